@@ -0,0 +1,149 @@
+"""Benchmarks the model cascade of cascade.py against the strong model alone
+(latency, calls, tokens and cost per patient, tier report).
+
+usage:
+    python benchmarks/bench_cascade.py --num-patients 20 --output cascade_bench.json
+"""
+
+import os
+import json
+import time
+import asyncio
+import argparse
+import platform
+import statistics
+import tempfile
+import contextlib
+
+from bench_harness import SAMPLE_DATA_PATH, SKILL_NAME, SKILL_PATH, bench_config, git_commit
+
+import agents
+import local_tools
+import stub_models
+from usage import BatchUsage
+
+
+def sample_documents(num_patients: int) -> list[tuple[int, str]]:
+    """insights <documents> messages with line-numbered notes, as app.py builds them."""
+    samples = sorted(int(filename[3:7]) for filename in os.listdir(SAMPLE_DATA_PATH)
+                     if filename.endswith("_note.txt"))
+    documents = []
+    for patient_id in range(num_patients):
+        data = local_tools.load_patient_data(
+            samples[patient_id % len(samples)], base_path=SAMPLE_DATA_PATH, line_numbers=True)
+        documents.append((patient_id, local_tools.create_xml_document({
+            "patient_id": patient_id, "notes": data["note"], "questions": data["question"],
+        }, root_tag="documents")))
+    return documents
+
+
+def build_agent(args, output_path: str, num_patients: int, cascade: bool) -> agents.Agent:
+    strong = stub_models.StubChatModel(
+        turns=stub_models.insights_tool_turns(grounded=True),
+        latency_s=args.strong_latency_s, output_tokens=args.output_tokens)
+    ungrounded = stub_models.insights_tool_turns()
+    cheap = stub_models.StubChatModel(
+        turns=stub_models.insights_tool_turns(grounded=True),
+        turns_by_patient={patient_id: ungrounded for patient_id in range(num_patients)
+                          if args.ungrounded_every and patient_id % args.ungrounded_every == 0},
+        latency_s=args.cheap_latency_s, output_tokens=args.output_tokens)
+    config = bench_config(output_path)
+    # one script per patient, so the subskills run in one ReAct loop
+    config.fanout.enabled = False
+    config.cascade.enabled = cascade
+    config.cascade.max_note_tokens = args.max_note_tokens
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        return agents.prepare_agent(SKILL_NAME, SKILL_PATH, config, llm=strong,
+                                    tier_llms=[cheap], reuse=False)
+
+
+async def run_batch(agent: agents.Agent, documents: list, output_path: str,
+                    max_concurrency: int) -> list[tuple[float, object]]:
+    """the arun_skill_batch loop; returns (latency_s, ledger) per patient."""
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run_patient(patient_id: int, documents_xml: str):
+        async with semaphore:
+            start = time.perf_counter()
+            ledger = await agents.arun_agent(
+                agent, f"bench_cascade_{patient_id:04d}", stream_mode="updates",
+                user_query=documents_xml,
+                metadata={"patient_id": patient_id, "skill_name": SKILL_NAME,
+                          "output_base_path": output_path})
+            return time.perf_counter() - start, ledger
+
+    results = await asyncio.gather(*(run_patient(*document) for document in documents))
+    agent.output_sink.flush()
+    return results
+
+
+def bench(args, documents: list, cascade: bool) -> dict:
+    with tempfile.TemporaryDirectory() as output_path:
+        agent = build_agent(args, output_path, len(documents), cascade)
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            start = time.perf_counter()
+            results = asyncio.run(run_batch(agent, documents, output_path, args.max_concurrency))
+            wall_clock_s = time.perf_counter() - start
+    latencies = [latency for latency, _ in results]
+    ledgers = [ledger for _, ledger in results]
+    num_patients = len(ledgers)
+    result = {
+        "wall_clock_s": round(wall_clock_s, 3),
+        "latency_s": {"mean": round(statistics.mean(latencies), 3),
+                      "p50": round(statistics.median(latencies), 3),
+                      "max": round(max(latencies), 3)},
+        "llm_calls_per_patient": sum(ledger.usage.llm_calls for ledger in ledgers) / num_patients,
+        "input_tokens_per_patient": round(
+            sum(ledger.usage.input_tokens for ledger in ledgers) / num_patients, 1),
+        "output_tokens_per_patient": round(
+            sum(ledger.usage.output_tokens for ledger in ledgers) / num_patients, 1),
+    }
+    # the patient ledgers price every tier's calls at the tier's rates
+    batch_usage = BatchUsage(agent.config.model.name, list(ledgers))
+    cost = batch_usage.cache_report()
+    result["cost_usd"] = round(cost["effective_input_cost_usd"] + cost["output_cost_usd"], 6)
+    if agent.cascade is not None:
+        report = agent.cascade.report()
+        result["tiers"] = report["tiers"]
+        result["direct_to_last_tier"] = report["direct_to_last_tier"]
+        result["tier_cost_usd"] = round(
+            sum(tier.get("cost_usd", 0) for tier in report["tiers"].values()), 6)
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--num-patients", type=int, default=20)
+    parser.add_argument("--max-concurrency", type=int, default=8)
+    parser.add_argument("--cheap-latency-s", type=float, default=0.1)
+    parser.add_argument("--strong-latency-s", type=float, default=0.5)
+    parser.add_argument("--output-tokens", type=int, default=600)
+    parser.add_argument("--ungrounded-every", type=int, default=4,
+                        help="the cheap tier is ungrounded for every n-th patient (0: never)")
+    parser.add_argument("--max-note-tokens", type=int, default=3000)
+    parser.add_argument("--output", default=None, help="optional JSON result file")
+    args = parser.parse_args()
+
+    documents = sample_documents(args.num_patients)
+    strong_only = bench(args, documents, cascade=False)
+    cascade = bench(args, documents, cascade=True)
+    results = {
+        "benchmark": "cascade",
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "num_patients": args.num_patients,
+        "strong_only": strong_only,
+        "cascade": cascade,
+        "latency_speedup": round(strong_only["latency_s"]["p50"] / cascade["latency_s"]["p50"], 2),
+        "cost_ratio": round(cascade["cost_usd"] / strong_only["cost_usd"], 3)
+                      if strong_only["cost_usd"] else None,
+    }
+
+    print(json.dumps(results, indent=4))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""Benchmarks the completion contract of completion.py: disabled, enabled and enabled
+with a tight output budget (latency, calls, tokens, savings and written outputs).
+
+usage:
+    python benchmarks/bench_completion.py --num-patients 20 --output completion_bench.json
+"""
+
+import os
+import json
+import time
+import asyncio
+import argparse
+import platform
+import statistics
+import tempfile
+import contextlib
+
+from bench_harness import SKILL_NAME, SKILL_PATH, bench_config, git_commit, run_batch
+from bench_cascade import sample_documents
+
+import agents
+import stub_models
+from completion import required_artifacts
+from usage import CompletionSavings
+
+
+def build_agent(args, output_path: str, enabled: bool,
+                max_patient_output_tokens=None) -> agents.Agent:
+    llm = stub_models.StubChatModel(
+        turns=stub_models.insights_tool_turns(), latency_s=args.latency_s,
+        output_tokens=args.output_tokens)
+    config = bench_config(output_path)
+    # one script per patient, so the closing turn is part of the ReAct loop
+    config.fanout.enabled = False
+    config.completion.enabled = enabled
+    config.completion.max_patient_output_tokens = max_patient_output_tokens
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        return agents.prepare_agent(SKILL_NAME, SKILL_PATH, config, llm=llm, reuse=False)
+
+
+def bench(args, documents: list, enabled: bool, max_patient_output_tokens=None) -> dict:
+    with tempfile.TemporaryDirectory() as output_path:
+        agent = build_agent(args, output_path, enabled, max_patient_output_tokens)
+        latencies, ledgers = [], []
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            for document in documents:
+                start = time.perf_counter()
+                ledgers += asyncio.run(run_batch(agent, [document], output_path, "updates", 1))
+                latencies.append(time.perf_counter() - start)
+        artifacts = required_artifacts(agent.config.skill)
+        written = sum(agent.output_sink.exists(output_path, f"pid{patient_id:04d}_{artifact}")
+                      for patient_id, _ in documents for artifact in artifacts)
+    num_patients = len(ledgers)
+    savings = CompletionSavings()
+    for ledger in ledgers:
+        savings.merge(ledger.completion)
+    return {
+        "latency_s": {"mean": round(statistics.mean(latencies), 3),
+                      "p50": round(statistics.median(latencies), 3),
+                      "max": round(max(latencies), 3)},
+        "llm_calls_per_patient": sum(ledger.usage.llm_calls for ledger in ledgers) / num_patients,
+        "input_tokens_per_patient": round(
+            sum(ledger.usage.input_tokens for ledger in ledgers) / num_patients, 1),
+        "output_tokens_per_patient": round(
+            sum(ledger.usage.output_tokens for ledger in ledgers) / num_patients, 1),
+        "completion": {
+            "early_stops": savings.early_stops,
+            "saved_input_tokens_per_patient": round(savings.saved_input_tokens / num_patients, 1),
+            "saved_output_tokens_per_patient": round(savings.saved_output_tokens / num_patients, 1),
+            "saved_seconds_per_patient": round(savings.saved_seconds / num_patients, 3),
+            "truncated_turns": savings.truncated_turns,
+            "budget_stops": savings.budget_stops,
+        },
+        "outputs_written_share": round(written / (num_patients * len(artifacts)), 3),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--num-patients", type=int, default=20)
+    parser.add_argument("--latency-s", type=float, default=0.2)
+    parser.add_argument("--output-tokens", type=int, default=600)
+    parser.add_argument("--budget-share", type=float, default=0.6,
+                        help="patient output-token budget as a share of the scripted run")
+    parser.add_argument("--output", default=None, help="optional JSON result file")
+    args = parser.parse_args()
+
+    documents = sample_documents(args.num_patients)
+    scripted_output_tokens = len(stub_models.insights_tool_turns()) * args.output_tokens
+    budget = round(scripted_output_tokens * args.budget_share)
+    disabled = bench(args, documents, enabled=False)
+    enabled = bench(args, documents, enabled=True)
+    budgeted = bench(args, documents, enabled=True, max_patient_output_tokens=budget)
+    results = {
+        "benchmark": "completion",
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "num_patients": args.num_patients,
+        "disabled": disabled,
+        "enabled": enabled,
+        "budgeted": {"max_patient_output_tokens": budget, **budgeted},
+        "latency_speedup": round(disabled["latency_s"]["p50"] / enabled["latency_s"]["p50"], 2),
+        "llm_calls_saved_per_patient": round(
+            disabled["llm_calls_per_patient"] - enabled["llm_calls_per_patient"], 2),
+    }
+
+    print(json.dumps(results, indent=4))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""Benchmarks loading patients from the packed corpus against the per-patient text files.
+
+usage:
+    python benchmarks/bench_corpus.py --num-patients 20000 --output corpus_bench.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+SAMPLE_DATA_PATH = os.path.join(SRC_PATH, "..", "data", "text_files")
+sys.path.append(SRC_PATH)
+
+import corpus
+import local_tools
+
+
+def load_samples() -> list[tuple[str, str, str]]:
+    """reads the (note, question, answer) samples shipped with the repo."""
+    samples = []
+    for filename in sorted(os.listdir(SAMPLE_DATA_PATH)):
+        if filename.endswith("_note.txt"):
+            prefix = os.path.join(SAMPLE_DATA_PATH, filename[:-len("_note.txt")])
+            samples.append(tuple(
+                open(f"{prefix}_{kind}.txt").read()
+                for kind in ("note", "question", "answer")))
+    return samples
+
+
+def write_layouts(base_path: str, num_patients: int) -> dict:
+    """writes num_patients patients as text files and as a packed corpus."""
+    samples = load_samples()
+    files_path = os.path.join(base_path, "files")
+    packed_path = os.path.join(base_path, "packed")
+    os.makedirs(files_path)
+
+    start = time.perf_counter()
+    for patient_id in range(num_patients):
+        note, question, answer = samples[patient_id % len(samples)]
+        for kind, text in (("note", note), ("question", question), ("answer", answer)):
+            with open(os.path.join(files_path, f"pid{patient_id:04d}_{kind}.txt"), "w") as f:
+                f.write(text)
+    files_write_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with corpus.CorpusWriter(packed_path) as writer:
+        for patient_id in range(num_patients):
+            writer.add(patient_id, *samples[patient_id % len(samples)])
+    packed_write_s = time.perf_counter() - start
+
+    return {
+        "files_path": files_path,
+        "packed_path": packed_path,
+        "files_write_s": round(files_write_s, 3),
+        "packed_write_s": round(packed_write_s, 3),
+        "files_count": len(os.listdir(files_path)),
+        "packed_count": len(os.listdir(packed_path)),
+    }
+
+
+def time_loads(base_path: str, patient_ids: list[int]) -> dict:
+    """loads every patient once; includes opening the corpus (cold start)."""
+    corpus._open_corpora.clear()
+    start = time.perf_counter()
+    first_load_s = None
+    for patient_id in patient_ids:
+        local_tools.load_patient_data(patient_id, base_path=base_path, line_numbers=True)
+        if first_load_s is None:
+            first_load_s = time.perf_counter() - start
+    total_s = time.perf_counter() - start
+    return {
+        "first_load_ms": round(first_load_s * 1000, 3),
+        "total_s": round(total_s, 3),
+        "patients_per_s": round(len(patient_ids) / total_s, 1),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--num-patients", type=int, default=10000)
+    parser.add_argument("--output", default=None, help="optional JSON result file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as base_path:
+        layouts = write_layouts(base_path, args.num_patients)
+        patient_ids = list(range(args.num_patients))
+        random.Random(0).shuffle(patient_ids)
+        results = {
+            "benchmark": "corpus",
+            "num_patients": args.num_patients,
+            **{k: v for k, v in layouts.items() if not k.endswith("_path")},
+            "files_load": time_loads(layouts["files_path"], patient_ids),
+            "packed_load": time_loads(layouts["packed_path"], patient_ids),
+        }
+    results["load_speedup"] = round(
+        results["files_load"]["total_s"] / results["packed_load"]["total_s"], 2)
+
+    print(json.dumps(results, indent=4))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""Benchmarks the near-duplicate index of note_dedup.py on a synthetic cohort with
+planted duplicates (index speed and memory, recall and precision, avoided runs).
+
+usage:
+    python benchmarks/bench_dedup.py --num-notes 100000 --output dedup_bench.json
+"""
+
+import os
+import json
+import random
+import argparse
+import platform
+import tracemalloc
+
+from bench_harness import SAMPLE_DATA_PATH, git_commit
+
+import local_tools
+import note_dedup
+from utils import DotDict
+
+
+def synthetic_cohort(num_notes: int, edits: int, exact_share: float, unique_share: float,
+                     seed: int) -> tuple[list[dict], list[int]]:
+    """patients built from the sample notes; returns the patient data and
+    the sample each patient was built from (-1 for unique notes)."""
+    rng = random.Random(seed)
+    samples = sorted(int(filename[3:7]) for filename in os.listdir(SAMPLE_DATA_PATH)
+                     if filename.endswith("_note.txt"))
+    sample_data = [local_tools.load_patient_data(patient_id, base_path=SAMPLE_DATA_PATH,
+                                                 line_numbers=False) for patient_id in samples]
+    vocabulary = sorted({word for data in sample_data for word in data["note"].split()})
+    cohort, sources = [], []
+    for patient_id in range(num_notes):
+        source = rng.randrange(len(sample_data))
+        data = sample_data[source]
+        words = data["note"].split(" ")
+        if rng.random() < unique_share:
+            # an unrelated note of the same length
+            words, source = [rng.choice(vocabulary) for _ in words], -1
+        elif rng.random() >= exact_share:
+            for _ in range(edits):
+                words[rng.randrange(len(words))] = rng.choice(vocabulary)
+        cohort.append({"patient_id": patient_id, "note": " ".join(words),
+                       "question": data["question"]})
+        sources.append(source)
+    return cohort, sources
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--num-notes", type=int, default=20000)
+    parser.add_argument("--edits", type=int, default=1, help="edited words per copied note")
+    parser.add_argument("--exact-share", type=float, default=0.3)
+    parser.add_argument("--unique-share", type=float, default=0.2)
+    parser.add_argument("--similarity", type=float, default=0.9)
+    parser.add_argument("--num-perm", type=int, default=128)
+    parser.add_argument("--bands", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--output", default=None, help="optional JSON result file")
+    args = parser.parse_args()
+
+    cohort, sources = synthetic_cohort(
+        args.num_notes, args.edits, args.exact_share, args.unique_share, args.seed)
+    settings = DotDict({"similarity": args.similarity, "num_perm": args.num_perm,
+                        "bands": args.bands, "reuse": True})
+    patient_ids = [data["patient_id"] for data in cohort]
+
+    plan = note_dedup.plan_duplicates(settings, "clinical_insights_skill", patient_ids,
+                                      patient_ids, lambda patient_id: cohort[patient_id])
+    # again with tracing, which slows the allocations down
+    tracemalloc.start()
+    note_dedup.plan_duplicates(settings, "clinical_insights_skill", patient_ids,
+                               patient_ids, lambda patient_id: cohort[patient_id])
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # every copy after the first of a sample is a planted duplicate
+    seen, planted = set(), 0
+    for source in sources:
+        if source >= 0:
+            planted += source in seen
+            seen.add(source)
+    found = plan.duplicates
+    correct = sum(1 for patient_id, (representative, _, _) in found.items()
+                  if sources[patient_id] >= 0 and sources[patient_id] == sources[representative])
+    report = plan.report()
+    results = {
+        "benchmark": "dedup",
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "num_notes": args.num_notes,
+        "settings": vars(args),
+        "index": {"seconds": report["index_s"],
+                  "notes_per_s": round(args.num_notes / report["index_s"], 1),
+                  "peak_traced_mb": round(peak_bytes / 2**20, 1)},
+        "quality": {"planted_duplicates": planted, "found_duplicates": len(found),
+                    "exact": report["exact"],
+                    "recall": round(correct / planted, 4) if planted else None,
+                    "precision": round(correct / len(found), 4) if found else None},
+        "avoided_share": round(len(found) / args.num_notes, 4),
+    }
+
+    print(json.dumps(results, indent=4))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Benchmarks the fan-out graph of fanout.py against the sequential ReAct agent
+(latency, calls and input tokens per patient, and whether the outputs match).
+
+usage:
+    python benchmarks/bench_fanout.py --num-patients 20 --latency-s 0.5 --output fanout_bench.json
+"""
+
+import os
+import json
+import time
+import asyncio
+import argparse
+import platform
+import statistics
+import tempfile
+import contextlib
+
+from bench_harness import SKILL_NAME, SKILL_PATH, bench_config, git_commit, sample_documents
+
+import agents
+import stub_models
+
+
+OUTPUT_ARTIFACTS = ("notes_with_toc.md", "treatment_recommendation.json",
+                    "clinical_summary.json")
+
+def build_agent(args, output_path: str, fanout: bool) -> agents.Agent:
+    llm = stub_models.StubChatModel(
+        turns=stub_models.insights_tool_turns(),
+        turns_by_prompt=stub_models.insights_branch_turns(),
+        latency_s=args.latency_s, output_tokens=args.output_tokens)
+    config = bench_config(output_path)
+    config.fanout.enabled = fanout
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        return agents.prepare_agent(SKILL_NAME, SKILL_PATH, config, llm=llm, reuse=False)
+
+
+async def run_batch(agent: agents.Agent, documents: list, output_path: str,
+                    max_concurrency: int) -> list[tuple[float, object]]:
+    """the arun_skill_batch loop; returns (latency_s, ledger) per patient."""
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run_patient(patient_id: int, documents_xml: str):
+        async with semaphore:
+            start = time.perf_counter()
+            ledger = await agents.arun_agent(
+                agent, f"bench_fanout_{patient_id:04d}", stream_mode="updates",
+                user_query=documents_xml,
+                metadata={"patient_id": patient_id, "skill_name": SKILL_NAME,
+                          "output_base_path": output_path})
+            return time.perf_counter() - start, ledger
+
+    results = await asyncio.gather(*(run_patient(*document) for document in documents))
+    agent.output_sink.flush()
+    return results
+
+
+def bench(args, documents: list, fanout: bool) -> tuple[dict, list[str]]:
+    with tempfile.TemporaryDirectory() as output_path:
+        agent = build_agent(args, output_path, fanout)
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            start = time.perf_counter()
+            results = asyncio.run(run_batch(agent, documents, output_path, args.max_concurrency))
+            wall_clock_s = time.perf_counter() - start
+        outputs = sorted(agent.output_sink.versions(output_path, [
+            f"pid{patient_id:04d}_{artifact}" for patient_id, _ in documents
+            for artifact in OUTPUT_ARTIFACTS]))
+    latencies = [latency for latency, _ in results]
+    ledgers = [ledger for _, ledger in results]
+    num_patients = len(ledgers)
+    return {
+        "wall_clock_s": round(wall_clock_s, 3),
+        "latency_s": {"mean": round(statistics.mean(latencies), 3),
+                      "p50": round(statistics.median(latencies), 3),
+                      "max": round(max(latencies), 3)},
+        "llm_calls_per_patient": sum(ledger.usage.llm_calls for ledger in ledgers) / num_patients,
+        "input_tokens_per_patient": round(
+            sum(ledger.usage.input_tokens for ledger in ledgers) / num_patients, 1),
+        "output_tokens_per_patient": round(
+            sum(ledger.usage.output_tokens for ledger in ledgers) / num_patients, 1),
+    }, outputs
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--num-patients", type=int, default=20)
+    parser.add_argument("--max-concurrency", type=int, default=8)
+    parser.add_argument("--latency-s", type=float, default=0.5)
+    parser.add_argument("--output-tokens", type=int, default=600)
+    parser.add_argument("--output", default=None, help="optional JSON result file")
+    args = parser.parse_args()
+
+    documents = sample_documents(args.num_patients)
+    sequential, sequential_outputs = bench(args, documents, fanout=False)
+    fanout, fanout_outputs = bench(args, documents, fanout=True)
+    results = {
+        "benchmark": "fanout",
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "num_patients": args.num_patients,
+        "sequential": sequential,
+        "fanout": fanout,
+        "same_outputs": sequential_outputs == fanout_outputs,
+        "latency_speedup": round(sequential["latency_s"]["mean"] / fanout["latency_s"]["mean"], 2),
+        "input_token_ratio": round(
+            fanout["input_tokens_per_patient"] / sequential["input_tokens_per_patient"], 3),
+    }
+
+    print(json.dumps(results, indent=4))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+"""Benchmarks the agent harness offline with stub_models.StubChatModel (throughput per
+stream mode, sync runs, memory, concurrency scaling and usage accounting).
+
+usage:
+    python benchmarks/bench_harness.py --num-patients 50 --output harness_bench.json
+    python benchmarks/bench_harness.py --compare harness_bench.json
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import tempfile
+import contextlib
+import subprocess
+import tracemalloc
+
+BENCH_PATH = os.path.dirname(os.path.abspath(__file__))
+SRC_PATH = os.path.join(BENCH_PATH, "..", "src")
+SKILL_PATH = os.path.join(BENCH_PATH, "..", "skills")
+SAMPLE_DATA_PATH = os.path.join(BENCH_PATH, "..", "data", "text_files")
+sys.path.append(SRC_PATH)
+
+import agents
+import local_tools
+import stub_models
+from utils import ConfigLoader
+
+SKILL_NAME = "clinical_insights_skill"
+STREAM_MODES = ("values", "updates", "messages", "tokens")
+
+
+def bench_config(output_path: str):
+    """the repo's agent config with local paths, the caches and the rate
+    limiter disabled."""
+    config = ConfigLoader(os.path.join(SRC_PATH, "agent_config.yaml")).dotdict
+    config.system_prompt_file_path = os.path.join(SRC_PATH, "system_prompt.txt")
+    if getattr(config, "response_cache", None):
+        config.response_cache.enabled = False
+    if getattr(config, "rate_limit", None):
+        config.rate_limit.enabled = False
+    if getattr(config, "memory", None):
+        config.memory.path = os.path.join(output_path, "chat_memory.sqlite")
+    if getattr(config, "output_sink", None):
+        config.output_sink.path = os.path.join(output_path, "results.sqlite")
+    return config
+
+
+def sample_documents(num_patients: int) -> list[tuple[int, str]]:
+    """insights <documents> messages built from the sample notes."""
+    samples = sorted(int(filename[3:7]) for filename in os.listdir(SAMPLE_DATA_PATH)
+                     if filename.endswith("_note.txt"))
+    documents = []
+    for patient_id in range(num_patients):
+        data = local_tools.load_patient_data(
+            samples[patient_id % len(samples)], base_path=SAMPLE_DATA_PATH)
+        documents.append((patient_id, local_tools.create_xml_document({
+            "patient_id": patient_id, "notes": data["note"], "questions": data["question"],
+        }, root_tag="documents")))
+    return documents
+
+
+def build_agent(args, output_path: str, latency_s: float = 0.0,
+                fanout: bool = False) -> agents.Agent:
+    llm = stub_models.StubChatModel(
+        turns=stub_models.insights_tool_turns(), latency_s=latency_s,
+        turns_by_prompt=stub_models.insights_branch_turns(),
+        output_tokens=args.output_tokens, input_tokens=args.input_tokens,
+        chunk_chars=args.chunk_chars)
+    config = bench_config(output_path)
+    config.fanout.enabled = fanout
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        return agents.prepare_agent(SKILL_NAME, SKILL_PATH, config, llm=llm)
+
+
+async def run_batch(agent: agents.Agent, documents: list, output_path: str,
+                    stream_mode: str, max_concurrency: int) -> list:
+    """the arun_skill_batch loop without the reporting."""
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run_patient(patient_id: int, documents_xml: str):
+        async with semaphore:
+            return await agents.arun_agent(
+                agent, f"bench_{patient_id:04d}", stream_mode=stream_mode,
+                user_query=documents_xml,
+                metadata={"patient_id": patient_id, "skill_name": SKILL_NAME,
+                          "output_base_path": output_path})
+
+    ledgers = await asyncio.gather(*(run_patient(*document) for document in documents))
+    agent.output_sink.flush()
+    return ledgers
+
+
+def summarize(ledgers: list, wall_clock_s: float) -> dict:
+    events = sum(ledger.usage.events_seen for ledger in ledgers)
+    llm_calls = sum(ledger.usage.llm_calls for ledger in ledgers)
+    return {
+        "wall_clock_s": round(wall_clock_s, 4),
+        "patients_per_s": round(len(ledgers) / wall_clock_s, 2),
+        "events": events,
+        "events_per_s": round(events / wall_clock_s, 1),
+        "llm_calls": llm_calls,
+        # the model answers instantly, so this is the harness cost per event
+        "overhead_per_event_ms": round(wall_clock_s * 1000 / events, 4) if events else None,
+    }
+
+
+def bench_throughput(args, documents: list, output_path: str) -> dict:
+    results = {}
+    for stream_mode in STREAM_MODES:
+        agent = build_agent(args, output_path)
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            asyncio.run(run_batch(agent, documents[:2], output_path, stream_mode, 1))  # warm-up
+            start = time.perf_counter()
+            ledgers = asyncio.run(run_batch(
+                agent, documents, output_path, stream_mode, args.max_concurrency))
+        results[stream_mode] = summarize(ledgers, time.perf_counter() - start)
+    return results
+
+
+def bench_sync_run(args, documents: list, output_path: str) -> dict:
+    """sequential agents.run_agent calls, as app.run_skill does."""
+    agent = build_agent(args, output_path)
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        start = time.perf_counter()
+        ledgers = [agents.run_agent(
+            agent, f"bench_sync_{patient_id:04d}", stream_mode="values",
+            user_query=documents_xml,
+            metadata={"patient_id": patient_id, "skill_name": SKILL_NAME,
+                      "output_base_path": output_path})
+            for patient_id, documents_xml in documents]
+        agent.output_sink.flush()
+    return summarize(ledgers, time.perf_counter() - start)
+
+
+def bench_memory(args, documents: list, output_path: str) -> dict:
+    agent = build_agent(args, output_path)
+    tracemalloc.start()
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        asyncio.run(run_batch(agent, documents, output_path, "values", args.max_concurrency))
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"peak_traced_mb": round(peak / 2 ** 20, 2),
+            "retained_mb": round(current / 2 ** 20, 2),
+            "peak_per_patient_kb": round(peak / 1024 / len(documents), 1)}
+
+
+def bench_scaling(args, documents: list, output_path: str) -> dict:
+    results = {}
+    agent = build_agent(args, output_path, latency_s=args.latency_s)
+    for concurrency in args.concurrency:
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            start = time.perf_counter()
+            asyncio.run(run_batch(agent, documents, output_path, "values", concurrency))
+        results[str(concurrency)] = round(time.perf_counter() - start, 3)
+    base = results[str(args.concurrency[0])]
+    return {"model_latency_s": args.latency_s,
+            "wall_clock_s": results,
+            "speedup": {c: round(base / s, 2) for c, s in results.items()}}
+
+
+def bench_accounting(args, documents: list, output_path: str) -> dict:
+    """every scripted call must be counted once with the scripted tokens, and
+    stream as one model turn (also when fan-out branches interleave)."""
+    agent = build_agent(args, output_path, latency_s=0.01, fanout=True)
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        ledgers = asyncio.run(run_batch(agent, documents, output_path, "tokens", 4))
+    if agent.fanout_enabled:
+        calls_per_patient = sum(map(len, stub_models.insights_branch_turns().values()))
+    else:
+        calls_per_patient = len(stub_models.insights_tool_turns())
+        if agent.completion_enabled:
+            # the closing turn after the last output is not called (see completion.py)
+            calls_per_patient -= 1
+    expected_calls = len(documents) * calls_per_patient
+    llm_calls = sum(ledger.usage.llm_calls for ledger in ledgers)
+    output_tokens = sum(ledger.usage.output_tokens for ledger in ledgers)
+    model_turns = sum(len(ledger.turns) for ledger in ledgers)
+    return {"expected_llm_calls": expected_calls, "llm_calls": llm_calls,
+            "output_tokens": output_tokens, "model_turns": model_turns,
+            "consistent": (llm_calls == expected_calls == model_turns
+                           and output_tokens == expected_calls * args.output_tokens)}
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_PATH,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(results: dict, baseline: dict, path: str = "") -> None:
+    """prints the relative change of every numeric result."""
+    for key, value in results.items():
+        name = f"{path}.{key}" if path else key
+        base = baseline.get(key) if isinstance(baseline, dict) else None
+        if isinstance(value, dict):
+            compare(value, base or {}, name)
+        elif (isinstance(value, (int, float)) and not isinstance(value, bool)
+              and isinstance(base, (int, float)) and base):
+            print(f"{name:55s} {base:>12} -> {value:>12} ({(value - base) / base:+.1%})")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--num-patients", type=int, default=50)
+    parser.add_argument("--max-concurrency", type=int, default=8)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--latency-s", type=float, default=0.05,
+                        help="stub model latency for the scaling runs")
+    parser.add_argument("--input-tokens", type=int, default=0,
+                        help="reported input tokens per call (0: ~len/4 of the prompt)")
+    parser.add_argument("--output-tokens", type=int, default=32)
+    parser.add_argument("--chunk-chars", type=int, default=16,
+                        help="streamed chunk size in messages mode")
+    parser.add_argument("--output", default=None, help="optional JSON result file")
+    parser.add_argument("--compare", default=None, help="earlier JSON result file")
+    args = parser.parse_args()
+
+    documents = sample_documents(args.num_patients)
+    with tempfile.TemporaryDirectory() as output_path:
+        results = {
+            "benchmark": "harness",
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "num_patients": args.num_patients,
+            "throughput": bench_throughput(args, documents, output_path),
+            "sync_run": bench_sync_run(args, documents, output_path),
+            "memory": bench_memory(args, documents, output_path),
+            "scaling": bench_scaling(args, documents, output_path),
+            "accounting": bench_accounting(args, documents, output_path),
+        }
+
+    print(json.dumps(results, indent=4))
+    if args.compare:
+        with open(args.compare, "r") as f:
+            compare(results, json.load(f))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""Benchmarks the chunked CSV ingest of data/preprocessing.py against the original
+load_data path (time and peak RSS, one child process per mode).
+
+usage:
+    python benchmarks/bench_ingest.py --num-rows 200000 --output ingest_bench.json
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import resource
+import tempfile
+import subprocess
+
+BENCH_PATH = os.path.dirname(os.path.abspath(__file__))
+REPO_PATH = os.path.join(BENCH_PATH, "..")
+SAMPLE_DATA_PATH = os.path.join(REPO_PATH, "data", "text_files")
+sys.path.append(REPO_PATH)
+
+
+def write_synthetic_csv(filepath: str, num_rows: int) -> None:
+    """writes num_rows rows; every other row belongs to another task."""
+    samples = []
+    for filename in sorted(os.listdir(SAMPLE_DATA_PATH)):
+        if filename.endswith("_note.txt"):
+            prefix = os.path.join(SAMPLE_DATA_PATH, filename[:-len("_note.txt")])
+            samples.append([open(f"{prefix}_{kind}.txt").read()
+                            for kind in ("note", "question", "answer")])
+    with open(filepath, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["idx", "patient_id", "task", "note", "full_note",
+                         "question", "answer", "conversation"])
+        for row in range(num_rows):
+            note, question, answer = samples[row % len(samples)]
+            task = "Summarization" if row % 2 == 0 else "Question Answering"
+            writer.writerow([row, row, task, note, note, question, answer, note])
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1)
+
+
+def run_mode(mode: str, csv_fp: str, base_path: str, chunksize: int) -> dict:
+    """runs one ingestion mode in this process and returns its stats."""
+    from data import preprocessing
+
+    start = time.perf_counter()
+    if mode == "legacy":
+        df = preprocessing.load_data(csv_fp, task_name="Summarization")
+        rows = rows_written = len(df)
+        for _, row in df.iterrows():
+            patient_id = f"pid{int(row['patient_id']):04d}"
+            for kind in ("note", "question", "answer"):
+                with open(f"{base_path}/{patient_id}_{kind}.txt", "w") as f:
+                    f.write(row[kind])
+    else:
+        stats = preprocessing.ingest_csv(
+            csv_fp, base_path=base_path, task_name="Summarization",
+            chunksize=chunksize, resume=(mode == "resume"), packed=False)
+        rows, rows_written = stats["rows_read"], stats["rows_written"]
+    duration_s = time.perf_counter() - start
+    return {
+        "mode": mode,
+        "rows_read": rows,
+        "rows_written": rows_written,
+        "duration_s": round(duration_s, 3),
+        "rows_per_s": round(rows / duration_s, 1) if duration_s else 0.0,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def run_child(mode: str, csv_fp: str, base_path: str, chunksize: int) -> dict:
+    output = subprocess.run(
+        [sys.executable, __file__, "--child", mode, "--csv", csv_fp,
+         "--base-path", base_path, "--chunksize", str(chunksize)],
+        check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--num-rows", type=int, default=50000)
+    parser.add_argument("--chunksize", type=int, default=10000)
+    parser.add_argument("--output", default=None, help="optional JSON result file")
+    parser.add_argument("--child", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--csv", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--base-path", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_mode(args.child, args.csv, args.base_path, args.chunksize)))
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_path:
+        csv_fp = os.path.join(tmp_path, "synthetic.csv")
+        write_synthetic_csv(csv_fp, args.num_rows)
+        legacy_path = os.path.join(tmp_path, "legacy")
+        chunked_path = os.path.join(tmp_path, "chunked")
+        os.makedirs(legacy_path)
+        results = {
+            "benchmark": "ingest",
+            "num_rows": args.num_rows,
+            "csv_mb": round(os.path.getsize(csv_fp) / 1024 / 1024, 1),
+            "chunksize": args.chunksize,
+            "legacy": run_child("legacy", csv_fp, legacy_path, args.chunksize),
+            "chunked": run_child("chunked", csv_fp, chunked_path, args.chunksize),
+            # second pass over the same output: everything is skipped
+            "resume": run_child("resume", csv_fp, chunked_path, args.chunksize),
+        }
+
+    print(json.dumps(results, indent=4))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Benchmarks rate_limit.RateLimitScheduler against a throttled stub model, without and
+with the scheduler (failed patients, attempts, retries, wait and concurrency).
+
+usage:
+    python benchmarks/bench_rate_limit.py --num-patients 40 --output rate_limit_bench.json
+"""
+
+import os
+import json
+import time
+import asyncio
+import argparse
+import platform
+import tempfile
+import contextlib
+
+from bench_harness import SKILL_NAME, SKILL_PATH, bench_config, git_commit, sample_documents
+
+import agents
+import rate_limit
+import stub_models
+
+
+def build_agent(args, output_path: str, scheduled: bool) -> agents.Agent:
+    llm = stub_models.ThrottlingStubChatModel(
+        turns=stub_models.insights_tool_turns(), latency_s=args.latency_s,
+        turns_by_prompt=stub_models.insights_branch_turns(),
+        requests_per_window=args.requests_per_window, window_s=args.window_s,
+        server_error_every=args.server_error_every)
+    config = bench_config(output_path)
+    # the stub's limit expressed per minute; slightly below it, as one would
+    # configure against a provider
+    config.rate_limit.enabled = scheduled
+    config.rate_limit.requests_per_minute = 0.9 * args.requests_per_window * 60 / args.window_s
+    config.rate_limit.tokens_per_minute = 10 ** 9  # the stub does not limit tokens
+    config.rate_limit.burst_s = args.window_s
+    config.rate_limit.backoff_base_s = args.window_s / 20
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        return agents.prepare_agent(SKILL_NAME, SKILL_PATH, config, llm=llm, reuse=False)
+
+
+async def run_batch(agent: agents.Agent, documents: list, output_path: str,
+                    max_concurrency: int) -> int:
+    """the arun_skill_batch loop; returns the number of failed patients."""
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run_patient(patient_id: int, documents_xml: str):
+        async with semaphore:
+            return await agents.arun_agent(
+                agent, f"bench_rl_{patient_id:04d}", stream_mode="updates",
+                user_query=documents_xml,
+                metadata={"patient_id": patient_id, "skill_name": SKILL_NAME,
+                          "output_base_path": output_path})
+
+    results = await asyncio.gather(*(run_patient(*document) for document in documents),
+                                   return_exceptions=True)
+    agent.output_sink.flush()
+    return sum(isinstance(result, Exception) for result in results)
+
+
+def bench(args, documents: list, output_path: str, scheduled: bool) -> dict:
+    agent = build_agent(args, output_path, scheduled)
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        start = time.perf_counter()
+        failed = asyncio.run(run_batch(agent, documents, output_path, args.max_concurrency))
+    result = {"wall_clock_s": round(time.perf_counter() - start, 3),
+              "patients_failed": failed,
+              "patients_completed": len(documents) - failed,
+              "model_rejections": agent.llm.rejected}
+    if agent.scheduler is not None:
+        stats = agent.scheduler.stats()
+        result["scheduler"] = stats
+        result["attempts_per_call"] = round(stats["attempts"] / max(stats["calls"], 1), 3)
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--num-patients", type=int, default=40)
+    parser.add_argument("--max-concurrency", type=int, default=16)
+    parser.add_argument("--latency-s", type=float, default=0.02)
+    parser.add_argument("--requests-per-window", type=int, default=30)
+    parser.add_argument("--window-s", type=float, default=1.0)
+    parser.add_argument("--server-error-every", type=int, default=25)
+    parser.add_argument("--output", default=None, help="optional JSON result file")
+    args = parser.parse_args()
+
+    documents = sample_documents(args.num_patients)
+    with tempfile.TemporaryDirectory() as output_path:
+        results = {
+            "benchmark": "rate_limit",
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "num_patients": args.num_patients,
+            "without_scheduler": bench(args, documents, output_path, scheduled=False),
+            "with_scheduler": bench(args, documents, output_path, scheduled=True),
+        }
+    rate_limit._schedulers.clear()
+
+    print(json.dumps(results, indent=4))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Benchmarks the cold import of app.py and the agent setup of agents.prepare_agent.
+
+usage:
+    python benchmarks/bench_startup.py --repeats 5 --output startup_bench.json
+    python benchmarks/bench_startup.py --compare startup_bench.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import statistics
+import contextlib
+import subprocess
+
+from bench_harness import SRC_PATH, SKILL_PATH, bench_config, compare, git_commit
+
+import agents
+import stub_models
+
+SKILLS = ("clinical_insights_skill", "clinical_judge_skill")
+HEAVY_MODULES = ("openai", "langchain_openai", "git", "pandas")
+IMPORT_SCRIPT = (
+    "import sys, time, json; start = time.perf_counter(); import app; "
+    "print(json.dumps({'seconds': time.perf_counter() - start, "
+    f"'loaded': [m for m in {HEAVY_MODULES!r} if m in sys.modules]}}))")
+
+
+def bench_cold_import(repeats: int) -> dict:
+    runs = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT], cwd=SRC_PATH,
+                                capture_output=True, text=True, check=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    return {"median_s": round(statistics.median(run["seconds"] for run in runs), 4),
+            "min_s": round(min(run["seconds"] for run in runs), 4),
+            "heavy_modules_loaded": runs[-1]["loaded"]}
+
+
+def time_call(fn) -> float:
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        start = time.perf_counter()
+        fn()
+        return round(time.perf_counter() - start, 4)
+
+
+def bench_setup(output_path: str, llm_factory) -> dict:
+    results = {}
+    for skill_name in SKILLS:
+        llm = llm_factory()
+        # every call loads the config again, as app.run_skill does, so the
+        # pooled call only hits when equal configs give equal pool keys
+        prepare = lambda **kwargs: agents.prepare_agent(
+            skill_name, SKILL_PATH, bench_config(output_path), llm=llm, **kwargs)
+        results[skill_name] = {
+            "first_s": time_call(prepare),
+            "pooled_s": time_call(prepare),
+            "pool_hit": prepare() is prepare(),
+            "rebuild_s": time_call(lambda: prepare(reuse=False)),
+        }
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--output", default=None, help="optional JSON result file")
+    parser.add_argument("--compare", default=None, help="earlier JSON result file")
+    args = parser.parse_args()
+
+    # the OpenAI client is only constructed, a placeholder key is enough
+    os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+    with tempfile.TemporaryDirectory() as output_path:
+        results = {
+            "benchmark": "startup",
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "cold_import": bench_cold_import(args.repeats),
+            "setup_stub": bench_setup(output_path, lambda: stub_models.StubChatModel(
+                turns=stub_models.insights_tool_turns())),
+            "setup_openai": bench_setup(output_path, lambda: None),
+        }
+
+    print(json.dumps(results, indent=4))
+    if args.compare:
+        with open(args.compare, "r") as f:
+            compare(results, json.load(f))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,20 @@
+"""
+Turns the CSV export into per-patient text files and/or the packed corpus.
+
+Run it from the repository root, so that the src package can be imported:
+    python -m data.preprocessing
+"""
 
 import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
+
 import pandas as pd
 
+from src.corpus import CorpusWriter
+
 
 # set pandas display options for better readability
 pd.set_option('display.max_columns', None)
@@ -12,6 +25,17 @@ pd.set_option('display.max_colwidth', 20)
 csv_fp = "/Users/ebadahmadzadeh/ms-code-projects/ethermed/langgraph_agent_app/data/synthetic.csv"
 output_text_base_path = "/Users/ebadahmadzadeh/ms-code-projects/ethermed/langgraph_agent_app/data/text_files"
 
+# only these columns are parsed from the CSV export
+INGEST_COLUMNS = ["patient_id", "task", "note", "question", "answer"]
+INGEST_DTYPES = {
+    "patient_id": "Int64",  # nullable: rows without an id are dropped
+    "task": "category",
+    "note": "string",
+    "question": "string",
+    "answer": "string",
+}
+DOCUMENT_KINDS = ("note", "question", "answer")
+
 
 def load_data(filepath: str, task_name: str = "Summarization", num_rows: int = None) -> pd.DataFrame:
     """Loads data from a CSV file and filters by task name."""
@@ -44,31 +68,138 @@ def show_note_length_stats(dataframe: pd.DataFrame):
     print(f"Min: {note_lengths.min()}")
 
 
-def save_row_as_text_files(dataframe: pd.DataFrame, base_path: str = "."):
-    """Saves each row as 3 text files."""
+def iter_data_chunks(filepath: str, task_name: str = "Summarization",
+                     num_rows: int = None, chunksize: int = 10000) -> Iterator[pd.DataFrame]:
+    """Streams the CSV in chunks, parsing only the needed columns and keeping
+    only rows of the given task, so memory is bounded by the chunk size."""
+    remaining = num_rows
+    reader = pd.read_csv(filepath, usecols=INGEST_COLUMNS, dtype=INGEST_DTYPES,
+                         chunksize=chunksize)
+    with reader:
+        for chunk in reader:
+            chunk = chunk[(chunk['task'] == task_name) & chunk['patient_id'].notna()]
+            if remaining is not None:
+                chunk = chunk.head(remaining)
+                remaining -= len(chunk)
+            if len(chunk):
+                yield chunk
+            if remaining is not None and remaining <= 0:
+                return
+
+
+def _write_text_file(filepath: str, text: str) -> None:
+    # written to a temporary file and renamed over the target, so a crash
+    # never leaves a partial file that resume would count as done
+    tmp_fp = f"{filepath}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_fp, "w") as f:
+        f.write(text)
+    os.replace(tmp_fp, filepath)
+
+
+def save_row_as_text_files(dataframe: pd.DataFrame, base_path: str = ".",
+                           executor: ThreadPoolExecutor = None):
+    """Saves each row as 3 text files (file paths are built column-wise and
+    the files are written by a thread pool)."""
     # create base path directory if it doesn't exist
     os.makedirs(base_path, exist_ok=True)
-    for index, row in dataframe.iterrows():
-        patient_id = row['patient_id']
-        # note = row['note']
-        note = row['note']
-        question = row['question']
-        answer = row['answer']
-        
-        patient_id = f"pid{int(patient_id):04d}"
-        with open(f"{base_path}/{patient_id}_note.txt", "w") as f:
-            f.write(note)
-
-        with open(f"{base_path}/{patient_id}_question.txt", "w") as f:
-            f.write(question)
-
-        with open(f"{base_path}/{patient_id}_answer.txt", "w") as f:
-            f.write(answer)
+    # load_data parses the ids as floats when some are missing
+    dataframe = dataframe[dataframe['patient_id'].notna()]
+    if dataframe.empty:
+        return
+    prefixes = base_path + "/pid" + dataframe['patient_id'].map(lambda patient_id: f"{int(patient_id):04d}")
+    filepaths, texts = [], []
+    for kind in DOCUMENT_KINDS:
+        filepaths.extend(prefixes + f"_{kind}.txt")
+        texts.extend(dataframe[kind].fillna(""))
+
+    if executor is None:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(_write_text_file, filepaths, texts))
+    else:
+        list(executor.map(_write_text_file, filepaths, texts))
+
+
+def materialized_patient_ids(base_path: str) -> set[int]:
+    """patients whose three text files already exist in base_path."""
+    if not os.path.isdir(base_path):
+        return set()
+    counts = {}
+    for filename in os.listdir(base_path):
+        if filename.startswith("pid") and filename.endswith(".txt"):
+            patient_id, _, kind = filename[3:-4].partition("_")
+            if kind in DOCUMENT_KINDS and patient_id.isdigit():
+                counts[int(patient_id)] = counts.get(int(patient_id), 0) + 1
+    return {patient_id for patient_id, count in counts.items()
+            if count == len(DOCUMENT_KINDS)}
+
+
+def ingest_csv(filepath: str, base_path: str = ".", task_name: str = "Summarization",
+               num_rows: int = None, chunksize: int = 10000, resume: bool = True,
+               text_files: bool = True, packed: bool = True, workers: int = 8) -> dict:
+    """Streams the CSV into per-patient text files and/or the packed corpus.
+
+    With resume=True, patients that are already materialized (all three text
+    files, or an entry in the packed corpus) are skipped, so an interrupted
+    ingestion can be restarted. Returns throughput stats."""
+    assert text_files or packed, "nothing to write: enable text_files and/or packed"
+    os.makedirs(base_path, exist_ok=True)
+    start = time.perf_counter()
+    done_files = materialized_patient_ids(base_path) if (resume and text_files) else set()
+    rows_read = rows_written = rows_skipped = 0
+
+    writer = CorpusWriter(base_path) if packed else None
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for chunk in iter_data_chunks(filepath, task_name, num_rows, chunksize):
+                rows_read += len(chunk)
+                patient_ids = chunk['patient_id']
+                if text_files:
+                    pending = chunk[~patient_ids.isin(done_files)] if resume else chunk
+                    save_row_as_text_files(pending, base_path, executor=executor)
+                    done_files.update(int(patient_id) for patient_id in pending['patient_id'])
+                if writer is not None:
+                    pending_packed = chunk[[not (resume and patient_id in writer)
+                                            for patient_id in patient_ids]]
+                    for patient_id, note, question, answer in zip(
+                            pending_packed['patient_id'], pending_packed['note'].fillna(""),
+                            pending_packed['question'].fillna(""),
+                            pending_packed['answer'].fillna("")):
+                        writer.add(int(patient_id), note, question, answer)
+                written = len(pending) if text_files else len(pending_packed)
+                rows_written += written
+                rows_skipped += len(chunk) - written
+        finally:
+            if writer is not None:
+                writer.close()
+
+    duration_s = time.perf_counter() - start
+    return {
+        "rows_read": rows_read,
+        "rows_written": rows_written,
+        "rows_skipped": rows_skipped,
+        "duration_s": round(duration_s, 3),
+        "rows_per_s": round(rows_read / duration_s, 1) if duration_s else 0.0,
+    }
+
+
+def save_as_packed_corpus(dataframe: pd.DataFrame, base_path: str = "."):
+    """Appends all rows to the packed corpus (corpus.bin + corpus.idx.json),
+    with the line-numbered notes precomputed."""
+    dataframe = dataframe[dataframe['patient_id'].notna()]
+    with CorpusWriter(base_path) as writer:
+        for patient_id, note, question, answer in zip(
+                dataframe['patient_id'], dataframe['note'],
+                dataframe['question'], dataframe['answer']):
+            writer.add(int(patient_id), note, question, answer)
 
 
 if __name__ == "__main__":
-    df = load_data(csv_fp, task_name="Summarization", num_rows=10)
+    # streams the export in chunks (bounded memory), resuming after the
+    # patients already written
+    print(ingest_csv(csv_fp, base_path=output_text_base_path, task_name="Summarization",
+                     num_rows=10))
+    # to inspect the data in memory instead:
+    # df = load_data(csv_fp, task_name="Summarization", num_rows=10)
     # show_head(df, num_rows=5)
     # show_note(df, row_index=2)
     # show_note_length_stats(df)
-    save_row_as_text_files(df ,base_path=output_text_base_path)
@@ -6,202 +6,477 @@ Export your key first, e.g.:
 """
 
 from __future__ import annotations
-from dataclasses import dataclass
 import os
 import json
-from typing import Iterable, Optional, Sequence
+import hashlib
+import threading
+from typing import AsyncIterable, Iterable, Optional, Sequence
 
-from langchain_openai import ChatOpenAI
+from langchain_core.language_models import BaseChatModel
 from langchain.agents import create_agent
 # from langgraph.prebuilt import create_react_agent as create_agent
-from langchain_core.messages import SystemMessage, AIMessage
-from langchain_core.messages import HumanMessage, ToolMessage, BaseMessage
+from langchain_core.messages import AIMessage, SystemMessage, HumanMessage
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from langgraph.checkpoint.sqlite import SqliteSaver
 
 import local_tools
+import tracing
+from cascade import Cascade
+from completion import CompletionMiddleware, required_artifacts
+from fanout import BranchDoneMiddleware, branch_skills, build_fanout_graph
+from memory import HistoryCompactionMiddleware, build_checkpointer
+from output_sink import OutputSink, build_output_sink, sink_scope
+from rate_limit import RateLimitMiddleware, build_scheduler
+from response_cache import build_response_cache
+from streaming import NullSink, StreamRenderer, StreamSink, TerminalSink, graph_stream_mode
+from usage import TokenUsage, UsageLedger, UsageCallbackHandler, usage_scope
 from utils import DotDict, ConfigLoader
 
 
-@dataclass
-class TokenUsage:
-    model: str
-    stream_mode: str = "values"
-    input_tokens: int = 0
-    output_tokens: int = 0
-    total_tokens: int = 0
-    events_seen: int = 0
-
-    def update_usage(self, message: BaseMessage) -> None:
-        """updates the token usage based on the message."""
-        if hasattr(message, "usage_metadata"):
-            usage = message.usage_metadata
-            self.input_tokens += usage.get("input_tokens", 0)
-            self.output_tokens += usage.get("output_tokens", 0)
-            self.total_tokens += usage.get("total_tokens", 0)
-        if hasattr(message, "response_metadata"):
-            usage = message.response_metadata.get("token_usage", {})
-            self.input_tokens += usage.get("prompt_tokens", 0)
-            self.output_tokens += usage.get("completion_tokens", 0)
-            self.total_tokens += usage.get("total_tokens", 0)
-
-    def save(self, filepath: str) -> None:
-        """saves the token usage to a JSON file."""
-        with open(filepath, 'w') as f:
-            json.dump(self.__dict__, f, indent=4)
-
-    def reset(self) -> None:
-        """resets the token usage."""
-        self.input_tokens = 0
-        self.output_tokens = 0
-        self.total_tokens = 0
-        self.events_seen = 0
-
-
 class Agent:
-    def __init__(self, agent_config: DotDict):
+    def __init__(self, agent_config: DotDict,
+                 llm: Optional[BaseChatModel]=None,
+                 tier_llms: Optional[Sequence[BaseChatModel]]=None):
         self.config = agent_config
         self.tools = [getattr(local_tools, tool.name)
                       for tool in self.config.local_tools
                       if tool.enabled]
+        self.prompt_cache = getattr(self.config, "prompt_cache", None)
+        self.pricing = getattr(self.config, "pricing", None)
         self.system_prompt = self.set_system_prompt()
         print("System Prompt:", self.system_prompt)
-        self.llm = ChatOpenAI(**self.config.model.to_dict())
-        self.agent = self._build_agent()
-        self.token_usage = TokenUsage(self.config.model.name)
+        self.prefix_fingerprint = self.prompt_prefix_fingerprint()
+        # opt-in disk cache of model responses (None when disabled)
+        self.response_cache = build_response_cache(
+            getattr(self.config, "response_cache", None))
+        # client-side RPM/TPM budgets and retries for model calls (or None)
+        self.scheduler = build_scheduler(
+            getattr(self.config, "rate_limit", None),
+            output_tokens=getattr(self.config.model, "max_tokens", 0) or 0)
+        # an injected chat model (e.g. stub_models.StubChatModel) replaces
+        # the OpenAI client, which keeps the graph testable offline.
+        self.llm = llm or shared_chat_model(self._model_kwargs(), self.response_cache)
+        if self.response_cache is not None:
+            self.llm.cache = self.response_cache
+        # skills with independent subskills can run them as parallel
+        # branches (see fanout.py); chat sessions keep the ReAct graph
+        self.fanout_config = getattr(self.config, "fanout", None)
+        # runs end once the skill's artifacts are written, within output-token
+        # budgets (see completion.py)
+        self.completion_config = getattr(self.config, "completion", None)
+        self.agent = (self._build_fanout_agent() if self.fanout_enabled
+                      else self._build_agent(middleware=self._completion_middleware()))
+        # where json_writer / text_writer put the outputs (see output_sink.py)
+        self.output_sink = build_output_sink(
+            getattr(self.config, "output_sink", None))
+        # chat sessions get their own graph with persistent memory (lazy)
+        self.memory_config = getattr(self.config, "memory", None)
+        self._chat_agent = None
+        # token usage is recorded per LLM call by this handler into the
+        # ledger of the run that made the call (see usage.usage_scope).
+        self.usage_handler = UsageCallbackHandler(self.config.model.name)
+        # cheaper models tried first for per-patient runs (see cascade.py);
+        # tier_llms replace their clients like llm does for this agent
+        self.cascade_config = getattr(self.config, "cascade", None)
+        self.cascade = self._build_cascade(tier_llms) if self.cascade_enabled else None
 
-    def _build_agent(self) -> None:
+    def _build_agent(self, checkpointer: Optional[SqliteSaver]=None,
+                     middleware: Sequence=(),
+                     system_prompt: Optional[SystemMessage]=None,
+                     name: Optional[str]=None) -> None:
+        if self.scheduler is not None:
+            middleware = [RateLimitMiddleware(self.scheduler), *middleware]
         return create_agent(
-            name=self.config.agent_name,
+            name=name or self.config.agent_name,
             model=self.llm,
             tools=self.tools,
-            system_prompt=self.system_prompt,
+            system_prompt=system_prompt or self.system_prompt,
+            middleware=middleware,
+            checkpointer=checkpointer,
             debug=self.config.debug,
         )
 
-    def set_system_prompt(self) -> SystemMessage:
-        """Builds the system prompt for the agent."""
+    @property
+    def fanout_enabled(self) -> bool:
+        return bool(self.fanout_config and self.fanout_config.enabled
+                    and getattr(self.config, "skill_name", None) in self.fanout_config.skills)
+
+    @property
+    def completion_enabled(self) -> bool:
+        return bool(self.completion_config and self.completion_config.enabled)
+
+    def _completion_middleware(self) -> list:
+        if not self.completion_enabled:
+            return []
+        return [CompletionMiddleware(
+            required_artifacts(self.config.skill),
+            max_turn_output_tokens=getattr(self.completion_config, "max_turn_output_tokens", None),
+            max_patient_output_tokens=getattr(self.completion_config, "max_patient_output_tokens", None))]
+
+    @property
+    def cascade_enabled(self) -> bool:
+        return bool(self.cascade_config and self.cascade_config.enabled
+                    and getattr(self.config, "skill_name", None) in self.cascade_config.skills)
+
+    def _build_cascade(self, tier_llms: Optional[Sequence[BaseChatModel]]=None) -> Cascade:
+        """One agent per cascade tier, with the tier's model settings (and
+        pricing) over this agent's config; this agent is the last tier."""
+        tiers = []
+        for index, tier in enumerate(self.cascade_config.tiers):
+            tier = tier.to_dict()
+            tier_config = DotDict(self.config.to_dict())
+            if "pricing" in tier:
+                tier_config.pricing = DotDict(tier.pop("pricing"))
+            tier_config.model = DotDict({**self.config.model.to_dict(), **tier})
+            tier_config.cascade.enabled = False
+            tier_llm = tier_llms[index] if tier_llms else None
+            tiers.append((tier_config.model.name, Agent(tier_config, llm=tier_llm)))
+        tiers.append((self.config.model.name, self))
+        return Cascade(tiers, self.cascade_config)
+
+    def _build_fanout_agent(self):
+        """One ReAct agent per subskill, run as parallel branches of a
+        fan-out graph; the ReAct agent of the whole skill when it has fewer
+        than two subskills."""
+        branches = branch_skills(self.config.skill or "")
+        if not branches:
+            return self._build_agent(middleware=self._completion_middleware())
+        return build_fanout_graph(
+            {node_name: self._build_agent(middleware=[BranchDoneMiddleware(),
+                                                      *self._completion_middleware()],
+                                          system_prompt=self.set_system_prompt(skill),
+                                          name=node_name)
+             for node_name, skill in branches.items()},
+            name=self.config.agent_name)
+
+    @property
+    def memory_enabled(self) -> bool:
+        return bool(self.memory_config and self.memory_config.enabled)
+
+    def _get_chat_agent(self):
+        """The graph used by chat sessions: with a persistent checkpointer and
+        history compaction when memory is enabled, otherwise self.agent."""
+        if not self.memory_enabled:
+            return self.agent
+        if self._chat_agent is None:
+            summarizer = self.llm if self.memory_config.summarize else None
+            compaction = HistoryCompactionMiddleware(
+                max_history_tokens=self.memory_config.max_history_tokens,
+                keep_last_turns=self.memory_config.keep_last_turns,
+                max_tool_output_chars=self.memory_config.max_tool_output_chars,
+                summarizer=summarizer)
+            self._chat_agent = self._build_agent(
+                checkpointer=build_checkpointer(self.memory_config),
+                middleware=[compaction])
+        return self._chat_agent
+
+    def _model_kwargs(self) -> dict:
+        """Builds the ChatOpenAI arguments from the model config."""
+        model_kwargs = self.config.model.to_dict()
+        if self.prompt_layout == "static_prefix" and self.prompt_cache.use_cache_key:
+            # routes all requests sharing the static prefix to the same
+            # provider cache shard.
+            model_kwargs["model_kwargs"] = {
+                **model_kwargs.get("model_kwargs", {}),
+                "prompt_cache_key": f"{self.config.agent_name}-{self.prefix_fingerprint[:16]}"}
+        if self.scheduler is not None:
+            # retries are left to the scheduler (see rate_limit.py)
+            model_kwargs["max_retries"] = 0
+        return model_kwargs
+
+    @property
+    def prompt_layout(self) -> str:
+        """static_prefix keeps patient content out of the system prompt,
+        inline appends it to the system prompt."""
+        return self.prompt_cache.layout if self.prompt_cache else "inline"
+
+    @tracing.traced("agent")
+    def set_system_prompt(self, skill: Optional[str]=None) -> SystemMessage:
+        """Builds the system prompt for the agent (or for one fan-out branch
+        with its part of the skill)."""
         # the order is important for caching purposes:
         # 1. base system prompt, 2. skill, 3. content
         with open(self.config.system_prompt_file_path, "r") as f:
             system_prompt_text = f.read()
         
         system_prompt_parts = [system_prompt_text]
-        if self.config.skill:
-            skill_text = f"\n# Agent Specialty\n\n{self.config.skill}"
+        skill = skill or self.config.skill
+        if skill:
+            skill_text = f"\n# Agent Specialty\n\n{skill}"
             system_prompt_parts.append(skill_text)
-        if self.config.content:
+        if self.config.content and self.prompt_layout == "inline":
             content_text = f"\n# Patient Data\n\n{self.config.content}"
             system_prompt_parts.append(content_text)
         
         combined_prompt = "".join(system_prompt_parts)
         return SystemMessage(content=combined_prompt)
 
+    def prompt_prefix(self) -> str:
+        """The static part of every request: system prompt and tool schemas.
+
+        With the static_prefix layout this is byte-identical for every
+        patient of a batch, which is what provider prefix caching needs."""
+        tool_schemas = [convert_to_openai_tool(tool) for tool in self.tools]
+        return json.dumps(
+            {"system": self.system_prompt.content, "tools": tool_schemas},
+            sort_keys=True)
+
+    def prompt_prefix_fingerprint(self) -> str:
+        """sha256 of the static prompt prefix (changes when the prefix does)."""
+        return hashlib.sha256(self.prompt_prefix().encode("utf-8")).hexdigest()
+
     def _stream(self, content: str, session_id: str, stream_mode: str,
-                metadata: dict=None) -> Iterable[dict]:
-        """Streams the agent execution."""
+                metadata: dict=None, chat: bool=False,
+                include_content: bool=True) -> Iterable[dict]:
+        """Streams the agent execution (on the chat graph if chat is set)."""
+        inputs, runnable_config = self._prepare_inputs(
+            content, session_id, metadata, include_content)
+        graph = self._get_chat_agent() if chat else self.agent
+        # with the subgraph events, so the fan-out branches stream their turns
+        return graph.stream(
+            inputs, stream_mode=graph_stream_mode(stream_mode), config=runnable_config,
+            subgraphs=True)
+
+    def _astream(self, content: str, session_id: str, stream_mode: str,
+                 metadata: dict=None) -> AsyncIterable[dict]:
+        """Streams the agent execution asynchronously."""
+        inputs, runnable_config = self._prepare_inputs(
+            content, session_id, metadata)
+        return self.agent.astream(
+            inputs, stream_mode=graph_stream_mode(stream_mode), config=runnable_config,
+            subgraphs=True)
+
+    def _prepare_inputs(self, content: str, session_id: str,
+                        metadata: dict=None,
+                        include_content: bool=True) -> tuple[dict, dict]:
+        """Builds the graph inputs and the runnable config for a turn."""
         metadata = metadata or {}
         runnable_config = {
-            "configurable": {"thread_id": session_id, **metadata}}
+            "configurable": {"thread_id": session_id, **metadata},
+            "callbacks": [self.usage_handler, *tracing.callbacks()]}
+        if (include_content and self.config.content
+                and self.prompt_layout == "static_prefix"):
+            # patient content goes after the static prefix, in the user turn
+            content = f"{self.config.content}\n{content}"
         user_message = HumanMessage(content=content)
         inputs = {"messages": [user_message]}
-        return self.agent.stream(
-            inputs, stream_mode=stream_mode, config=runnable_config)
+        return inputs, runnable_config
     
+    def new_ledger(self, stream_mode: str="values",
+                   metadata: dict=None) -> UsageLedger:
+        """Creates an empty usage ledger for one run of this agent."""
+        metadata = metadata or {}
+        return UsageLedger(self.config.model.name, stream_mode,
+                           patient_id=metadata.get("patient_id"),
+                           skill=metadata.get("skill_name"),
+                           pricing=self.pricing,
+                           prefix_fingerprint=self.prefix_fingerprint)
+
+    @tracing.traced("agent")
     def stream_local(self, content: str, session_id: str,
                      stream_mode: str="values",
                      metadata: dict=None, chat: bool=False,
-                     first_response_file_path: Optional[str]=None) -> None:
-        """Streams the agent interaction locally."""
-        self.token_usage.stream_mode = stream_mode
-        stream = self._stream(
-            content, session_id, stream_mode=stream_mode, metadata=metadata)
-        response_values = self._print_stream(stream)
-        if first_response_file_path:
-            with open(first_response_file_path, 'w') as f:
-                f.write(response_values[-1])
-        while chat:
-            q = input("User: ")
-            if q == "exit":
-                return
+                     first_response_file_path: Optional[str]=None,
+                     ledger: Optional[UsageLedger]=None,
+                     sink: Optional[StreamSink]=None) -> UsageLedger:
+        """Streams the agent interaction locally and returns its usage ledger.
+
+        The run is rendered into sink (the terminal by default); use
+        stream_mode="tokens" to see the answer token by token.
+        With chat=True and memory enabled, the session is persisted under
+        session_id, so follow-up turns (and later sessions with the same id)
+        see the compacted earlier conversation."""
+        ledger = ledger or self.new_ledger(stream_mode, metadata)
+        sink = sink or TerminalSink()
+        trace = tracing.trace_scope((metadata or {}).get("patient_id"), session_id)
+        with usage_scope(ledger), sink_scope(self.output_sink), trace:
             stream = self._stream(
-                q, session_id, stream_mode=stream_mode, metadata=metadata)
-            self._print_stream(stream)
+                content, session_id, stream_mode=stream_mode, metadata=metadata,
+                chat=chat)
+            response_values = self._print_stream(
+                stream, StreamRenderer(sink, stream_mode, ledger,
+                                       collect=bool(first_response_file_path)))
+            if first_response_file_path:
+                with open(first_response_file_path, 'w') as f:
+                    f.write(response_values[-1])
+            while chat:
+                q = input("User: ")
+                if q == "exit":
+                    break
+                # with memory, the patient content is already in the history
+                stream = self._stream(
+                    q, session_id, stream_mode=stream_mode, metadata=metadata,
+                    chat=True, include_content=not self.memory_enabled)
+                self._print_stream(stream, StreamRenderer(sink, stream_mode, ledger))
+        return ledger
+
+    @tracing.traced("agent")
+    async def astream_local(self, content: str, session_id: str,
+                            stream_mode: str="values",
+                            metadata: dict=None,
+                            verbose: bool=True,
+                            ledger: Optional[UsageLedger]=None,
+                            sink: Optional[StreamSink]=None,
+                            output_sink: Optional[OutputSink]=None) -> UsageLedger:
+        """Streams one agent run asynchronously and returns its usage ledger.
+
+        The ledger is scoped to this run, so several runs can share one
+        compiled graph concurrently (one thread_id per run). Without a sink,
+        the run is rendered to the terminal if verbose and discarded
+        otherwise. output_sink replaces the agent's sink for the writer
+        tools of this run."""
+        ledger = ledger or self.new_ledger(stream_mode, metadata)
+        sink = sink or (TerminalSink() if verbose else NullSink())
+        renderer = StreamRenderer(sink, stream_mode, ledger)
+        trace = tracing.trace_scope((metadata or {}).get("patient_id"), session_id)
+        with usage_scope(ledger), sink_scope(output_sink or self.output_sink), trace:
+            stream = self._astream(
+                content, session_id, stream_mode=stream_mode, metadata=metadata)
+            async for response in stream:
+                renderer.handle(response)
+        renderer.close()
+        return ledger
 
-    def _print_stream(self, stream: Iterable[dict]) -> Sequence[str]:
-        """Prints the streamed responses."""
-        response_values = []
+    async def ainvoke_model(self, messages: list, ledger: UsageLedger,
+                            metadata: dict=None) -> AIMessage:
+        """One model call outside the agent graph (e.g. the long-note reduce
+        step). It goes through the same scheduler, response cache and usage
+        callbacks as the graph's model calls, and is recorded in ledger."""
+        runnable_config = {
+            "configurable": dict(metadata or {}),
+            "callbacks": [self.usage_handler, *tracing.callbacks()]}
+        call = lambda: self.llm.ainvoke(messages, config=runnable_config)
+        trace = tracing.trace_scope((metadata or {}).get("patient_id"))
+        with usage_scope(ledger), trace:
+            if self.scheduler is None:
+                return await call()
+            return await self.scheduler.acall(self.scheduler.estimate_tokens(messages), call)
+
+    def _print_stream(self, stream: Iterable,
+                      renderer: StreamRenderer) -> Sequence[str]:
+        """Renders the streamed responses; returns the collected messages."""
         for response in stream:
-            if response is None:
-                continue
-            
-            # update the number of events seen
-            self.token_usage.events_seen += 1
-            
-            # final_state = response
-            if len(response.get("messages", [])) > 0:
-                message = response["messages"][-1]
-                
-                # updatr token usage
-                self.token_usage.update_usage(message)
-                
-                # print message content
-                if isinstance(message, HumanMessage):
-                    print("\nHuman: ", end="", flush=True)
-                    response_values.append(message.content)
-                elif isinstance(message, AIMessage):
-                    print("\nAI: ", end="", flush=True)
-                    response_values.append(message.content)
-                elif isinstance(message, ToolMessage):
-                    tool_name = getattr(message, 'name', 'Unknown')
-                    print(f"\n[Tool: {tool_name}] ", end="", flush=True)
-                    response_values.append(f"[Tool: {tool_name}]")
-                
-                if isinstance(message.content, str):
-                    print(message.content, end="", flush=True)
-                elif isinstance(message.content, list):
-                    for item in message.content:
-                        if isinstance(item, dict) and "text" in item:
-                            print(item["text"], end="", flush=True)
-                        else:
-                            print(item, end="", flush=True)
-                elif isinstance(message.content, dict):
-                    if message.content.get("type") == "function_call":
-                        print(f"Function Call: {message.content.get('name')}", end="", flush=True)
-                        
-        print()  # New line after the response
-        return response_values
+            renderer.handle(response)
+        return renderer.close()
 
 
 def run_agent(agent: Agent, session_id: str,
               stream_mode: str="values",
               chat: bool=False,
-              user_query: str=None, metadata: dict=None) -> None:
+              user_query: str=None, metadata: dict=None,
+              sink: Optional[StreamSink]=None) -> UsageLedger:
     """Runs the agent with the given session ID and optional user query."""
     user_message = "start your analysis." if user_query is None else user_query
-    agent.stream_local(
+    if agent.cascade is not None and not chat:
+        return agent.cascade.run(agent, user_message, session_id, stream_mode,
+                                 metadata or {}, sink=sink)
+    return agent.stream_local(
         content=user_message,
         session_id=session_id,
         stream_mode=stream_mode,
         metadata=metadata,
         chat=chat,
-        first_response_file_path=None)
-    return agent.token_usage
+        first_response_file_path=None,
+        sink=sink)
+
+
+async def arun_agent(agent: Agent, session_id: str,
+                     stream_mode: str="values",
+                     user_query: str=None, metadata: dict=None,
+                     verbose: bool=False,
+                     sink: Optional[StreamSink]=None) -> UsageLedger:
+    """Runs the agent asynchronously for one session and returns its usage."""
+    user_message = "start your analysis." if user_query is None else user_query
+    if agent.cascade is not None:
+        return await agent.cascade.arun(agent, user_message, session_id, stream_mode,
+                                        metadata or {}, verbose=verbose, sink=sink)
+    return await agent.astream_local(
+        content=user_message,
+        session_id=session_id,
+        stream_mode=stream_mode,
+        metadata=metadata,
+        verbose=verbose,
+        sink=sink)
+
+
+# Compiled agents, chat model clients and skill texts are shared per process.
+# Agents are keyed by their whole config (skill, enabled tools, model config,
+# ...) plus the system prompt file version and the injected chat model, so an
+# identical prepare_agent call returns the already compiled graph. Chat
+# models are keyed by their arguments; their HTTP connection pools are the
+# process-wide httpx clients of langchain_openai (per base_url and timeout),
+# so all agents and skills reuse the same connections.
+_agent_pool: dict[str, Agent] = {}
+_chat_models: dict[str, BaseChatModel] = {}
+_skills: dict[tuple, str] = {}
+_pool_lock = threading.RLock()
+
+
+def _file_version(filepath: str) -> int:
+    try:
+        return os.stat(filepath).st_mtime_ns
+    except (OSError, TypeError):
+        return 0
+
+
+def shared_chat_model(model_kwargs: dict, response_cache=None) -> BaseChatModel:
+    """Returns the ChatOpenAI client for these arguments, creating it once.
+    langchain_openai (and openai) are imported on first use."""
+    key = json.dumps(model_kwargs, sort_keys=True, default=str)
+    key += f"|cache={getattr(response_cache, 'path', None)}"
+    with _pool_lock:
+        if key not in _chat_models:
+            from langchain_openai import ChatOpenAI
+            _chat_models[key] = ChatOpenAI(**model_kwargs)
+        return _chat_models[key]
+
+
+def agent_pool_key(agent_config: DotDict, llm: Optional[BaseChatModel]=None,
+                   tier_llms: Optional[Sequence[BaseChatModel]]=None) -> str:
+    """identifies a compiled agent: the config and what it points to."""
+    key = json.dumps(agent_config.to_dict(), sort_keys=True, default=str)
+    key += f"|prompt={_file_version(agent_config.system_prompt_file_path)}"
+    if llm is not None:
+        key += f"|llm={id(llm)}"
+    if tier_llms:
+        key += f"|tiers={[id(tier_llm) for tier_llm in tier_llms]}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
 
 
 def prepare_agent(skill_name: str, skill_path: str,
                   agent_config: DotDict,
-                  data_xml: str=None) -> Agent:
-    """prepares the agent with the given skill and data."""
+                  data_xml: str=None,
+                  llm: Optional[BaseChatModel]=None,
+                  reuse: bool=True,
+                  tier_llms: Optional[Sequence[BaseChatModel]]=None) -> Agent:
+    """prepares the agent with the given skill and data.
+
+    With reuse, an agent already compiled for the same skill, config and
+    chat model is returned instead of building a new one; its cascade
+    counters start over, as every batch prepares its agent."""
+    agent_config.skill_name = skill_name
     agent_config.skill = load_skill(skill_name, skill_path)
     agent_config.content = data_xml
-    return Agent(agent_config)
+    if not reuse:
+        return Agent(agent_config, llm=llm, tier_llms=tier_llms)
+    key = agent_pool_key(agent_config, llm, tier_llms)
+    with _pool_lock:
+        if key not in _agent_pool:
+            _agent_pool[key] = Agent(agent_config, llm=llm, tier_llms=tier_llms)
+        agent = _agent_pool[key]
+    if agent.cascade is not None:
+        agent.cascade.reset()
+    return agent
 
 
 def load_skill(skill_name: str, skill_path: str) -> str:
-    """Loads the skill from the skill file."""
+    """Loads the skill from the skill file (cached until the file changes)."""
     skill_filepath = os.path.join(skill_path, f"{skill_name}.md")
-    with open(skill_filepath, 'r') as f:
-        skill = f.read()
-    return skill
+    key = (os.path.abspath(skill_filepath), _file_version(skill_filepath))
+    if key not in _skills:
+        with open(skill_filepath, 'r') as f:
+            _skills[key] = f.read()
+    return _skills[key]
 
 
 if __name__ == "__main__":
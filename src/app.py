@@ -1,11 +1,23 @@
 
 import os
-import json
 import time
+import asyncio
+from typing import Optional
 
+from langchain_core.language_models import BaseChatModel
+
+import batch_api
+import grounding
+import judge_packing
 import local_tools
+import long_notes
 import agents
+import note_dedup
+import run_manifest
+import tracing
 import utils
+from output_sink import OutputSink, get_output_sink
+from usage import BatchUsage, TokenUsage, UsageLedger, prompt_cache_report
 from utils import ConfigLoader
 
 
@@ -15,84 +27,637 @@ OUTPUT_BASE_PATH = "/Users/ebadahmadzadeh/ms-code-projects/ethermed/langgraph_ag
 SKILL_PATH = "/Users/ebadahmadzadeh/ms-code-projects/ethermed/langgraph_agent_app/skills"
 
 
-def run_skill(skill_name: str, patient_id_list: list[int], chat: bool=False) -> None:
-    """Runs the specified skill for the given patient ID."""
+def run_skill(skill_name: str, patient_id_list: list[int], chat: bool=False,
+              batch_mode: Optional[str]=None,
+              batch_results_path: Optional[str]=None,
+              stream_mode: str="values") -> Optional[str]:
+    """Runs the specified skill for the given patient ID.
+
+    stream_mode="tokens" renders the answers token by token.
+
+    With batch_mode="export" the patients' first requests are written to a
+    Batch API input file instead; batch_mode="ingest" applies the result
+    file at batch_results_path (see run_skill_batch_api). Both return the
+    request file of the next round, if any."""
+    assert skill_name in ["clinical_insights_skill", "clinical_judge_skill"], \
+        f"Unsupported skill name: {skill_name}"
+    if batch_mode is not None:
+        return run_skill_batch_api(skill_name, patient_id_list, batch_mode,
+                                   batch_results_path)
+    agent_config = ConfigLoader(AGENT_CONFIG_PATH).dotdict
+    # opt-in latency spans and sampling profile of the run (see tracing.py)
+    with tracing.trace_run(getattr(agent_config, "tracing", None), skill_name, OUTPUT_BASE_PATH):
+        agent = agents.prepare_agent(
+            skill_name, SKILL_PATH, agent_config, data_xml=None)
+        # patients whose inputs and outputs are unchanged are skipped
+        cohort = patient_id_list
+        plan = plan_cohort(agent, skill_name, patient_id_list)
+        if plan is not None:
+            patient_id_list = plan.to_run
+            if not patient_id_list:
+                return None
+        if skill_name == "clinical_judge_skill":
+            patient_id_list = gate_judge_patients(agent, patient_id_list, plan)
+            if not patient_id_list:
+                return None
+        # patients whose note duplicates another one's can reuse its outputs
+        dedup = None if chat else plan_note_dedup(agent, skill_name, cohort, patient_id_list)
+        if dedup is not None:
+            patient_id_list = dedup.to_run
+        packing = getattr(agent_config, "judge_packing", None)
+        if skill_name == "clinical_judge_skill" and packing and packing.enabled and not chat:
+            pending = patient_id_list
+            while pending:
+                run_packed_judge(agent, pending)
+                if plan is not None:
+                    for patient_id in pending:
+                        run_manifest.record_patient(plan, patient_id, agent.output_sink, OUTPUT_BASE_PATH)
+                # as below: duplicates reuse the outputs of their representative
+                pending, dedup = (reuse_note_duplicates(agent, dedup, plan)
+                                  if dedup is not None else []), None
+            return None
+
+        total_latency_s = 0.0
+        batch_usage = BatchUsage(agent_config.model.name)
+
+        pending, num_patients = patient_id_list, 0
+        while True:
+            for patient_id in pending:
+                metadata = {"patient_id": patient_id, "skill_name": skill_name,
+                            "output_base_path": OUTPUT_BASE_PATH}
+                session_id = f"patient_{int(patient_id):04d}_{skill_name}_session"
+                try:
+                    with tracing.trace_scope(patient_id, session_id), tracing.span("patient", "patient"):
+                        documents_xml = build_documents_xml(
+                            skill_name, patient_id, sink=agent.output_sink)
+                        p_start = time.perf_counter()
+                        long_note_data = load_long_note(agent, skill_name, patient_id)
+                        if long_note_data is not None and not chat:
+                            ledger = asyncio.run(long_notes.arun_long_note(
+                                agent, long_note_data, metadata, agent_config.long_notes))
+                        else:
+                            ledger = agents.run_agent(agent, session_id, stream_mode=stream_mode,
+                                                      chat=chat, user_query=documents_xml,
+                                                      metadata=metadata)
+                except BaseException as error:
+                    if plan is not None:
+                        run_manifest.record_patient(
+                            plan, patient_id, agent.output_sink, OUTPUT_BASE_PATH, error=error)
+                    raise
+
+                # measure runtime and token usage:
+                p_duration = round(time.perf_counter() - p_start, 2)
+                total_latency_s += p_duration
+                batch_usage.add(ledger)
+
+                # save token usage per patient:
+                token_usage_filepath = os.path.join(
+                    OUTPUT_BASE_PATH, f"pid{patient_id:04d}_{skill_name}_token_usage.json")
+                ledger.save(token_usage_filepath)
+                if plan is not None:
+                    run_manifest.record_patient(plan, patient_id, agent.output_sink, OUTPUT_BASE_PATH,
+                                                ledger.usage, p_duration)
+            num_patients += len(pending)
+            if dedup is None:
+                break
+            # the representatives have run: duplicates reuse their adapted
+            # outputs, the ones that cannot be adapted run after all
+            pending, dedup = reuse_note_duplicates(agent, dedup, plan), None
+
+        agent.output_sink.flush()
+        print_overall_stats(skill_name, num_patients, total_latency_s,
+                            batch_usage.total(), agent, batch_usage.stream_report(),
+                            batch_usage.completion_report(num_patients),
+                            batch_usage.cache_report())
+
+
+def dry_run_skill(skill_name: str, patient_id_list: list[int]) -> Optional[dict]:
+    """Reports what run_skill would do for the cohort (see run_manifest.py):
+    the patients to run, why, and the estimated tokens; nothing is run."""
+    agent_config = ConfigLoader(AGENT_CONFIG_PATH).dotdict
+    agent = agents.prepare_agent(skill_name, SKILL_PATH, agent_config, data_xml=None)
+    plan = plan_cohort(agent, skill_name, patient_id_list)
+    return None if plan is None else plan.report(len(agent.prompt_prefix()) // 4)
+
+
+def plan_cohort(agent: agents.Agent, skill_name: str,
+                patient_id_list: list[int]) -> Optional[run_manifest.RunPlan]:
+    """Compares the patients' input hashes and outputs with the run
+    manifest and prints the plan; None when the manifest is disabled."""
+    manifest = run_manifest.build_run_manifest(getattr(agent.config, "run_manifest", None))
+    if manifest is None:
+        return None
+    plan = run_manifest.plan_run(
+        manifest, agent, skill_name, patient_id_list, load_patient,
+        agent.output_sink, OUTPUT_BASE_PATH)
+    report = plan.report(len(agent.prompt_prefix()) // 4)
+    estimated = report["estimated"]
+    output_tokens = "unknown" if estimated["output_tokens"] is None else estimated["output_tokens"]
+    print(f"Run Manifest: {report['to_run']} of {report['patients']} patients to run "
+          f"({report['skipped']} unchanged skipped, {report['reasons']}), estimated "
+          f"{estimated['input_tokens']} input / {output_tokens} output tokens "
+          f"in {estimated['llm_calls']} calls (from {estimated['method']})")
+    return plan
+
+
+def plan_note_dedup(agent: agents.Agent, skill_name: str, cohort: list[int],
+                    patient_id_list: list[int]) -> Optional[note_dedup.DedupPlan]:
+    """Finds the patients to run whose note duplicates the note of another
+    patient of the cohort (see note_dedup.py) and prints the groups; None
+    when note_dedup is disabled for the skill."""
+    settings = getattr(agent.config, "note_dedup", None)
+    if not (settings and settings.enabled and skill_name in settings.skills):
+        return None
+    dedup = note_dedup.plan_duplicates(settings, skill_name, cohort, patient_id_list, load_patient)
+    report = dedup.report()
+    print(f"Note Dedup: {report['duplicates']} of {len(patient_id_list)} patients to run duplicate "
+          f"the note of {report['groups']} others ({report['exact']} exact, similarity >= "
+          f"{settings.similarity}), {report['indexed']} notes indexed in {report['index_s']:.3f}s"
+          f"{', outputs are reused' if report['reuse'] else ''}")
+    return dedup
+
+
+def reuse_note_duplicates(agent: agents.Agent, dedup: note_dedup.DedupPlan,
+                          plan: Optional[run_manifest.RunPlan]) -> list[int]:
+    """Writes the adapted outputs of their representative for the
+    duplicates of dedup (recorded in the run manifest of plan, if given);
+    returns the duplicates that have to run after all."""
+    fallback = note_dedup.reuse_duplicates(dedup, agent.output_sink, OUTPUT_BASE_PATH, load_patient)
+    if plan is not None:
+        for patient_id in dedup.reused:
+            run_manifest.record_patient(plan, patient_id, agent.output_sink, OUTPUT_BASE_PATH)
+    if dedup.report()["reuse"]:
+        print(f"Note Dedup: {len(dedup.reused)} LLM runs avoided, {len(fallback)} duplicates "
+              f"run after all {dict(dedup.fallbacks)}")
+    return fallback
+
+
+def load_patient(patient_id: int) -> dict:
+    """the patient's note (without line numbers), question and answer."""
+    return local_tools.load_patient_data(
+        patient_id, base_path=PATIENT_DATA_BASE_PATH, line_numbers=False)
+
+
+def run_packed_judge(agent: agents.Agent, patient_id_list: list[int]) -> None:
+    """Runs the clinical_judge_skill with several patients per request (see
+    judge_packing.py). Token usage is saved per patient (pid####), with each
+    pack's usage split between its patients; the batch stats count the
+    requests as they ran."""
+    skill_name = "clinical_judge_skill"
+    metadata = {"skill_name": skill_name, "output_base_path": OUTPUT_BASE_PATH}
+    documents = [(patient_id, build_documents_xml(
+                      skill_name, patient_id, sink=agent.output_sink))
+                 for patient_id in patient_id_list]
+    start = time.perf_counter()
+    ledgers, patient_ledgers = asyncio.run(judge_packing.arun_packed_judge(
+        agent, documents, metadata, agent.config.judge_packing))
+    total_latency_s = time.perf_counter() - start
+    agent.output_sink.flush()
+
+    batch_usage = BatchUsage(agent.config.model.name)
+    for ledger in ledgers.values():
+        batch_usage.add(ledger)
+    for patient_id, ledger in patient_ledgers.items():
+        ledger.save(os.path.join(
+            OUTPUT_BASE_PATH, f"pid{patient_id:04d}_{skill_name}_token_usage.json"))
+    print_overall_stats(skill_name, len(patient_id_list), total_latency_s,
+                        batch_usage.total(), agent, batch_usage.stream_report(),
+                        batch_usage.completion_report(len(patient_id_list)),
+                        batch_usage.cache_report())
+    print(f"Judge Requests: {len(ledgers)} for {len(patient_id_list)} patients")
+
+
+def run_skill_batch_api(skill_name: str, patient_id_list: list[int],
+                        batch_mode: str, batch_results_path: Optional[str]=None,
+                        llm: Optional[BaseChatModel]=None) -> Optional[str]:
+    """Runs a skill in offline Batch API rounds (see batch_api.py).
+
+    export: writes the first requests of the patients and returns the file
+    to submit. ingest: applies a result file (tool calls are executed
+    locally) and returns the requests of the next round, or None once all
+    patients are done, after saving the token usage files and printing the
+    overall stats. Long notes are not supported (run them with run_skill)."""
+    assert batch_mode in ["export", "ingest"], f"Unsupported batch mode: {batch_mode}"
+    agent_config = ConfigLoader(AGENT_CONFIG_PATH).dotdict
+    agent = agents.prepare_agent(
+        skill_name, SKILL_PATH, agent_config, data_xml=None, llm=llm)
+    settings = agent_config.batch_api
+    batch_run = batch_api.BatchRun(
+        agent, os.path.join(settings.path, skill_name), max_rounds=settings.max_rounds,
+        max_attempts=settings.max_attempts, resume=batch_mode == "ingest")
+
+    if batch_mode == "export":
+        if skill_name == "clinical_judge_skill":
+            patient_id_list = gate_judge_patients(agent, patient_id_list)
+        for patient_id in patient_id_list:
+            if load_long_note(agent, skill_name, patient_id) is not None:
+                print(f"[{skill_name}] patient {patient_id} skipped: long note")
+                continue
+            metadata = {"patient_id": patient_id, "skill_name": skill_name,
+                        "output_base_path": OUTPUT_BASE_PATH}
+            batch_run.add_patient(
+                patient_id, f"patient_{int(patient_id):04d}_{skill_name}_session",
+                build_documents_xml(skill_name, patient_id, sink=agent.output_sink), metadata)
+        requests_path = batch_run.export_round()
+        print(f"[{skill_name}] batch requests for {len(batch_run.pending())} "
+              f"patient(s) written to {requests_path}")
+        return requests_path
+
+    assert batch_results_path, "batch_results_path is required to ingest"
+    counts = batch_run.ingest(batch_results_path)
+    agent.output_sink.flush()
+    requests_path = batch_run.export_round()
+    print(f"[{skill_name}] batch round {batch_run.state['round'] - 1} ingested: {counts['done']} done, "
+          f"{counts['pending']} pending, {counts['failed']} failed")
+    if requests_path is not None:
+        print(f"[{skill_name}] next batch requests written to {requests_path}")
+        return requests_path
+
+    batch_usage = BatchUsage(agent_config.model.name)
+    for patient_id, ledger in batch_run.ledgers().items():
+        batch_usage.add(ledger)
+        ledger.save(os.path.join(
+            OUTPUT_BASE_PATH, f"pid{patient_id:04d}_{skill_name}_token_usage.json"))
+    usage = batch_usage.total()
+    print_overall_stats(skill_name, len(batch_usage.ledgers), batch_run.elapsed_s,
+                        usage, agent)
+    if agent.pricing is not None:
+        report = prompt_cache_report(usage, agent.pricing)
+        live_cost = report["effective_input_cost_usd"] + report["output_cost_usd"]
+        print(f"Batch Cost (USD): {live_cost * settings.price_factor:.4f} "
+              f"(live {live_cost:.4f}, price factor {settings.price_factor})")
+    return None
+
+
+def run_skill_local_batch(skill_name: str, patient_id_list: list[int],
+                          llm: BaseChatModel) -> None:
+    """Runs all batch rounds of a skill against batch_api.LocalBatchEndpoint
+    (e.g. with a stub chat model), to exercise export / ingest offline."""
+    endpoint = batch_api.LocalBatchEndpoint(llm)
+    requests_path = run_skill_batch_api(skill_name, patient_id_list, "export", llm=llm)
+    while requests_path is not None:
+        requests_path = run_skill_batch_api(
+            skill_name, patient_id_list, "ingest", endpoint.run(requests_path), llm=llm)
+
+
+def run_skill_batch(skill_name: str, patient_id_list: list[int],
+                    max_concurrency: int=4,
+                    stream_mode: str="updates",
+                    llm: Optional[BaseChatModel]=None) -> None:
+    """Runs the specified skill for a cohort with up to max_concurrency
+    patients in flight (see arun_skill_batch)."""
+    settings = getattr(ConfigLoader(AGENT_CONFIG_PATH).dotdict, "tracing", None)
+    with tracing.trace_run(settings, f"{skill_name}_batch", OUTPUT_BASE_PATH):
+        asyncio.run(arun_skill_batch(
+            skill_name, patient_id_list, max_concurrency=max_concurrency,
+            stream_mode=stream_mode, llm=llm))
+
+
+async def arun_skill_batch(skill_name: str, patient_id_list: list[int],
+                           max_concurrency: int=4,
+                           stream_mode: str="updates",
+                           llm: Optional[BaseChatModel]=None) -> None:
+    """Runs the specified skill concurrently for the given patient IDs.
+
+    One compiled agent is shared by all patients; each patient gets its own
+    thread_id and token usage. Per-patient token usage files and the overall
+    stats match run_skill. An optional chat model (e.g. a stub) can be
+    injected in place of the configured OpenAI model."""
     assert skill_name in ["clinical_insights_skill", "clinical_judge_skill"], \
         f"Unsupported skill name: {skill_name}"
+    assert max_concurrency >= 1, "max_concurrency must be at least 1"
     agent_config = ConfigLoader(AGENT_CONFIG_PATH).dotdict
     agent = agents.prepare_agent(
-        skill_name, SKILL_PATH, agent_config, data_xml=None)
-    
-    total_latency_s = 0.0
-    total_input_tokens = 0
-    total_output_tokens = 0
-    total_tokens = 0
-
-    for patient_id in patient_id_list:
-        metadata = {"patient_id": patient_id, "output_base_path": OUTPUT_BASE_PATH}
-        session_id = f"patient_{int(patient_id):04d}_{skill_name}_session"
-        patient_data = local_tools.load_patient_data(
-            patient_id, base_path=PATIENT_DATA_BASE_PATH, line_numbers=True)
-        
-        documents_dict, documents_xml = None, None
-        if skill_name == "clinical_insights_skill":
-            documents_dict = {
-                "patient_id": patient_data["patient_id"],
-                "notes": patient_data["note"],
-                "questions": patient_data["question"],
-            }
+        skill_name, SKILL_PATH, agent_config, data_xml=None, llm=llm)
+    cohort = patient_id_list
+    plan = plan_cohort(agent, skill_name, patient_id_list)
+    if plan is not None:
+        patient_id_list = plan.to_run
+        if not patient_id_list:
+            return
+    if skill_name == "clinical_judge_skill":
+        patient_id_list = gate_judge_patients(agent, patient_id_list, plan)
+        if not patient_id_list:
+            return
+    dedup = plan_note_dedup(agent, skill_name, cohort, patient_id_list)
+    if dedup is not None:
+        patient_id_list = dedup.to_run
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run_patient(patient_id: int) -> tuple[float, UsageLedger]:
+        async with semaphore:
+            documents_xml = build_documents_xml(skill_name, patient_id, sink=agent.output_sink)
+            return await arun_patient(
+                agent, skill_name, patient_id, documents_xml, stream_mode, plan)
+
+    batch_start = time.perf_counter()
+    results = await asyncio.gather(
+        *(run_patient(patient_id) for patient_id in patient_id_list))
+    if dedup is not None:
+        # the representatives have run: duplicates reuse their adapted
+        # outputs, the ones that cannot be adapted run after all
+        fallback = reuse_note_duplicates(agent, dedup, plan)
+        results += await asyncio.gather(*(run_patient(patient_id) for patient_id in fallback))
+    agent.output_sink.flush()
+    wall_clock_s = time.perf_counter() - batch_start
+
+    batch_usage = BatchUsage(agent_config.model.name)
+    for _, ledger in results:
+        batch_usage.add(ledger)
+    print_overall_stats(
+        skill_name, len(results),
+        sum(duration for duration, _ in results), batch_usage.total(), agent,
+        batch_usage.stream_report(), batch_usage.completion_report(len(results)),
+        batch_usage.cache_report())
+    print(f"Batch Wall-Clock (s): {wall_clock_s:.2f} (max concurrency: {max_concurrency})")
+
+
+async def arun_patient(agent: agents.Agent, skill_name: str, patient_id: int,
+                       documents_xml: str,
+                       stream_mode: str="updates",
+                       plan: Optional[run_manifest.RunPlan]=None) -> tuple[float, UsageLedger]:
+    """Runs one patient through a skill and saves its token usage file
+    (and records the outcome in the run manifest of plan, if given)."""
+    metadata = {"patient_id": patient_id, "skill_name": skill_name,
+                "output_base_path": OUTPUT_BASE_PATH}
+    session_id = f"patient_{int(patient_id):04d}_{skill_name}_session"
+    p_start = time.perf_counter()
+    try:
+        with tracing.trace_scope(patient_id, session_id), tracing.span("patient", "patient"):
+            long_note_data = load_long_note(agent, skill_name, patient_id)
+            if long_note_data is not None:
+                ledger = await long_notes.arun_long_note(
+                    agent, long_note_data, metadata, agent.config.long_notes, stream_mode)
+            else:
+                ledger = await agents.arun_agent(
+                    agent, session_id, stream_mode=stream_mode,
+                    user_query=documents_xml, metadata=metadata)
+    except BaseException as error:
+        if plan is not None:
+            run_manifest.record_patient(
+                plan, patient_id, agent.output_sink, OUTPUT_BASE_PATH, error=error)
+        raise
+    p_duration = round(time.perf_counter() - p_start, 2)
+    ledger.save(os.path.join(
+        OUTPUT_BASE_PATH, f"pid{patient_id:04d}_{skill_name}_token_usage.json"))
+    if plan is not None:
+        run_manifest.record_patient(plan, patient_id, agent.output_sink, OUTPUT_BASE_PATH,
+                                    ledger.usage, p_duration)
+    cache_report = prompt_cache_report(ledger.usage)
+    print(f"[{skill_name}] patient {patient_id} done in {p_duration:.2f}s "
+          f"(prompt cache hit ratio {cache_report['cache_hit_ratio']:.2%})")
+    return p_duration, ledger
+
+
+def gate_judge_patients(agent: agents.Agent, patient_id_list: list[int],
+                        plan: Optional[run_manifest.RunPlan]=None) -> list[int]:
+    """Runs the grounding check of the insights outputs (see grounding.py)
+    and returns the patients that still need the LLM judge; the others are
+    recorded as done in the run manifest of plan, if given."""
+    settings = getattr(agent.config, "grounding_check", None)
+    if not (settings and settings.enabled):
+        return patient_id_list
+    start = time.perf_counter()
+    reports = grounding.check_patients(
+        patient_id_list, agent.output_sink, OUTPUT_BASE_PATH, PATIENT_DATA_BASE_PATH,
+        min_overlap=settings.min_overlap)
+    grounding.write_reports(reports, agent.output_sink, OUTPUT_BASE_PATH)
+    selected = grounding.select_for_judge(reports, settings.risk_threshold)
+    if plan is not None:
+        for patient_id in set(patient_id_list) - set(selected):
+            run_manifest.record_cleared(plan, patient_id, agent.output_sink, OUTPUT_BASE_PATH,
+                                        [grounding.report_filename(patient_id)])
+    summary = grounding.grounding_summary(reports)
+    print(f"Grounding Check: {len(selected)} of {len(patient_id_list)} patients sent to the "
+          f"judge (risk >= {settings.risk_threshold}) in {time.perf_counter() - start:.3f}s, "
+          f"mean risk {summary['mean_risk']:.2f}, issues {summary['issues']}")
+    return selected
+
+
+def load_long_note(agent: agents.Agent, skill_name: str,
+                   patient_id: int) -> Optional[dict]:
+    """Returns the patient data when the insights skill should process the
+    patient's note with map-reduce (see long_notes.py), otherwise None."""
+    settings = getattr(agent.config, "long_notes", None)
+    if skill_name != "clinical_insights_skill" or not (settings and settings.enabled):
+        return None
+    patient_data = local_tools.load_patient_data(
+        patient_id, base_path=PATIENT_DATA_BASE_PATH, line_numbers=True)
+    return patient_data if long_notes.is_long_note(patient_data["note"], settings) else None
+
+
+def run_pipeline(patient_id_list: list[int], insights_concurrency: int=4,
+                 judge_concurrency: int=4,
+                 insights_llm: Optional[BaseChatModel]=None,
+                 judge_llm: Optional[BaseChatModel]=None) -> None:
+    """Runs insights and judge as a per-patient pipeline (see arun_pipeline)."""
+    asyncio.run(arun_pipeline(
+        patient_id_list, insights_concurrency=insights_concurrency,
+        judge_concurrency=judge_concurrency,
+        insights_llm=insights_llm, judge_llm=judge_llm))
+
+
+async def arun_pipeline(patient_id_list: list[int], insights_concurrency: int=4,
+                        judge_concurrency: int=4,
+                        insights_llm: Optional[BaseChatModel]=None,
+                        judge_llm: Optional[BaseChatModel]=None) -> None:
+    """Runs clinical_insights_skill then clinical_judge_skill per patient.
+
+    Each stage has its own concurrency limit. A patient is judged as soon as
+    its own insights are written, while other patients are still in the
+    insights stage, so cohort latency approaches max(stage) instead of
+    sum(stage). The insights outputs are handed to the judge in memory (as
+    captured from the writer tools) instead of being re-read from disk."""
+    insights_name, judge_name = "clinical_insights_skill", "clinical_judge_skill"
+    insights_agent = agents.prepare_agent(
+        insights_name, SKILL_PATH, ConfigLoader(AGENT_CONFIG_PATH).dotdict,
+        data_xml=None, llm=insights_llm)
+    judge_agent = agents.prepare_agent(
+        judge_name, SKILL_PATH, ConfigLoader(AGENT_CONFIG_PATH).dotdict,
+        data_xml=None, llm=judge_llm)
+    grounding_settings = getattr(judge_agent.config, "grounding_check", None)
+    insights_semaphore = asyncio.Semaphore(insights_concurrency)
+    judge_semaphore = asyncio.Semaphore(judge_concurrency)
+    stage_results = {insights_name: [], judge_name: []}
+
+    async def run_patient(patient_id: int) -> None:
+        async with insights_semaphore:
+            with local_tools.capture_artifacts() as artifacts:
+                stage_results[insights_name].append(await arun_patient(
+                    insights_agent, insights_name, patient_id,
+                    build_documents_xml(insights_name, patient_id)))
+
+        insights = {
+            "treatment_recommendation": artifacts.get(
+                f"pid{patient_id:04d}_treatment_recommendation.json"),
+            "clinical_summary": artifacts.get(
+                f"pid{patient_id:04d}_clinical_summary.json"),
+        }
+        if None in insights.values():
+            print(f"[{judge_name}] patient {patient_id} skipped: "
+                  f"insights outputs missing ({sorted(artifacts)})")
+            return
+        if grounding_settings and grounding_settings.enabled:
+            note = local_tools.load_patient_data(
+                patient_id, base_path=PATIENT_DATA_BASE_PATH, line_numbers=False)["note"]
+            report = grounding.check_patient(note, insights, grounding_settings.min_overlap)
+            grounding.write_reports({patient_id: report}, judge_agent.output_sink, OUTPUT_BASE_PATH)
+            if report["risk"] < grounding_settings.risk_threshold:
+                print(f"[{judge_name}] patient {patient_id} skipped: "
+                      f"grounding risk {report['risk']:.2f}")
+                return
+        async with judge_semaphore:
+            stage_results[judge_name].append(await arun_patient(
+                judge_agent, judge_name, patient_id,
+                build_documents_xml(judge_name, patient_id, insights=insights)))
+
+    pipeline_start = time.perf_counter()
+    await asyncio.gather(*(run_patient(patient_id) for patient_id in patient_id_list))
+    judge_agent.output_sink.flush()
+    wall_clock_s = time.perf_counter() - pipeline_start
+
+    for skill_name, agent in ((insights_name, insights_agent), (judge_name, judge_agent)):
+        results = stage_results[skill_name]
+        if not results:
+            continue
+        batch_usage = BatchUsage(agent.config.model.name)
+        for _, ledger in results:
+            batch_usage.add(ledger)
+        print_overall_stats(
+            skill_name, len(results),
+            sum(duration for duration, _ in results), batch_usage.total(), agent,
+            batch_usage.stream_report(), batch_usage.completion_report(len(results)),
+            batch_usage.cache_report())
+    print(f"Pipeline Wall-Clock (s): {wall_clock_s:.2f} "
+          f"(insights concurrency: {insights_concurrency}, judge concurrency: {judge_concurrency})")
+
+
+@tracing.traced("xml")
+def build_documents_xml(skill_name: str, patient_id: int,
+                        insights: Optional[dict]=None,
+                        sink: Optional[OutputSink]=None) -> str:
+    """Builds the <documents> user message for a patient and skill.
+
+    For the judge, the insights outputs are read from the output sink unless
+    they are passed in memory as {"treatment_recommendation": ...,
+    "clinical_summary": ...}."""
+    patient_data = local_tools.load_patient_data(
+        patient_id, base_path=PATIENT_DATA_BASE_PATH, line_numbers=True)
+
+    documents_dict = None
+    if skill_name == "clinical_insights_skill":
+        documents_dict = {
+            "patient_id": patient_data["patient_id"],
+            "notes": patient_data["note"],
+            "questions": patient_data["question"],
+        }
+    else:
+        if insights is not None:
+            treatment_plan_response = insights["treatment_recommendation"]
+            summarization_response = insights["clinical_summary"]
         else:
-            treatment_plan_response = json.load(
-                open(os.path.join(
-                    OUTPUT_BASE_PATH,
-                    f"pid{patient_id:04d}_treatment_recommendation.json")))
-            summarization_response = json.load(
-                open(os.path.join(
-                    OUTPUT_BASE_PATH,
-                    f"pid{patient_id:04d}_clinical_summary.json")))
-            documents_dict = {
-                "patient_id": patient_id,
-                "notes": patient_data["note"],
-                "treatment_plan_query": "Extract the treatment plan from the patient data.",
-                "treatment_plan_response": treatment_plan_response.get("recommended_treatment", ""),
-                "summarization_query": patient_data["question"],
-                "summarization_ground_truth": patient_data["answer"],
-                "summarization_response": summarization_response.get("summary", "")
-            }
-            
-        documents_xml = local_tools.create_xml_document(
-                documents_dict, root_tag="documents")
-        p_start = time.perf_counter()
-        token_usage = agents.run_agent(agent, session_id, stream_mode="values",
-                                       chat=chat, user_query=documents_xml,
-                                       metadata=metadata)
-
-        # measure runtime and token usage:
-        p_duration = round(time.perf_counter() - p_start, 2)
-        total_latency_s += p_duration
-        total_input_tokens += token_usage.input_tokens
-        total_output_tokens += token_usage.output_tokens
-        total_tokens += token_usage.total_tokens
-        
-        # save token usage per patient:
-        token_usage_filepath = os.path.join(
-            OUTPUT_BASE_PATH, f"pid{patient_id:04d}_{skill_name}_token_usage.json")
-        token_usage.save(token_usage_filepath)
-        # reset the token usage for the next patient:
-        agent.token_usage.reset()
-
-    # print overall stats:
+            sink = sink or get_output_sink()
+            treatment_plan_response = sink.read(
+                OUTPUT_BASE_PATH, f"pid{patient_id:04d}_treatment_recommendation.json")
+            summarization_response = sink.read(
+                OUTPUT_BASE_PATH, f"pid{patient_id:04d}_clinical_summary.json")
+        documents_dict = {
+            "patient_id": patient_id,
+            "notes": patient_data["note"],
+            "treatment_plan_query": "Extract the treatment plan from the patient data.",
+            "treatment_plan_response": treatment_plan_response.get("recommended_treatment", ""),
+            "summarization_query": patient_data["question"],
+            "summarization_ground_truth": patient_data["answer"],
+            "summarization_response": summarization_response.get("summary", "")
+        }
+
+    return local_tools.create_xml_document(
+        documents_dict, root_tag="documents")
+
+
+def print_overall_stats(skill_name: str, num_patients: int,
+                        total_latency_s: float, usage: TokenUsage,
+                        agent: agents.Agent,
+                        stream_report: Optional[dict]=None,
+                        completion_report: Optional[dict]=None,
+                        cache_report: Optional[dict]=None) -> None:
+    """Prints the overall stats of a skill run (costs from cache_report when
+    given, e.g. BatchUsage.cache_report with cascade tiers at their rates)."""
     print(f"\n=== Overall Stats for skill: {skill_name} ===")
-    print(f"Total Patients Processed: {len(patient_id_list)}")
+    print(f"Total Patients Processed: {num_patients}")
     print(f"Total Latency (s): {total_latency_s:.2f}")
-    print(f"Total Input Tokens: {total_input_tokens}")
-    print(f"Total Output Tokens: {total_output_tokens}")
-    print(f"Total Tokens: {total_tokens}")
-    print(f"Average Latency per Patient (s): {total_latency_s / len(patient_id_list):.2f}")
-    print(f"Average Input Tokens per Patient: {total_input_tokens / len(patient_id_list):.2f}")
-    print(f"Average Output Tokens per Patient: {total_output_tokens / len(patient_id_list):.2f}")
-    print(f"Average Tokens per Patient: {total_tokens / len(patient_id_list):.2f}")
-    
+    print(f"Total LLM Calls: {usage.llm_calls} (response cache hits: {usage.cache_hits})")
+    print(f"Total LLM Latency (s): {usage.llm_latency_s:.2f}")
+    print(f"Total Input Tokens: {usage.input_tokens}")
+    print(f"Total Cached Input Tokens: {usage.cached_input_tokens}")
+    print(f"Total Output Tokens: {usage.output_tokens}")
+    print(f"Total Reasoning Tokens: {usage.reasoning_tokens}")
+    print(f"Total Tokens: {usage.total_tokens}")
+    print(f"Average Latency per Patient (s): {total_latency_s / num_patients:.2f}")
+    print(f"Average Input Tokens per Patient: {usage.input_tokens / num_patients:.2f}")
+    print(f"Average Output Tokens per Patient: {usage.output_tokens / num_patients:.2f}")
+    print(f"Average Tokens per Patient: {usage.total_tokens / num_patients:.2f}")
+    if stream_report and stream_report["turns"]:
+        print(f"Time to First Token (s): mean {stream_report['ttft_mean_s']:.3f}, "
+              f"p50 {stream_report['ttft_p50_s']:.3f}, p95 {stream_report['ttft_p95_s']:.3f} "
+              f"over {stream_report['turns']} model turns")
+        if "inter_token_mean_s" in stream_report:
+            print(f"Inter-Token Latency (ms): mean {stream_report['inter_token_mean_s'] * 1000:.1f}, "
+                  f"max {stream_report['inter_token_max_s'] * 1000:.1f}")
+    print_prompt_cache_stats(usage, agent, cache_report)
+    if agent.response_cache is not None:
+        cache_stats = agent.response_cache.stats()
+        print(f"Response Cache Hits / Misses: {cache_stats['hits']} / {cache_stats['misses']} "
+              f"(hit rate {cache_stats['hit_rate']:.2%}, evictions {cache_stats['evictions']}, "
+              f"entries {cache_stats['entries']})")
+    if agent.scheduler is not None:
+        limit_stats = agent.scheduler.stats()
+        print(f"Rate Limiter: {limit_stats['attempts']} attempts for {limit_stats['calls']} calls, "
+              f"{limit_stats['throttled']} throttled (429), {limit_stats['server_errors']} server errors, "
+              f"{limit_stats['failed']} failed, waited {limit_stats['wait_s']:.2f}s, "
+              f"concurrency limit {limit_stats['concurrency_limit']}")
+    if agent.cascade is not None:
+        cascade_report = agent.cascade.report()
+        for tier_name, tier in cascade_report["tiers"].items():
+            cost = f", cost ${tier['cost_usd']:.4f}" if "cost_usd" in tier else ""
+            print(f"Cascade Tier {tier_name}: {tier['runs']} runs, {tier['accepted']} accepted, "
+                  f"escalation rate {tier['escalation_rate']:.2%} {tier['reasons']}, "
+                  f"{tier['llm_calls']} calls, {tier['input_tokens']} input / "
+                  f"{tier['output_tokens']} output tokens{cost}")
+        if cascade_report["direct_to_last_tier"]:
+            print(f"Cascade Direct to Last Tier: {cascade_report['direct_to_last_tier']}")
+    if completion_report and agent.completion_enabled:
+        per_patient = completion_report["per_patient"]
+        print(f"Completion Contract: {completion_report['early_stops']} runs ended once their "
+              f"artifacts were written, saving an estimated {completion_report['saved_input_tokens']} "
+              f"input / {completion_report['saved_output_tokens']} output tokens and "
+              f"{completion_report['saved_seconds']:.2f}s ({per_patient['saved_input_tokens']:.0f} / "
+              f"{per_patient['saved_output_tokens']:.0f} tokens, {per_patient['saved_seconds']:.2f}s "
+              f"per patient)")
+        print(f"Output Budgets: {completion_report['truncated_turns']} turns truncated, "
+              f"{completion_report['budget_stops']} runs stopped at the output-token budget")
+
+
+def print_prompt_cache_stats(usage: TokenUsage, agent: agents.Agent,
+                             report: Optional[dict]=None) -> None:
+    """Prints the provider prompt cache hit ratio and effective input cost,
+    and warns when a cacheable static prefix is not being cached."""
+    report = report or prompt_cache_report(usage, agent.pricing)
+    prefix_tokens = len(agent.prompt_prefix()) // 4  # rough estimate
+    print(f"Prompt Layout: {agent.prompt_layout} "
+          f"(prefix {agent.prefix_fingerprint[:12]}, ~{prefix_tokens} tokens)")
+    print(f"Prompt Cache Hit Ratio: {report['cache_hit_ratio']:.2%}")
+    if "effective_input_cost_usd" in report:
+        print(f"Effective Input Cost (USD): {report['effective_input_cost_usd']:.4f} "
+              f"(uncached {report['uncached_input_cost_usd']:.4f}, "
+              f"saved {report['input_cost_saved_usd']:.4f})")
+        print(f"Output Cost (USD): {report['output_cost_usd']:.4f}")
+    min_prefix_tokens = agent.prompt_cache.min_prefix_tokens if agent.prompt_cache else 1024
+    if (usage.llm_calls - usage.cache_hits > 1 and prefix_tokens >= min_prefix_tokens
+            and usage.cached_input_tokens == 0):
+        print("WARNING: no cached input tokens were reported although the static "
+              "prompt prefix is cacheable; check that the prefix is stable.")
+
 
 if __name__ == "__main__":
     # run skills:
@@ -100,3 +665,9 @@ if __name__ == "__main__":
     PID_LIST = [2, 5, 11]
     # run_skill("clinical_insights_skill", patient_id_list=PID_LIST, chat=False)
     run_skill("clinical_judge_skill", patient_id_list=PID_LIST)
+    # run_skill_batch("clinical_judge_skill", patient_id_list=PID_LIST, max_concurrency=3)
+    # run_pipeline(PID_LIST, insights_concurrency=3, judge_concurrency=3)
+    # print(dry_run_skill("clinical_insights_skill", PID_LIST))
+    # requests_path = run_skill("clinical_judge_skill", PID_LIST, batch_mode="export")
+    # run_skill("clinical_judge_skill", PID_LIST, batch_mode="ingest",
+    #           batch_results_path="<downloaded batch output file>")
@@ -0,0 +1,379 @@
+"""Offline Batch API rounds for cohort runs (see app.run_skill(batch_mode=...)): export
+writes the pending patients' next requests, ingest applies a result file and runs the
+returned tool calls locally. Of the graph middleware only the completion contract is
+applied, so budgets and compaction do not apply and a batch run can take more model
+calls than a live one. LocalBatchEndpoint answers request files with a local model."""
+
+import os
+import json
+import time
+import uuid
+from typing import Any, Optional
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import (
+    AIMessage, BaseMessage, HumanMessage, SystemMessage, ToolMessage,
+    messages_from_dict, messages_to_dict)
+from langchain_core.outputs import ChatGeneration, LLMResult
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+from completion import CompletionMiddleware, required_artifacts, written_filenames
+from output_sink import sink_scope
+from usage import LLMCall, UsageLedger, call_from_result
+
+
+RESPONSES_ENDPOINT = "/v1/responses"
+CHAT_COMPLETIONS_ENDPOINT = "/v1/chat/completions"
+STATE_FILENAME = "state.json"
+
+
+def requests_filename(round_index: int) -> str:
+    return f"round{round_index:02d}_requests.jsonl"
+
+
+def request_body(messages: list[BaseMessage], tools: list, model_config: Any,
+                 endpoint: str, extra: Optional[dict] = None) -> dict:
+    """The request body the OpenAI client would send for these messages."""
+    schemas = [convert_to_openai_tool(tool) for tool in tools]
+    body = {"model": model_config.name}
+    for param in ("temperature", "top_p"):
+        if getattr(model_config, param, None) is not None:
+            body[param] = getattr(model_config, param)
+    if endpoint == RESPONSES_ENDPOINT:
+        body["input"] = [item for message in messages for item in _responses_items(message)]
+        body["tools"] = [{"type": "function", **schema["function"]} for schema in schemas]
+        body["max_output_tokens"] = model_config.max_tokens
+    else:
+        body["messages"] = [_chat_message(message) for message in messages]
+        body["tools"] = schemas
+        body["max_completion_tokens"] = model_config.max_tokens
+    body.update(extra or {})
+    return body
+
+
+def _chat_message(message: BaseMessage) -> dict:
+    if isinstance(message, SystemMessage):
+        return {"role": "system", "content": message.content}
+    if isinstance(message, HumanMessage):
+        return {"role": "user", "content": message.content}
+    if isinstance(message, ToolMessage):
+        return {"role": "tool", "tool_call_id": message.tool_call_id,
+                "content": message.content}
+    chat_message = {"role": "assistant", "content": message.text or None}
+    if message.tool_calls:
+        chat_message["tool_calls"] = [
+            {"id": call["id"], "type": "function",
+             "function": {"name": call["name"], "arguments": json.dumps(call["args"])}}
+            for call in message.tool_calls]
+    return chat_message
+
+
+def _responses_items(message: BaseMessage) -> list[dict]:
+    if isinstance(message, SystemMessage):
+        return [{"role": "system", "content": message.content}]
+    if isinstance(message, HumanMessage):
+        return [{"role": "user", "content": message.content}]
+    if isinstance(message, ToolMessage):
+        return [{"type": "function_call_output", "call_id": message.tool_call_id,
+                 "output": message.content}]
+    items = [{"role": "assistant", "content": message.text}] if message.text else []
+    items.extend({"type": "function_call", "call_id": call["id"], "name": call["name"],
+                  "arguments": json.dumps(call["args"])}
+                 for call in message.tool_calls)
+    return items
+
+
+def request_messages(body: dict) -> list[BaseMessage]:
+    """The conversation of a request body (the inverse of request_body)."""
+    messages = []
+    if "messages" in body:
+        for item in body["messages"]:
+            if item["role"] == "system":
+                messages.append(SystemMessage(content=item["content"]))
+            elif item["role"] == "user":
+                messages.append(HumanMessage(content=item["content"]))
+            elif item["role"] == "tool":
+                messages.append(ToolMessage(content=item["content"],
+                                            tool_call_id=item["tool_call_id"]))
+            else:
+                messages.append(AIMessage(content=item.get("content") or "", tool_calls=[
+                    {"id": call["id"], "name": call["function"]["name"],
+                     "args": json.loads(call["function"]["arguments"])}
+                    for call in item.get("tool_calls") or []]))
+        return messages
+    for item in body["input"]:
+        if item.get("type") == "function_call":
+            if not (messages and isinstance(messages[-1], AIMessage)):
+                messages.append(AIMessage(content=""))
+            tool_calls = messages[-1].tool_calls + [
+                {"id": item["call_id"], "name": item["name"],
+                 "args": json.loads(item["arguments"])}]
+            messages[-1] = AIMessage(content=messages[-1].content, tool_calls=tool_calls)
+        elif item.get("type") == "function_call_output":
+            messages.append(ToolMessage(content=item["output"], tool_call_id=item["call_id"]))
+        elif item["role"] == "system":
+            messages.append(SystemMessage(content=item["content"]))
+        elif item["role"] == "user":
+            messages.append(HumanMessage(content=item["content"]))
+        else:
+            messages.append(AIMessage(content=item["content"]))
+    return messages
+
+
+def response_message(body: dict) -> AIMessage:
+    """The AI message (with tool calls and usage) of a response body."""
+    usage = body.get("usage") or {}
+    if "choices" in body:
+        message = body["choices"][0]["message"]
+        content = message.get("content") or ""
+        tool_calls = [{"id": call["id"], "name": call["function"]["name"],
+                       "args": json.loads(call["function"]["arguments"])}
+                      for call in message.get("tool_calls") or []]
+        input_tokens, output_tokens = usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+        cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0)
+        reasoning = (usage.get("completion_tokens_details") or {}).get("reasoning_tokens", 0)
+    else:
+        output = body.get("output") or []
+        content = "".join(part.get("text", "") for item in output if item["type"] == "message"
+                          for part in item.get("content") or [])
+        tool_calls = [{"id": item["call_id"], "name": item["name"],
+                       "args": json.loads(item["arguments"])}
+                      for item in output if item["type"] == "function_call"]
+        input_tokens, output_tokens = usage.get("input_tokens", 0), usage.get("output_tokens", 0)
+        cached = (usage.get("input_tokens_details") or {}).get("cached_tokens", 0)
+        reasoning = (usage.get("output_tokens_details") or {}).get("reasoning_tokens", 0)
+    return AIMessage(
+        content=content, tool_calls=tool_calls, id=body.get("id"),
+        usage_metadata={
+            "input_tokens": input_tokens, "output_tokens": output_tokens,
+            "total_tokens": usage.get("total_tokens", input_tokens + output_tokens),
+            "input_token_details": {"cache_read": cached or 0},
+            "output_token_details": {"reasoning": reasoning or 0}},
+        response_metadata={"model_name": body.get("model")})
+
+
+def response_body(message: AIMessage, endpoint: str, model: str) -> dict:
+    """A provider response body for an AI message (the inverse of
+    response_message), used by LocalBatchEndpoint."""
+    usage = message.usage_metadata or {}
+    input_tokens, output_tokens = usage.get("input_tokens", 0), usage.get("output_tokens", 0)
+    cached = (usage.get("input_token_details") or {}).get("cache_read", 0)
+    if endpoint == CHAT_COMPLETIONS_ENDPOINT:
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex[:24]}", "object": "chat.completion",
+            "created": int(time.time()), "model": model,
+            "choices": [{"index": 0, "finish_reason": "tool_calls" if message.tool_calls else "stop",
+                         "message": _chat_message(message)}],
+            "usage": {"prompt_tokens": input_tokens, "completion_tokens": output_tokens,
+                      "total_tokens": input_tokens + output_tokens,
+                      "prompt_tokens_details": {"cached_tokens": cached}},
+        }
+    output = [{"type": "message", "role": "assistant", "status": "completed",
+               "content": [{"type": "output_text", "text": message.text, "annotations": []}]}
+              ] if message.text else []
+    output.extend({"type": "function_call", "status": "completed", **item}
+                  for item in _responses_items(message) if item.get("type") == "function_call")
+    return {
+        "id": f"resp_{uuid.uuid4().hex[:24]}", "object": "response",
+        "created_at": int(time.time()), "status": "completed", "model": model,
+        "output": output,
+        "usage": {"input_tokens": input_tokens, "output_tokens": output_tokens,
+                  "total_tokens": input_tokens + output_tokens,
+                  "input_tokens_details": {"cached_tokens": cached}},
+    }
+
+
+def read_jsonl(filepath: str) -> list[dict]:
+    with open(filepath, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def write_jsonl(filepath: str, records: list[dict]) -> None:
+    """writes the records atomically."""
+    tmp_filepath = f"{filepath}.tmp"
+    with open(tmp_filepath, "w") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+    os.replace(tmp_filepath, filepath)
+
+
+class BatchRun:
+    """The rounds of one skill over a cohort, persisted in batch_dir.
+
+    Patients are "pending" while their next request waits for a round,
+    "done" once the model answered without tool calls (or, with the
+    completion contract, wrote the required artifacts) and "failed" after
+    max_attempts failed requests or max_rounds rounds."""
+    def __init__(self, agent: Any, batch_dir: str, max_rounds: int = 8,
+                 max_attempts: int = 3, resume: bool = True):
+        self.agent = agent
+        self.batch_dir = batch_dir
+        self.max_rounds = max_rounds
+        self.max_attempts = max_attempts
+        self.endpoint = (RESPONSES_ENDPOINT if getattr(agent.config.model, "use_responses_api", False)
+                         else CHAT_COMPLETIONS_ENDPOINT)
+        self.state = self._load_state() if resume else self._new_state()
+
+    @property
+    def state_filepath(self) -> str:
+        return os.path.join(self.batch_dir, STATE_FILENAME)
+
+    def _new_state(self) -> dict:
+        return {"round": 0, "endpoint": self.endpoint, "created_at": time.time(),
+                "patients": {}}
+
+    def _load_state(self) -> dict:
+        if not os.path.exists(self.state_filepath):
+            raise FileNotFoundError(f"no batch run in {self.batch_dir} (export one first)")
+        with open(self.state_filepath, "r") as f:
+            return json.load(f)
+
+    @property
+    def elapsed_s(self) -> float:
+        """time since the export of the first round."""
+        return time.time() - self.state["created_at"]
+
+    def _save_state(self) -> None:
+        os.makedirs(self.batch_dir, exist_ok=True)
+        tmp_filepath = f"{self.state_filepath}.tmp"
+        with open(tmp_filepath, "w") as f:
+            json.dump(self.state, f)
+        os.replace(tmp_filepath, self.state_filepath)
+
+    def pending(self) -> list[dict]:
+        return [patient for patient in self.state["patients"].values()
+                if patient["status"] == "pending"]
+
+    def add_patient(self, patient_id: int, session_id: str, user_query: str,
+                    metadata: dict) -> None:
+        """queues the first request of a patient: the system prompt and the
+        user message the live graph would send."""
+        inputs, _ = self.agent._prepare_inputs(user_query, session_id, metadata)
+        self.state["patients"][str(patient_id)] = {
+            "patient_id": patient_id, "session_id": session_id, "metadata": metadata,
+            "status": "pending", "attempts": 0, "custom_id": None,
+            "messages": messages_to_dict([self.agent.system_prompt, *inputs["messages"]]),
+            "calls": [],
+        }
+
+    def export_round(self) -> Optional[str]:
+        """writes the requests of all pending patients for the current round
+        and returns the file path (None when no patient is pending)."""
+        pending = self.pending()
+        if not pending:
+            self._save_state()
+            return None
+        round_index = self.state["round"]
+        extra = self.agent._model_kwargs().get("model_kwargs", {})
+        records = []
+        for patient in pending:
+            patient["custom_id"] = f"pid{patient['patient_id']:04d}-r{round_index:02d}"
+            records.append({
+                "custom_id": patient["custom_id"], "method": "POST", "url": self.endpoint,
+                "body": request_body(messages_from_dict(patient["messages"]), self.agent.tools,
+                                     self.agent.config.model, self.endpoint, extra)})
+        os.makedirs(self.batch_dir, exist_ok=True)
+        filepath = os.path.join(self.batch_dir, requests_filename(round_index))
+        write_jsonl(filepath, records)
+        self._save_state()
+        return filepath
+
+    def ingest(self, results_filepath: str) -> dict:
+        """Applies a result file: records the usage, runs the tool calls and
+        moves to the next round. Returns the patient counts per status."""
+        results = {record["custom_id"]: record for record in read_jsonl(results_filepath)}
+        if results and not any(patient["custom_id"] in results for patient in self.pending()):
+            raise ValueError(f"{results_filepath} holds no result of round {self.state['round']}")
+        for patient in self.pending():
+            result = results.get(patient["custom_id"])
+            response = (result or {}).get("response") or {}
+            if not result or result.get("error") or response.get("status_code") != 200:
+                # missing, expired or failed: the same request goes out again
+                patient["attempts"] += 1
+                if patient["attempts"] >= self.max_attempts:
+                    patient["status"] = "failed"
+                continue
+            self._apply(patient, response_message(response["body"]))
+
+        self.state["round"] += 1
+        if self.state["round"] >= self.max_rounds:
+            for patient in self.pending():
+                patient["status"] = "failed"
+        self._save_state()
+        counts = {"pending": 0, "done": 0, "failed": 0}
+        for patient in self.state["patients"].values():
+            counts[patient["status"]] += 1
+        return counts
+
+    def _apply(self, patient: dict, message: AIMessage) -> None:
+        """adds a model turn and the results of its tool calls."""
+        call = call_from_result(
+            LLMResult(generations=[[ChatGeneration(message=message)]]),
+            self.agent.config.model.name)
+        patient["calls"].append(call.__dict__)
+        patient["attempts"] = 0
+        messages = [message]
+        tools = {tool.name: tool for tool in self.agent.tools}
+        config = {"configurable": {"thread_id": patient["session_id"], **patient["metadata"]}}
+        for tool_call in message.tool_calls:
+            tool = tools.get(tool_call["name"])
+            try:
+                if tool is None:
+                    raise ValueError(f"{tool_call['name']} is not a valid tool")
+                with sink_scope(self.agent.output_sink):
+                    messages.append(tool.invoke({**tool_call, "type": "tool_call"}, config=config))
+            except Exception as e:
+                messages.append(ToolMessage(content=f"Error: {e}", tool_call_id=tool_call["id"],
+                                            name=tool_call["name"], status="error"))
+        patient["messages"].extend(messages_to_dict(messages))
+        patient["status"] = "pending" if message.tool_calls else "done"
+        if patient["status"] == "pending" and self._completed(patient):
+            patient["status"] = "done"
+            patient["early_stop"] = True
+
+    def _completed(self, patient: dict) -> bool:
+        """whether the patient wrote every artifact its skill requires."""
+        if not self.agent.completion_enabled:
+            return False
+        artifacts = required_artifacts(self.agent.config.skill)
+        written = written_filenames(messages_from_dict(patient["messages"]))
+        return bool(artifacts) and all(
+            f"pid{patient['patient_id']:04d}_{artifact}" in written for artifact in artifacts)
+
+    def ledgers(self) -> dict[int, UsageLedger]:
+        """a usage ledger per patient with the calls of all rounds."""
+        ledgers = {}
+        for patient in self.state["patients"].values():
+            ledger = self.agent.new_ledger("batch", patient["metadata"])
+            for call in patient["calls"]:
+                ledger.record(LLMCall(**call))
+            if patient.get("early_stop"):
+                ledger.record_completion(early_stops=1, **CompletionMiddleware._skipped_call(
+                    messages_from_dict(patient["messages"]), ledger))
+            ledgers[patient["patient_id"]] = ledger
+        return ledgers
+
+
+class LocalBatchEndpoint:
+    """Answers Batch API request files with a local chat model."""
+    def __init__(self, llm: BaseChatModel):
+        self.llm = llm
+
+    def run(self, requests_filepath: str, results_filepath: Optional[str] = None) -> str:
+        """writes the result file for a request file and returns its path."""
+        results_filepath = results_filepath or requests_filepath.replace(
+            "_requests.jsonl", "_results.jsonl")
+        results = []
+        for request in read_jsonl(requests_filepath):
+            record = {"id": f"batch_req_{uuid.uuid4().hex[:24]}",
+                      "custom_id": request["custom_id"], "response": None, "error": None}
+            try:
+                message = self.llm.invoke(request_messages(request["body"]))
+                record["response"] = {
+                    "status_code": 200, "request_id": uuid.uuid4().hex,
+                    "body": response_body(message, request["url"], request["body"]["model"])}
+            except Exception as e:
+                record["error"] = {"code": type(e).__name__, "message": str(e)}
+            results.append(record)
+        write_jsonl(results_filepath, results)
+        return results_filepath
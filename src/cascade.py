@@ -0,0 +1,185 @@
+"""Model cascade: a patient runs on the cheaper tiers of the cascade block in
+agent_config.yaml first and escalates to the next tier when a signal (missing or
+invalid output, insufficient support, grounding risk, judge flags) rejects the result."""
+
+import re
+import threading
+from collections import Counter
+from typing import Any, Optional
+
+import grounding
+import local_tools
+from long_notes import INSUFFICIENT_SUPPORT, estimate_tokens
+from run_manifest import SKILL_OUTPUTS
+from usage import TokenUsage, UsageLedger, prompt_cache_report
+from utils import DotDict
+
+
+NOTES_PATTERN = re.compile(r"<notes>\n?(.*?)\n?</notes>", re.S)
+LINE_NUMBER_PATTERN = re.compile(r"(?m)^\d+: ")
+REQUIRED_FIELDS = {
+    "treatment_recommendation.json": ("recommended_treatment", "citations"),
+    "clinical_summary.json": ("summary", "citations"),
+    "eval_treatment_plan.json": ("hallucination", "accuracy"),
+    "eval_summarization.json": ("hallucination", "accuracy"),
+}
+
+
+def note_from_documents(content: str) -> str:
+    """the note of a <documents> message, without the line numbers."""
+    match = NOTES_PATTERN.search(content)
+    return LINE_NUMBER_PATTERN.sub("", match.group(1)) if match else ""
+
+
+def _judge_flagged(output: dict) -> bool:
+    """whether an evaluation reports a hallucination or an accuracy below HIGH."""
+    try:
+        hallucination = float((output.get("hallucination") or {}).get("score"))
+    except (TypeError, ValueError):
+        return True
+    accuracy = str((output.get("accuracy") or {}).get("score", "")).upper()
+    return hallucination > 0 or accuracy != "HIGH"
+
+
+def escalation_reasons(skill_name: str, patient_id: int, artifacts: dict, note: str,
+                       settings: DotDict) -> list[str]:
+    """the signals raised by the outputs a tier wrote for one patient."""
+    reasons = []
+    outputs = {}
+    for artifact in SKILL_OUTPUTS.get(skill_name, ()):
+        value = artifacts.get(f"pid{patient_id:04d}_{artifact}")
+        if value is None:
+            reasons.append("missing_output")
+            continue
+        required = REQUIRED_FIELDS.get(artifact, ())
+        if required and not (isinstance(value, dict) and all(key in value for key in required)):
+            reasons.append("invalid_output")
+            continue
+        outputs[artifact] = value
+    if reasons:
+        return sorted(set(reasons))
+
+    if skill_name == "clinical_insights_skill":
+        texts = [outputs[f"{artifact}.json"].get(text_key)
+                 for artifact, text_key in grounding.CHECKED_OUTPUTS]
+        if getattr(settings, "escalate_on_insufficient_support", True) and INSUFFICIENT_SUPPORT in texts:
+            reasons.append("insufficient_support")
+        risk_threshold = getattr(settings, "grounding_risk", None)
+        if risk_threshold is not None and note:
+            report = grounding.check_patient(note, {
+                artifact: outputs[f"{artifact}.json"] for artifact, _ in grounding.CHECKED_OUTPUTS})
+            if report["risk"] >= risk_threshold:
+                reasons.append("grounding")
+    elif skill_name == "clinical_judge_skill":
+        if getattr(settings, "escalate_on_judge_flags", True) and any(
+                _judge_flagged(output) for output in outputs.values()):
+            reasons.append("judge_flags")
+    return reasons
+
+
+class Cascade:
+    """Runs patients through tiers of agents, cheapest first; the last tier
+    is the agent the cascade belongs to."""
+    def __init__(self, tiers: list[tuple[str, Any]], settings: DotDict):
+        self.tiers = tiers
+        self.settings = settings
+        self.max_note_tokens = getattr(settings, "max_note_tokens", None)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        """clears the counters (the agent, and so its cascade, is pooled
+        across batches)."""
+        with self._lock:
+            self.runs = Counter()
+            self.accepted = Counter()
+            self.escalations = Counter()
+            self.reasons = {name: Counter() for name, _ in self.tiers}
+            self.direct = Counter()
+            self.usage = {name: TokenUsage(name) for name, _ in self.tiers}
+
+    def _first_tier(self, content: str) -> int:
+        if self.max_note_tokens and estimate_tokens(note_from_documents(content)) > self.max_note_tokens:
+            with self._lock:
+                self.direct["note_length"] += 1
+            return len(self.tiers) - 1
+        return 0
+
+    def _session_id(self, session_id: str, tier: int) -> str:
+        # each tier has its own thread
+        return session_id if tier == len(self.tiers) - 1 else f"{session_id}_tier{tier}"
+
+    def _finish_tier(self, tier: int, ledger: UsageLedger, tier_ledger: UsageLedger,
+                     artifacts: dict, content: str, metadata: dict) -> Optional[int]:
+        """merges the tier's usage and outputs; returns the next tier to run
+        or None when the result is accepted."""
+        ledger.merge(tier_ledger)
+        for filename, value in artifacts.items():
+            local_tools.record_artifact(filename, value)
+        name = self.tiers[tier][0]
+        reasons = []
+        if tier < len(self.tiers) - 1:
+            reasons = escalation_reasons(
+                metadata.get("skill_name"), metadata.get("patient_id"), artifacts,
+                note_from_documents(content), self.settings)
+        with self._lock:
+            self.runs[name] += 1
+            self.usage[name].merge(tier_ledger.usage)
+            if not reasons:
+                self.accepted[name] += 1
+                return None
+            self.escalations[name] += 1
+            self.reasons[name].update(reasons)
+        print(f"[cascade] patient {metadata.get('patient_id')}: {name} escalated "
+              f"to {self.tiers[tier + 1][0]} ({', '.join(reasons)})")
+        return tier + 1
+
+    def run(self, agent, content: str, session_id: str, stream_mode: str,
+            metadata: dict, sink=None) -> UsageLedger:
+        """Agent.stream_local through the tiers."""
+        ledger = agent.new_ledger(stream_mode, metadata)
+        tier = self._first_tier(content)
+        while tier is not None:
+            tier_agent = self.tiers[tier][1]
+            with local_tools.capture_artifacts() as artifacts:
+                tier_ledger = tier_agent.stream_local(
+                    content, self._session_id(session_id, tier), stream_mode=stream_mode,
+                    metadata=metadata, sink=sink)
+            tier = self._finish_tier(tier, ledger, tier_ledger, artifacts, content, metadata)
+        return ledger
+
+    async def arun(self, agent, content: str, session_id: str, stream_mode: str,
+                   metadata: dict, verbose: bool = False, sink=None) -> UsageLedger:
+        """Agent.astream_local through the tiers."""
+        ledger = agent.new_ledger(stream_mode, metadata)
+        tier = self._first_tier(content)
+        while tier is not None:
+            tier_agent = self.tiers[tier][1]
+            with local_tools.capture_artifacts() as artifacts:
+                tier_ledger = await tier_agent.astream_local(
+                    content, self._session_id(session_id, tier), stream_mode=stream_mode,
+                    metadata=metadata, verbose=verbose, sink=sink)
+            tier = self._finish_tier(tier, ledger, tier_ledger, artifacts, content, metadata)
+        return ledger
+
+    def report(self) -> dict:
+        """runs, acceptance, escalation rate, reasons and usage per tier."""
+        with self._lock:
+            tiers = {}
+            for name, tier_agent in self.tiers:
+                runs, usage = self.runs[name], self.usage[name]
+                tiers[name] = {
+                    "runs": runs,
+                    "accepted": self.accepted[name],
+                    "escalation_rate": round(self.escalations[name] / runs, 4) if runs else 0.0,
+                    "reasons": dict(self.reasons[name]),
+                    "llm_calls": usage.llm_calls,
+                    "input_tokens": usage.input_tokens,
+                    "output_tokens": usage.output_tokens,
+                    "llm_latency_s": round(usage.llm_latency_s, 3),
+                }
+                if tier_agent.pricing is not None:
+                    cost = prompt_cache_report(usage, tier_agent.pricing)
+                    tiers[name]["cost_usd"] = round(
+                        cost["effective_input_cost_usd"] + cost["output_cost_usd"], 6)
+            return {"tiers": tiers, "direct_to_last_tier": dict(self.direct)}
@@ -0,0 +1,134 @@
+"""Completion contract and output-token budgets: CompletionMiddleware ends a run once
+the skill's required artifacts are written and caps its model calls (see the
+completion block in agent_config.yaml)."""
+
+import os
+import re
+from typing import Any, Callable, Optional
+
+from langchain.agents.middleware import AgentMiddleware, hook_config
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+
+from fanout import WRITER_TOOLS
+from usage import current_ledger
+
+
+ARTIFACT_DECLARATION = re.compile(r"""filename\s*=\s*f["']pid\{patient_id:04d\}_([\w.\-]+)["']""")
+PATIENT_ID_PATTERN = re.compile(r"<patient_id>\s*(\d+)\s*</patient_id>")
+BUDGET_EXHAUSTED = "OUTPUT_BUDGET_EXHAUSTED"
+
+
+def required_artifacts(skill_text: str) -> tuple[str, ...]:
+    """the artifacts a skill declares (e.g. "clinical_summary.json"), in order."""
+    return tuple(dict.fromkeys(ARTIFACT_DECLARATION.findall(skill_text or "")))
+
+
+def written_filenames(messages: list) -> set[str]:
+    """the filenames of the writer tool calls that succeeded."""
+    filenames = {}
+    for message in messages:
+        if isinstance(message, AIMessage):
+            for call in message.tool_calls:
+                if call["name"] in WRITER_TOOLS and call["args"].get("filename"):
+                    filenames[call["id"]] = os.path.basename(str(call["args"]["filename"]))
+    return {filenames[message.tool_call_id] for message in messages
+            if isinstance(message, ToolMessage) and message.status != "error"
+            and message.tool_call_id in filenames}
+
+
+def _request_patients(messages: list) -> list[int]:
+    for message in reversed(messages):
+        if isinstance(message, HumanMessage):
+            return [int(match) for match in PATIENT_ID_PATTERN.findall(str(message.content))]
+    return []
+
+
+def _truncated(message: Any) -> bool:
+    """whether a model turn stopped at its output-token cap."""
+    metadata = getattr(message, "response_metadata", None) or {}
+    incomplete = metadata.get("incomplete_details") or {}
+    return (metadata.get("finish_reason") == "length"
+            or incomplete.get("reason") == "max_output_tokens")
+
+
+class CompletionMiddleware(AgentMiddleware):
+    """Ends a run once the skill's required artifacts are written and keeps
+    its model calls within the output-token budgets."""
+    def __init__(self, artifacts: tuple[str, ...],
+                 max_turn_output_tokens: Optional[int] = None,
+                 max_patient_output_tokens: Optional[int] = None):
+        super().__init__()
+        self.artifacts = artifacts
+        self.max_turn_output_tokens = max_turn_output_tokens
+        self.max_patient_output_tokens = max_patient_output_tokens
+
+    def _remaining(self, messages: list) -> Optional[int]:
+        """output tokens left in the run's budget (None without a budget)."""
+        ledger = current_ledger.get()
+        if not self.max_patient_output_tokens or ledger is None:
+            return None
+        budget = self.max_patient_output_tokens * max(len(_request_patients(messages)), 1)
+        return budget - ledger.usage.output_tokens
+
+    @hook_config(can_jump_to=["end"])
+    def before_model(self, state: dict, runtime: Any) -> Optional[dict]:
+        messages = state["messages"]
+        ledger = current_ledger.get()
+        patient_ids = _request_patients(messages)
+        if self.artifacts and patient_ids:
+            required = {f"pid{patient_id:04d}_{artifact}"
+                        for patient_id in patient_ids for artifact in self.artifacts}
+            if required <= written_filenames(messages):
+                if ledger is not None:
+                    ledger.record_completion(early_stops=1, **self._skipped_call(messages, ledger))
+                return {"jump_to": "end"}
+        remaining = self._remaining(messages)
+        if remaining is not None and remaining <= 0:
+            if ledger is not None:
+                ledger.record_completion(budget_stops=1)
+            return {"messages": [AIMessage(content=BUDGET_EXHAUSTED)], "jump_to": "end"}
+        return None
+
+    @staticmethod
+    def _skipped_call(messages: list, ledger) -> dict:
+        """the estimated usage of the model call the contract skips."""
+        calls = list(ledger.calls)
+        if not calls:
+            return {}
+        tool_tokens = 0
+        for message in reversed(messages):
+            if not isinstance(message, ToolMessage):
+                break
+            tool_tokens += len(str(message.content)) // 4
+        last = calls[-1]
+        return {"saved_input_tokens": last.input_tokens + last.output_tokens + tool_tokens,
+                "saved_output_tokens": round(sum(call.output_tokens for call in calls) / len(calls)),
+                "saved_seconds": sum(call.latency_s for call in calls) / len(calls)}
+
+    def _cap(self, request: Any) -> Any:
+        """the request with max_tokens lowered to the turn / run budget."""
+        caps = [cap for cap in (self.max_turn_output_tokens, self._remaining(request.messages))
+                if cap is not None]
+        if not caps:
+            return request
+        cap = max(min(caps), 1)
+        settings = request.model_settings or {}
+        configured = settings.get("max_tokens") or getattr(request.model, "max_tokens", None)
+        if configured and configured <= cap:
+            return request
+        return request.override(model_settings={**settings, "max_tokens": cap})
+
+    @staticmethod
+    def _count_truncations(response: Any) -> Any:
+        ledger = current_ledger.get()
+        if ledger is not None:
+            truncated = sum(1 for message in getattr(response, "result", ()) if _truncated(message))
+            if truncated:
+                ledger.record_completion(truncated_turns=truncated)
+        return response
+
+    def wrap_model_call(self, request: Any, handler: Callable) -> Any:
+        return self._count_truncations(handler(self._cap(request)))
+
+    async def awrap_model_call(self, request: Any, handler: Callable) -> Any:
+        return self._count_truncations(await handler(self._cap(request)))
@@ -0,0 +1,211 @@
+"""Packed patient corpus: all documents in one memory-mapped data file plus an offset
+index (corpus.idx.json) that names the data file, so compaction can swap it atomically."""
+
+import os
+import json
+import mmap
+import uuid
+import threading
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+
+CORPUS_DATA_FILENAME = "corpus.bin"
+CORPUS_INDEX_FILENAME = "corpus.idx.json"
+CORPUS_VERSION = 1
+CORPUS_FIELDS = ("note", "note_numbered", "question", "answer")
+
+
+def add_line_numbers(text: str) -> str:
+    """Adds line numbers to each line in the given text."""
+    lines = text.split('\n')
+    numbered_lines = [f"{i + 1}: {line}" for i, line in enumerate(lines)]
+    return '\n'.join(numbered_lines)
+
+
+class CorpusWriter:
+    """Appends patients to a packed corpus; the index is written on close().
+
+    An existing corpus in base_path is extended, and patients that are added
+    again replace their previous entry in the index. The documents of
+    replaced entries are dropped from the data file on close(), so
+    re-ingesting a cohort does not grow the corpus."""
+    def __init__(self, base_path: str):
+        os.makedirs(base_path, exist_ok=True)
+        self.base_path = base_path
+        self.index_fp = os.path.join(base_path, CORPUS_INDEX_FILENAME)
+        self.data_filename = CORPUS_DATA_FILENAME
+        self.patients = {}
+        if os.path.exists(self.index_fp):
+            with open(self.index_fp, 'r') as f:
+                index = json.load(f)
+            self.patients = index["patients"]
+            self.data_filename = index.get("data", CORPUS_DATA_FILENAME)
+        self.data_fp = os.path.join(base_path, self.data_filename)
+        self._data = open(self.data_fp, 'ab')
+        self._offset = self._data.tell()
+
+    def __contains__(self, patient_id: int) -> bool:
+        return str(int(patient_id)) in self.patients
+
+    def add(self, patient_id: int, note: str, question: str, answer: str) -> None:
+        """appends one patient's documents to the data file."""
+        documents = {
+            "note": note,
+            "note_numbered": add_line_numbers(note),
+            "question": question,
+            "answer": answer,
+        }
+        entry = {}
+        for field in CORPUS_FIELDS:
+            blob = documents[field].encode("utf-8")
+            self._data.write(blob)
+            entry[field] = [self._offset, len(blob)]
+            self._offset += len(blob)
+        self.patients[str(int(patient_id))] = entry
+
+    def live_bytes(self) -> int:
+        """size of the documents the index refers to."""
+        return sum(length for entry in self.patients.values() for _, length in entry.values())
+
+    def close(self) -> None:
+        """flushes the data file and atomically replaces the index.
+
+        If the data file holds documents no entry refers to any more (replaced
+        patients, or an interrupted run), the live documents are copied to a
+        new data file first; the old one is removed once the index names the
+        new one."""
+        self._data.close()
+        old_data_fp = None
+        if self.live_bytes() < self._offset:
+            old_data_fp = self.data_fp
+            self._compact()
+        tmp_fp = f"{self.index_fp}.tmp"
+        with open(tmp_fp, 'w') as f:
+            json.dump({"version": CORPUS_VERSION, "data": self.data_filename,
+                       "patients": self.patients}, f)
+        os.replace(tmp_fp, self.index_fp)
+        if old_data_fp is not None:
+            try:
+                os.remove(old_data_fp)
+            except OSError:
+                pass  # still mapped by a reader on platforms that refuse the removal
+
+    def _compact(self) -> None:
+        """copies the live documents to a new generation of the data file in
+        index order and rewrites the offsets."""
+        self.data_filename = f"corpus.{uuid.uuid4().hex[:12]}.bin"
+        compacted_fp = os.path.join(self.base_path, self.data_filename)
+        offset = 0
+        with open(self.data_fp, 'rb') as source, open(compacted_fp, 'wb') as target:
+            for entry in self.patients.values():
+                for field, (old_offset, length) in entry.items():
+                    source.seek(old_offset)
+                    target.write(source.read(length))
+                    entry[field] = [offset, length]
+                    offset += length
+        self.data_fp = compacted_fp
+        self._offset = offset
+
+    def __enter__(self) -> "CorpusWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class PackedCorpus:
+    """Read-only, memory-mapped view of a packed corpus."""
+    def __init__(self, base_path: str):
+        with open(os.path.join(base_path, CORPUS_INDEX_FILENAME), 'r') as f:
+            index = json.load(f)
+        if index.get("version") != CORPUS_VERSION:
+            raise ValueError(f"Unsupported corpus version: {index.get('version')}")
+        self.patients = index["patients"]
+        self._file = open(os.path.join(base_path, index.get("data", CORPUS_DATA_FILENAME)), 'rb')
+        # open_corpus users and whether a newer view replaced this one
+        self._users = 0
+        self._stale = False
+        size = os.fstat(self._file.fileno()).st_size
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    def close(self) -> None:
+        """unmaps the data file."""
+        if isinstance(self._mmap, mmap.mmap):
+            self._mmap.close()
+        self._file.close()
+
+    def __contains__(self, patient_id: int) -> bool:
+        return str(int(patient_id)) in self.patients
+
+    def __len__(self) -> int:
+        return len(self.patients)
+
+    def patient_ids(self) -> list[int]:
+        return sorted(int(patient_id) for patient_id in self.patients)
+
+    def read(self, patient_id: int, field: str) -> str:
+        """decodes one document of one patient."""
+        offset, length = self.patients[str(int(patient_id))][field]
+        return self._mmap[offset:offset + length].decode("utf-8")
+
+    def load(self, patient_id: int, line_numbers: bool = True) -> dict:
+        """returns the same dictionary as local_tools.load_patient_data."""
+        return {
+            "patient_id": patient_id,
+            "note": self.read(patient_id, "note_numbered" if line_numbers else "note"),
+            "question": self.read(patient_id, "question"),
+            "answer": self.read(patient_id, "answer"),
+        }
+
+
+# abspath -> (index mtime, corpus)
+_open_corpora: dict[str, tuple[int, PackedCorpus]] = {}
+_open_corpora_lock = threading.Lock()
+
+
+@contextmanager
+def open_corpus(base_path: str) -> Iterator[Optional[PackedCorpus]]:
+    """Yields the packed corpus in base_path, or None if there is none.
+
+    Corpora are opened once per process and reopened when the index file
+    changes (e.g. after preprocessing appended patients); the previous view
+    is closed when its last user leaves this context."""
+    corpus = _acquire_corpus(base_path)
+    try:
+        yield corpus
+    finally:
+        if corpus is not None:
+            _release_corpus(corpus)
+
+
+def _acquire_corpus(base_path: str) -> Optional[PackedCorpus]:
+    index_fp = os.path.join(base_path, CORPUS_INDEX_FILENAME)
+    key = os.path.abspath(base_path)
+    try:
+        mtime = os.stat(index_fp).st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
+    with _open_corpora_lock:
+        cached = _open_corpora.get(key)
+        if cached is not None and cached[0] == mtime:
+            corpus = cached[1]
+        else:
+            if cached is not None:
+                del _open_corpora[key]
+                cached[1]._stale = True
+                if cached[1]._users == 0:
+                    cached[1].close()
+            if mtime is None:
+                return None
+            corpus = PackedCorpus(base_path)
+            _open_corpora[key] = (mtime, corpus)
+        corpus._users += 1
+        return corpus
+
+
+def _release_corpus(corpus: PackedCorpus) -> None:
+    with _open_corpora_lock:
+        corpus._users -= 1
+        if corpus._stale and corpus._users == 0:
+            corpus.close()
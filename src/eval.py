@@ -1,41 +1,203 @@
 """loads the output json files for each patient generated by the clinical_judge_skill
-and computes statistics about the accuracy and hall ucination rates for both the
-recommended treatment and the clinical summary."""
+and computes statistics about the hallucination rates and accuracy levels for both the
+recommended treatment (treatment_plan) and the clinical summary (summarization)."""
 
 import os
-import json
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
 
+import numpy as np
+import pandas as pd
 
+from output_sink import OutputSink, build_output_sink
+from utils import ConfigLoader
+
+
+AGENT_CONFIG_PATH = "/Users/ebadahmadzadeh/ms-code-projects/ethermed/langgraph_agent_app/src/agent_config.yaml"
 OUTPUT_BASE_PATH = "/Users/ebadahmadzadeh/ms-code-projects/ethermed/langgraph_agent_app/outputs"
+EVAL_STATE_FILENAME = ".eval_state.csv"
+
+EVAL_TASKS = ("treatment_plan", "summarization")
+ACCURACY_LEVELS = ("LOW", "MEDIUM", "HIGH")
+STATE_COLUMNS = ["patient_id", "task", "version", "hallucination",
+                 "num_hallucinations", "accuracy"]
+
+
+def eval_filename(patient_id: int, task: str) -> str:
+    return f"pid{patient_id:04d}_eval_{task}.json"
+
+
+def grounding_filename(patient_id: int) -> str:
+    """the report of grounding.py's check gating the judge."""
+    return f"pid{patient_id:04d}_grounding_check.json"
+
+
+def _map_chunks(fn: Callable[[list], dict], items: list, max_workers: int,
+                chunk_size: int = 1000) -> dict:
+    """runs fn over chunks of items in a thread pool and merges the dicts."""
+    chunks = [items[start:start + chunk_size] for start in range(0, len(items), chunk_size)]
+    merged = {}
+    if len(chunks) <= 1 or max_workers <= 1:
+        for chunk in chunks:
+            merged.update(fn(chunk))
+        return merged
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for result in executor.map(fn, chunks):
+            merged.update(result)
+    return merged
+
+
+def parse_judge_output(output: dict) -> tuple:
+    """(hallucination score, number of instances, accuracy level) of one
+    judge output; invalid fields become NaN / None."""
+    hallucination = output.get("hallucination") or {}
+    accuracy = output.get("accuracy") or {}
+    try:
+        score = float(hallucination.get("score"))
+    except (TypeError, ValueError):
+        score = np.nan
+    level = str(accuracy.get("score", "")).strip().upper()
+    return (score, len(hallucination.get("instances") or []),
+            level if level in ACCURACY_LEVELS else None)
+
+
+def load_state(state_fp: str) -> pd.DataFrame:
+    if not os.path.exists(state_fp):
+        return pd.DataFrame({
+            "patient_id": pd.Series(dtype="int64"), "task": pd.Series(dtype=str),
+            "version": pd.Series(dtype=str), "hallucination": pd.Series(dtype=float),
+            "num_hallucinations": pd.Series(dtype="int64"), "accuracy": pd.Series(dtype=str)})
+    return pd.read_csv(state_fp, dtype={"task": str, "version": str, "accuracy": str})
+
 
-def analyze_clinical_judge_outputs(patient_id_list: list[int]) -> None:
+def save_state(state: pd.DataFrame, state_fp: str) -> None:
+    """replaces the state file atomically."""
+    tmp_fp = f"{state_fp}.tmp"
+    state[STATE_COLUMNS].to_csv(tmp_fp, index=False)
+    os.replace(tmp_fp, state_fp)
+
+
+def load_judge_outputs(patient_id_list: list[int], sink: OutputSink,
+                       base_path: str = OUTPUT_BASE_PATH,
+                       state_fp: Optional[str] = None,
+                       max_workers: int = 8,
+                       risk_threshold: Optional[float] = None) -> tuple[pd.DataFrame, dict]:
+    """Returns one row per available (patient_id, task) judge output and
+    load stats. Outputs whose version matches the state file are taken from
+    the state instead of being read and parsed again. With risk_threshold,
+    patients without judge outputs whose grounding check is below it count
+    as cleared instead of missing."""
+    state_fp = state_fp or os.path.join(base_path, EVAL_STATE_FILENAME)
+    requested = pd.DataFrame(
+        [(patient_id, task) for patient_id in patient_id_list for task in EVAL_TASKS],
+        columns=["patient_id", "task"])
+    filenames = [eval_filename(pid, task)
+                 for pid, task in zip(requested["patient_id"], requested["task"])]
+
+    versions = _map_chunks(lambda chunk: sink.versions(base_path, chunk), filenames, max_workers)
+    requested["filename"] = filenames
+    requested["version"] = requested["filename"].map(versions)
+    available = requested[requested["version"].notna()]
+
+    state = load_state(state_fp)
+    merged = available.merge(state, on=["patient_id", "task"], how="left",
+                             suffixes=("", "_state"))
+    unchanged = merged[merged["version"] == merged["version_state"]]
+    changed = merged[merged["version"] != merged["version_state"]]
+
+    outputs = _map_chunks(lambda chunk: sink.read_many(base_path, chunk),
+                          changed["filename"].tolist(), max_workers)
+    parsed = [parse_judge_output(outputs.get(filename) or {})
+              for filename in changed["filename"]]
+    fresh = changed[["patient_id", "task", "version"]].assign(
+        hallucination=[row[0] for row in parsed],
+        num_hallucinations=[row[1] for row in parsed],
+        accuracy=[row[2] for row in parsed])
+
+    frame = pd.concat([unchanged[STATE_COLUMNS], fresh[STATE_COLUMNS]], ignore_index=True)
+    if len(fresh):
+        # keep the rows of patients that were not requested this time
+        keep = state.merge(frame[["patient_id", "task"]], how="left", indicator=True,
+                           on=["patient_id", "task"])["_merge"].eq("left_only").to_numpy()
+        save_state(pd.concat([state[keep], frame], ignore_index=True), state_fp)
+
+    missing = requested.loc[requested["version"].isna(), "patient_id"].unique().tolist()
+    cleared = []
+    if risk_threshold is not None and missing:
+        reports = sink.read_many(base_path, [grounding_filename(pid) for pid in missing])
+        cleared = [pid for pid in missing
+                   if reports.get(grounding_filename(pid), {}).get("risk", risk_threshold)
+                   < risk_threshold]
+    stats = {"requested": len(requested), "loaded": len(fresh),
+             "from_state": len(unchanged), "grounding_cleared": cleared,
+             "missing_patients": [pid for pid in missing if pid not in cleared]}
+    return frame, stats
+
+
+def compute_metrics(frame: pd.DataFrame) -> dict:
+    """Hallucination rate and accuracy-level distribution per task and over
+    all tasks."""
+    frame = frame.assign(accuracy=pd.Categorical(frame["accuracy"], categories=ACCURACY_LEVELS))
+    hallucination = frame.groupby("task", observed=True).agg(
+        outputs=("patient_id", "size"),
+        hallucination_rate=("hallucination", "mean"),
+        mean_instances=("num_hallucinations", "mean"),
+        invalid_scores=("hallucination", lambda scores: int(scores.isna().sum())))
+    accuracy = pd.crosstab(frame["task"], frame["accuracy"], normalize="index", dropna=False)
+
+    metrics = {}
+    for task in hallucination.index:
+        row = hallucination.loc[task]
+        metrics[task] = {
+            "outputs": int(row["outputs"]),
+            "hallucination_rate": round(float(row["hallucination_rate"]), 4),
+            "mean_hallucination_instances": round(float(row["mean_instances"]), 3),
+            "invalid_hallucination_scores": int(row["invalid_scores"]),
+            "accuracy_distribution": {
+                level: round(float(accuracy.loc[task, level]), 4) if task in accuracy.index else 0.0
+                for level in ACCURACY_LEVELS},
+        }
+    metrics["overall"] = {
+        "outputs": int(len(frame)),
+        "hallucination_rate": round(float(frame["hallucination"].mean()), 4) if len(frame) else 0.0,
+        # patients with a hallucination in any task
+        "patients_with_hallucination": int(
+            frame.groupby("patient_id")["hallucination"].max().fillna(0).gt(0).sum()),
+        "high_accuracy_rate": round(float((frame["accuracy"] == "HIGH").mean()), 4) if len(frame) else 0.0,
+    }
+    return metrics
+
+
+def analyze_clinical_judge_outputs(patient_id_list: list[int],
+                                   sink: Optional[OutputSink] = None,
+                                   max_workers: int = 8) -> dict:
     """Analyzes the outputs of the clinical_judge_skill for the given patient IDs."""
-    total_patients = len(patient_id_list)
-    treatment_exact_match_count = 0
-    summary_exact_match_count = 0
-
-    for patient_id in patient_id_list:
-        treatment_fp = os.path.join(
-            OUTPUT_BASE_PATH, f"pid{patient_id:04d}_treatment_recommendation.json")
-        summary_fp = os.path.join(
-            OUTPUT_BASE_PATH, f"pid{patient_id:04d}_clinical_summary.json")
-
-        # check if the file exists before loading
-        if os.path.exists(treatment_fp):
-            treatment_data = json.load(open(treatment_fp, 'r'))
-        else:
-            print(f"Warning: Treatment recommendation file not found for patient {patient_id}")
-
-        if os.path.exists(summary_fp):
-            summary_data = json.load(open(summary_fp, 'r'))
-        else:
-            print(f"Warning: Clinical summary file not found for patient {patient_id}")
-        
-
-        
-
-    treatment_accuracy = (treatment_exact_match_count / total_patients) * 100
-    summary_accuracy = (summary_exact_match_count / total_patients) * 100
-
-    print(f"Treatment Recommendation Exact Match Accuracy: {treatment_accuracy:.2f}%")
-    print(f"Clinical Summary Exact Match Accuracy: {summary_accuracy:.2f}%")
\ No newline at end of file
+    # the outputs are read through the same sink the writer tools used
+    agent_config = ConfigLoader(AGENT_CONFIG_PATH).dotdict
+    sink = sink or build_output_sink(getattr(agent_config, "output_sink", None))
+    grounding_check = getattr(agent_config, "grounding_check", None)
+    frame, stats = load_judge_outputs(
+        patient_id_list, sink, base_path=OUTPUT_BASE_PATH, max_workers=max_workers,
+        risk_threshold=grounding_check.risk_threshold
+        if grounding_check and grounding_check.enabled else None)
+    metrics = compute_metrics(frame)
+
+    if stats["missing_patients"]:
+        print(f"Warning: judge outputs missing for {len(stats['missing_patients'])} "
+              f"patient(s): {stats['missing_patients'][:10]}")
+    if stats["grounding_cleared"]:
+        print(f"Grounding check: {len(stats['grounding_cleared'])} patient(s) cleared without "
+              f"the judge: {stats['grounding_cleared'][:10]}")
+    print(f"Judge outputs: {stats['loaded']} loaded, {stats['from_state']} unchanged (from state)")
+    for task in EVAL_TASKS:
+        if task not in metrics:
+            continue
+        task_metrics = metrics[task]
+        distribution = ", ".join(f"{level} {share:.2%}" for level, share
+                                 in task_metrics["accuracy_distribution"].items())
+        print(f"[{task}] outputs: {task_metrics['outputs']}, "
+              f"hallucination rate: {task_metrics['hallucination_rate']:.2%}, "
+              f"accuracy: {distribution}")
+    print(f"Overall hallucination rate: {metrics['overall']['hallucination_rate']:.2%} "
+          f"({metrics['overall']['patients_with_hallucination']} patient(s) with hallucinations)")
+    return {"metrics": metrics, "stats": stats}
@@ -0,0 +1,138 @@
+"""Runs the independent subskills of a skill as parallel graph branches that see only
+the patient documents, joined without a model call (see the fanout block in
+agent_config.yaml)."""
+
+import re
+from typing import Annotated, Any, Optional, TypedDict
+
+from langchain.agents.middleware import AgentMiddleware, hook_config
+from langchain_core.messages import AIMessage, AnyMessage, HumanMessage, ToolMessage
+from langchain_core.runnables import Runnable, RunnableConfig, RunnableLambda
+from langgraph.graph import END, START, StateGraph
+from langgraph.graph.message import add_messages
+
+
+SUBSKILL_HEADING = re.compile(r"^## Subskill (\d+): (.+)$")
+SUBSKILL_REFERENCE = re.compile(r"Subskill (\d+)")
+# sections that describe the sequential workflow; the graph replaces them
+SEQUENTIAL_SECTIONS = ("## Architecture", "## Final Step")
+WRITER_TOOLS = frozenset({"json_writer", "text_writer"})
+
+
+def split_skill(skill_text: str) -> tuple[str, dict[int, tuple[str, str]]]:
+    """Splits a skill file at its H2 sections into the shared text and
+    {subskill number: (title, section text)}."""
+    shared, subskills = [], {}
+    for section in re.split(r"(?m)^(?=## )", skill_text):
+        heading = section.split("\n", 1)[0].strip()
+        match = SUBSKILL_HEADING.match(heading)
+        if match:
+            subskills[int(match.group(1))] = (match.group(2).strip(), section)
+        elif not heading.startswith(SEQUENTIAL_SECTIONS):
+            shared.append(section)
+    return "".join(shared), subskills
+
+
+def branch_skills(skill_text: str) -> dict[str, str]:
+    """The skill text of every branch, keyed by node name (e.g.
+    subskill_2_treatment_recommendation); empty for skills with fewer than
+    two subskills."""
+    shared, subskills = split_skill(skill_text)
+    if len(subskills) < 2:
+        return {}
+    branches = {}
+    for number, (title, section) in sorted(subskills.items()):
+        references = sorted({int(ref) for ref in SUBSKILL_REFERENCE.findall(section)}
+                            & set(subskills) - {number})
+        scope = (
+            f"## Branch Scope\n"
+            f"This run is one of {len(subskills)} parallel branches of the skill, each "
+            f"performing one subskill. Perform ONLY Subskill {number} ({title}) and write "
+            f"its output file with the required tool call; the branch ends once the file "
+            f"is written. The other subskills and the execution summary are handled "
+            f"by the other branches: do not perform them, and ignore instructions to "
+            f"produce their files.")
+        if references:
+            scope += (" " + ", ".join(f"Subskill {ref}" for ref in references)
+                      + " is included only for the rules it defines.")
+        parts = [shared.rstrip("\n -") + "\n\n---\n\n"]
+        parts.extend(subskills[ref][1] for ref in references)
+        parts.extend([section, scope + "\n"])
+        node_name = re.sub(r"\W+", "_", f"subskill_{number}_{title}".lower()).strip("_")
+        branches[node_name] = "".join(parts)
+    return branches
+
+
+class BranchDoneMiddleware(AgentMiddleware):
+    """Ends a branch once its output is written: when the latest tool
+    results are all successful writer calls, the closing model turn (a
+    one-line confirmation nobody reads) is skipped."""
+
+    @hook_config(can_jump_to=["end"])
+    def before_model(self, state: dict, runtime: Any) -> Optional[dict]:
+        results = []
+        for message in reversed(state["messages"]):
+            if not isinstance(message, ToolMessage):
+                break
+            results.append(message)
+        if results and all(message.name in WRITER_TOOLS and message.status != "error"
+                           for message in results):
+            return {"jump_to": "end"}
+        return None
+
+
+def _merge(left: dict, right: dict) -> dict:
+    return {**left, **right}
+
+
+class FanoutState(TypedDict):
+    messages: Annotated[list[AnyMessage], add_messages]
+    branches: Annotated[dict, _merge]
+
+
+def _branch_inputs(state: FanoutState) -> dict:
+    """a branch only sees the latest user message (the patient documents)."""
+    human = [message for message in state["messages"] if isinstance(message, HumanMessage)]
+    return {"messages": human[-1:]}
+
+
+def _branch_update(name: str, inputs: dict, result: dict) -> dict:
+    new_messages = result["messages"][len(inputs["messages"]):]
+    written = [message.content for message in new_messages
+               if isinstance(message, ToolMessage) and message.status != "error"]
+    return {"messages": new_messages, "branches": {name: {"tool_results": written}}}
+
+
+def branch_node(name: str, agent: Runnable) -> Runnable:
+    """runs one branch agent as a node (sync and async)."""
+    def run(state: FanoutState, config: RunnableConfig) -> dict:
+        inputs = _branch_inputs(state)
+        return _branch_update(name, inputs, agent.invoke(inputs, config))
+
+    async def arun(state: FanoutState, config: RunnableConfig) -> dict:
+        inputs = _branch_inputs(state)
+        return _branch_update(name, inputs, await agent.ainvoke(inputs, config))
+
+    return RunnableLambda(run, afunc=arun, name=name)
+
+
+def join_branches(state: FanoutState) -> dict:
+    """the execution summary: what every branch wrote."""
+    lines = []
+    for name, branch in sorted(state["branches"].items()):
+        results = "; ".join(branch["tool_results"]) or "no file written"
+        lines.append(f"- {name}: {results}")
+    return {"messages": [AIMessage(
+        content="All subskills finished in parallel branches:\n" + "\n".join(lines))]}
+
+
+def build_fanout_graph(branches: dict[str, Runnable], name: Any = None):
+    """START fans out to every branch agent; join runs once all are done."""
+    graph = StateGraph(FanoutState)
+    for node_name, agent in branches.items():
+        graph.add_node(node_name, branch_node(node_name, agent))
+        graph.add_edge(START, node_name)
+    graph.add_node("join", join_branches)
+    graph.add_edge(list(branches), "join")
+    graph.add_edge("join", END)
+    return graph.compile(name=name)
@@ -0,0 +1,212 @@
+"""Deterministic citation check of the clinical_insights_skill outputs: every sentence
+is scored against the note lines it cites, and with grounding_check enabled only
+patients at or above risk_threshold go to the clinical_judge_skill."""
+
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+import local_tools
+from long_notes import CITATION_MARKER, INSUFFICIENT_SUPPORT
+from output_sink import OutputSink
+
+
+CHECKED_OUTPUTS = (("treatment_recommendation", "recommended_treatment"),
+                   ("clinical_summary", "summary"))
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:\.[0-9]+)?")
+SENTENCE_PATTERN = re.compile(r"(?<=[.!?\]])\s+(?=[A-Z0-9])")
+STOPWORDS = frozenset("""
+a an and are as at be been being but by for from had has have he her his if in into is it
+its of on or she that the their them then there these they this to was were which while
+who will with patient patients also after before during not no than other over under
+""".split())
+
+
+def content_tokens(text: str) -> list[str]:
+    """lower-cased words and numbers without stopwords and 1-2 letter words."""
+    return [token for token in TOKEN_PATTERN.findall(text.lower())
+            if token not in STOPWORDS and (len(token) > 2 or token[0].isdigit())]
+
+
+def is_number(token: str) -> bool:
+    return token[0].isdigit()
+
+
+class NoteIndex:
+    """Content tokens and token bigrams per note line and for the note."""
+    __slots__ = ("line_tokens", "line_bigrams", "note_tokens")
+
+    def __init__(self, note: str):
+        self.line_tokens, self.line_bigrams = [], []
+        for line in note.split("\n"):
+            tokens = content_tokens(line)
+            self.line_tokens.append(frozenset(tokens))
+            self.line_bigrams.append(frozenset(zip(tokens, tokens[1:])))
+        self.note_tokens = frozenset().union(*self.line_tokens)
+
+    @property
+    def num_lines(self) -> int:
+        return len(self.line_tokens)
+
+    def span(self, line_start: int, line_end: int) -> tuple[frozenset, frozenset]:
+        """tokens and bigrams of the (1-based, inclusive) line range."""
+        return (frozenset().union(*self.line_tokens[line_start - 1:line_end]),
+                frozenset().union(*self.line_bigrams[line_start - 1:line_end]))
+
+
+def _citation_spans(citations: Any, index: NoteIndex) -> tuple[dict, list[dict]]:
+    """{citation number: (line_start, line_end)} of the valid citations and
+    the issues of the others."""
+    spans, issues = {}, []
+    for citation in citations if isinstance(citations, list) else []:
+        number = str(citation.get("citation_number")) if isinstance(citation, dict) else None
+        try:
+            line_start, line_end = int(citation["line_start"]), int(citation["line_end"])
+        except (KeyError, TypeError, ValueError):
+            issues.append({"type": "malformed_citation", "citation": number})
+            continue
+        if not 1 <= line_start <= line_end <= index.num_lines:
+            issues.append({"type": "out_of_range", "citation": number,
+                           "lines": [line_start, line_end], "num_lines": index.num_lines})
+            continue
+        spans[number] = (line_start, line_end)
+    return spans, issues
+
+
+def check_output(output: Any, text_key: str, index: NoteIndex,
+                 min_overlap: float = 0.3) -> dict:
+    """Checks the citations of one output; returns its risk and issues."""
+    if not isinstance(output, dict) or not isinstance(output.get(text_key), str):
+        return {"risk": 1.0, "sentences": 0, "issues": [{"type": "invalid_output"}]}
+    text = output[text_key].strip()
+    if text == INSUFFICIENT_SUPPORT:
+        # nothing is claimed
+        return {"risk": 0.0, "sentences": 0, "issues": []}
+    spans, issues = _citation_spans(output.get("citations"), index)
+    cited_numbers = {str(citation.get("citation_number")) for citation
+                     in output.get("citations") or [] if isinstance(citation, dict)}
+
+    risks = []
+    for number, sentence in enumerate(SENTENCE_PATTERN.split(text)):
+        markers = CITATION_MARKER.findall(sentence)
+        tokens = set(content_tokens(CITATION_MARKER.sub(" ", sentence)))
+        if not tokens:
+            continue
+        risk, issue = 0.0, None
+        novel_numbers = sorted(token for token in tokens
+                               if is_number(token) and token not in index.note_tokens)
+        if any(marker not in spans for marker in markers):
+            risk, issue = 1.0, {"type": "invalid_citation", "citations": [
+                marker for marker in markers if marker not in spans]}
+        elif novel_numbers:
+            risk, issue = 1.0, {"type": "number_not_in_note", "numbers": novel_numbers}
+        elif not markers:
+            risk, issue = 0.5, {"type": "uncited"}
+        else:
+            cited_tokens, cited_bigrams = set(), set()
+            for marker in markers:
+                span_tokens, span_bigrams = index.span(*spans[marker])
+                cited_tokens |= span_tokens
+                cited_bigrams |= span_bigrams
+            unigram = len(tokens & cited_tokens) / len(tokens)
+            ordered = content_tokens(CITATION_MARKER.sub(" ", sentence))
+            bigrams = set(zip(ordered, ordered[1:]))
+            bigram = len(bigrams & cited_bigrams) / len(bigrams) if bigrams else unigram
+            overlap = (unigram + bigram) / 2
+            if overlap < min_overlap:
+                unsupported = 1 - len(tokens & index.note_tokens) / len(tokens)
+                risk = round(0.5 + 0.5 * unsupported, 3)
+                issue = {"type": "low_overlap", "overlap": round(overlap, 3),
+                         "not_in_note": round(unsupported, 3)}
+        if issue is not None:
+            issues.append({"sentence": number, **issue})
+        risks.append(risk)
+
+    if not risks:
+        issues.append({"type": "no_content"})
+        risks.append(1.0)
+    unused = sorted(cited_numbers - set(CITATION_MARKER.findall(text)) - {"None"})
+    if unused:
+        # informational: an unused citation does not support anything
+        issues.append({"type": "unused_citations", "citations": unused})
+    return {"risk": max(risks), "mean_risk": round(sum(risks) / len(risks), 3),
+            "sentences": len(risks), "issues": issues}
+
+
+def check_patient(note: str, outputs: dict, min_overlap: float = 0.3) -> dict:
+    """Checks both insights outputs of a patient; outputs maps the artifact
+    names (treatment_recommendation, clinical_summary) to their values."""
+    index = NoteIndex(note)
+    report = {"num_lines": index.num_lines}
+    for artifact, text_key in CHECKED_OUTPUTS:
+        if outputs.get(artifact) is None:
+            report[artifact] = {"risk": 1.0, "sentences": 0,
+                                "issues": [{"type": "missing_output"}]}
+        else:
+            report[artifact] = check_output(outputs[artifact], text_key, index, min_overlap)
+    report["risk"] = max(report[artifact]["risk"] for artifact, _ in CHECKED_OUTPUTS)
+    return report
+
+
+def check_patients(patient_id_list: list[int], sink: OutputSink, output_base_path: str,
+                   data_base_path: str, min_overlap: float = 0.3,
+                   max_workers: int = 8, chunk_size: int = 500) -> dict[int, dict]:
+    """Checks a cohort: the outputs are read through the sink in chunks and
+    the notes from the corpus (or text files) of data_base_path."""
+    def check_chunk(patient_ids: list[int]) -> dict:
+        filenames = {patient_id: {artifact: f"pid{patient_id:04d}_{artifact}.json"
+                                  for artifact, _ in CHECKED_OUTPUTS}
+                     for patient_id in patient_ids}
+        values = sink.read_many(output_base_path, [
+            filename for names in filenames.values() for filename in names.values()])
+        reports = {}
+        for patient_id in patient_ids:
+            note = local_tools.load_patient_data(
+                patient_id, base_path=data_base_path, line_numbers=False)["note"]
+            reports[patient_id] = check_patient(
+                note, {artifact: values.get(filename)
+                       for artifact, filename in filenames[patient_id].items()},
+                min_overlap)
+            reports[patient_id]["patient_id"] = patient_id
+        return reports
+
+    chunks = [patient_id_list[start:start + chunk_size]
+              for start in range(0, len(patient_id_list), chunk_size)]
+    reports = {}
+    if len(chunks) <= 1 or max_workers <= 1:
+        for chunk in chunks:
+            reports.update(check_chunk(chunk))
+        return reports
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for result in executor.map(check_chunk, chunks):
+            reports.update(result)
+    return reports
+
+
+def report_filename(patient_id: int) -> str:
+    return f"pid{patient_id:04d}_grounding_check.json"
+
+
+def write_reports(reports: dict[int, dict], sink: OutputSink, output_base_path: str) -> None:
+    """writes pid####_grounding_check.json for every report."""
+    sink.write_many([(output_base_path, report_filename(patient_id),
+                      report, "grounding_check") for patient_id, report in reports.items()])
+
+
+def select_for_judge(reports: dict[int, dict], risk_threshold: float) -> list[int]:
+    """the patients whose outputs the LLM judge still has to assess."""
+    return [patient_id for patient_id, report in reports.items()
+            if report["risk"] >= risk_threshold]
+
+
+def grounding_summary(reports: dict[int, dict]) -> dict:
+    """mean risk and issue counts over a cohort."""
+    risks = sorted(report["risk"] for report in reports.values())
+    summary = {"patients": len(risks),
+               "mean_risk": round(sum(risks) / len(risks), 4) if risks else 0.0,
+               "issues": {}}
+    for report in reports.values():
+        for artifact, _ in CHECKED_OUTPUTS:
+            for issue in report[artifact]["issues"]:
+                summary["issues"][issue["type"]] = summary["issues"].get(issue["type"], 0) + 1
+    return summary
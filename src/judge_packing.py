@@ -0,0 +1,158 @@
+"""Packs several patients into one clinical_judge_skill request, routes the written
+evaluations back to each patient and judges the unroutable ones one by one (see the
+judge_packing block in agent_config.yaml)."""
+
+import uuid
+import asyncio
+
+import local_tools
+from long_notes import estimate_tokens
+from output_sink import MemorySink, parse_artifact_name
+from usage import UsageLedger
+from utils import DotDict
+
+
+EVAL_TASKS = ("treatment_plan", "summarization")
+
+
+def eval_filename(patient_id: int, task: str) -> str:
+    return f"pid{patient_id:04d}_eval_{task}.json"
+
+
+def pack_documents(documents: list[tuple[int, str]], max_input_tokens: int,
+                   max_patients: int) -> list[list[tuple[int, str]]]:
+    """Groups (patient_id, documents_xml) pairs, in order, into packs of at
+    most max_patients and max_input_tokens (a larger patient gets its own
+    pack)."""
+    packs, current, current_tokens = [], [], 0
+    for patient_id, documents_xml in documents:
+        tokens = estimate_tokens(documents_xml)
+        if current and (current_tokens + tokens > max_input_tokens
+                        or len(current) >= max_patients):
+            packs.append(current)
+            current, current_tokens = [], 0
+        current.append((patient_id, documents_xml))
+        current_tokens += tokens
+    if current:
+        packs.append(current)
+    return packs
+
+
+def packed_user_message(pack: list[tuple[int, str]]) -> str:
+    """the user message of a pack: an instruction and the <documents> blocks."""
+    patient_ids = ", ".join(str(patient_id) for patient_id, _ in pack)
+    header = (
+        f"The {len(pack)} <documents> blocks below belong to {len(pack)} different "
+        f"patients (patient_id {patient_ids}). Run the full execution flow separately "
+        f"for every block, using only that block's data, and write the evaluation files "
+        f"of each patient with the patient_id of its block.\n")
+    return header + "".join(documents_xml for _, documents_xml in pack)
+
+
+def route_outputs(patient_ids: list[int], artifacts: dict) -> tuple[dict, list[int]]:
+    """Maps the evaluations written by a pack to their output filenames.
+
+    An evaluation is routed by its patient_id and evaluation_task; one that
+    contradicts the patient id of its filename, or a second one for the same
+    patient and task, makes that patient fall back. Returns the routed
+    {filename: evaluation} and the patient ids that need a single-patient
+    run."""
+    routed, conflicts = {}, set()
+    for filename, value in artifacts.items():
+        if not isinstance(value, dict):
+            continue
+        try:
+            patient_id = int(value.get("patient_id"))
+        except (TypeError, ValueError):
+            continue
+        task = value.get("evaluation_task")
+        if patient_id not in patient_ids or task not in EVAL_TASKS:
+            continue
+        filename_patient_id, _ = parse_artifact_name(filename)
+        if filename_patient_id not in (None, patient_id) or (patient_id, task) in routed:
+            conflicts.add(patient_id)
+        routed[(patient_id, task)] = value
+
+    failed = [patient_id for patient_id in patient_ids
+              if patient_id in conflicts
+              or any((patient_id, task) not in routed for task in EVAL_TASKS)]
+    return ({eval_filename(patient_id, task): value
+             for (patient_id, task), value in routed.items() if patient_id not in failed},
+            failed)
+
+
+async def arun_pack(agent, pack: list[tuple[int, str]], name: str,
+                    metadata: dict, stream_mode: str = "updates") -> tuple[UsageLedger, list[int]]:
+    """Judges one pack; returns its ledger and the patients to run again."""
+    patient_ids = [patient_id for patient_id, _ in pack]
+    output_base_path = metadata["output_base_path"]
+    # the usage of a pack is shared by its patients
+    ledger = agent.new_ledger(stream_mode, {**metadata, "patient_id": patient_ids})
+    with local_tools.capture_artifacts() as artifacts:
+        await agent.astream_local(
+            packed_user_message(pack), f"judge_{name}_session",
+            stream_mode=stream_mode, metadata=metadata, verbose=False, ledger=ledger,
+            output_sink=MemorySink())
+
+    sink = agent.output_sink
+    routed, failed = route_outputs(patient_ids, artifacts)
+    for filename, value in routed.items():
+        sink.write(output_base_path, filename, value, skill=metadata.get("skill_name"))
+        local_tools.record_artifact(filename, value)
+    return ledger, failed
+
+
+async def arun_packed_judge(agent, documents: list[tuple[int, str]], metadata: dict,
+                            settings: DotDict,
+                            stream_mode: str = "updates"
+                            ) -> tuple[dict[str, UsageLedger], dict[int, UsageLedger]]:
+    """Runs the judge over packs of patients (up to settings.max_concurrency
+    packs at a time) with single-patient fallbacks. Returns the ledgers of
+    the requests by name (<run>_pack_#### for packs, pid#### for single
+    runs) and one ledger per patient: its share of its pack plus its own
+    fallback run."""
+    packs = pack_documents(documents, settings.max_input_tokens, settings.max_patients)
+    documents_by_id = dict(documents)
+    semaphore = asyncio.Semaphore(settings.max_concurrency)
+    # packs of concurrent or repeated runs do not share a session
+    run_id = uuid.uuid4().hex[:8]
+    ledgers = {}
+
+    async def run_single(patient_id: int) -> None:
+        patient_metadata = {**metadata, "patient_id": patient_id}
+        async with semaphore:
+            ledgers[f"pid{patient_id:04d}"] = await agent.astream_local(
+                documents_by_id[patient_id],
+                f"patient_{patient_id:04d}_{metadata.get('skill_name')}_session",
+                stream_mode=stream_mode, metadata=patient_metadata, verbose=False,
+                ledger=agent.new_ledger(stream_mode, patient_metadata))
+
+    async def run_pack(index: int, pack: list[tuple[int, str]]) -> None:
+        if len(pack) == 1:
+            await run_single(pack[0][0])
+            return
+        name = f"{run_id}_pack_{index:04d}"
+        async with semaphore:
+            ledgers[name], failed = await arun_pack(agent, pack, name, metadata, stream_mode)
+        if failed:
+            print(f"[judge packing] pack {index}: single-patient fallback for {failed}")
+        await asyncio.gather(*(run_single(patient_id) for patient_id in failed))
+
+    await asyncio.gather(*(run_pack(index, pack) for index, pack in enumerate(packs)))
+    print(f"[judge packing] {len(documents)} patients in {len(packs)} requests")
+
+    patient_ledgers = {}
+    for index, pack in enumerate(packs):
+        ledger = ledgers.get(f"{run_id}_pack_{index:04d}")
+        if ledger is not None:
+            patient_ledgers.update(ledger.split(
+                {patient_id: estimate_tokens(documents_xml) for patient_id, documents_xml in pack}))
+    for patient_id, _ in documents:
+        single = ledgers.get(f"pid{patient_id:04d}")
+        if single is None:
+            continue
+        if patient_id in patient_ledgers:
+            patient_ledgers[patient_id].merge(single)
+        else:
+            patient_ledgers[patient_id] = single
+    return ledgers, patient_ledgers
@@ -1,12 +1,42 @@
 
 import os
 import json
-import git
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Optional
 from typing_extensions import Annotated
 from langchain.tools import tool, ToolException
 from langgraph.prebuilt import InjectedState
 from langchain_core.runnables import RunnableConfig
 
+from corpus import add_line_numbers, open_corpus
+from output_sink import get_output_sink
+from tracing import span, traced
+
+
+# when set (see capture_artifacts), the writer tools also record what they
+# wrote, keyed by filename, so callers can use outputs without re-reading them.
+captured_artifacts: ContextVar[Optional[dict]] = ContextVar(
+    "captured_artifacts", default=None)
+
+
+@contextmanager
+def capture_artifacts() -> Iterator[dict]:
+    """Collects the artifacts written by json_writer / text_writer in this
+    context: {filename: decoded JSON object or text}."""
+    artifacts = {}
+    token = captured_artifacts.set(artifacts)
+    try:
+        yield artifacts
+    finally:
+        captured_artifacts.reset(token)
+
+
+def record_artifact(filename: str, value) -> None:
+    artifacts = captured_artifacts.get()
+    if artifacts is not None:
+        artifacts[filename] = value
+
 
 @tool
 def json_writer(json_string: str, filename: str, config: RunnableConfig) -> str:
@@ -17,28 +47,33 @@ def json_writer(json_string: str, filename: str, config: RunnableConfig) -> str:
         config: RunnableConfig : The runnable config containing metadata such as output_base_path (injected automatically by langgraph - do not fabricate)
     """
     try:
-        output_base_path = config.get("configurable", {}).get("output_base_path")
+        configurable = config.get("configurable", {})
+        output_base_path = configurable.get("output_base_path")
         filepath = os.path.join(output_base_path, filename)
-        print(f"\n\n***** json_writer: Writing JSON string to {filepath}\n\n\n")
-        
-        # Fix incomplete JSON by counting and completing braces
-        json_string = json_string.strip()
+        with span("json_writer.print", "console"):
+            print(f"\n\n***** json_writer: Writing JSON string to {filepath}\n\n\n")
         
-        # Count opening and closing braces
-        open_braces = json_string.count('{')
-        close_braces = json_string.count('}')
-        missing_braces = open_braces - close_braces
-        
-        # Add missing closing braces
-        if missing_braces > 0:
-            json_string += '}' * missing_braces
-        
-        decoder = json.JSONDecoder()
-        obj, idx = decoder.raw_decode(json_string)
+        with span("json_writer.repair_decode", "tool", chars=len(json_string)):
+            # Fix incomplete JSON by counting and completing braces
+            json_string = json_string.strip()
+
+            # Count opening and closing braces
+            open_braces = json_string.count('{')
+            close_braces = json_string.count('}')
+            missing_braces = open_braces - close_braces
+
+            # Add missing closing braces
+            if missing_braces > 0:
+                json_string += '}' * missing_braces
+
+            decoder = json.JSONDecoder()
+            obj, idx = decoder.raw_decode(json_string)
         
-        with open(filepath, 'w') as f:
-            json.dump(obj, f, indent=4)
-        return f"Data written to {filepath}"
+        with span("json_writer.write", "io"):
+            location = get_output_sink().write(
+                output_base_path, filename, obj, skill=configurable.get("skill_name"))
+        record_artifact(filename, obj)
+        return f"Data written to {location}"
     except json.JSONDecodeError as e:
         raise ToolException(f"json_writer error: Invalid JSON - {e}. String: {json_string[:500]}")
     except Exception as e:
@@ -65,17 +100,20 @@ def text_writer(content: str, filename: str, config: RunnableConfig) -> str:
         config: RunnableConfig : The runnable config containing metadata such as output_base_path (injected automatically by langgraph - do not fabricate)
     """
     try:
-        output_base_path = config.get("configurable", {}).get("output_base_path")
-        filepath = os.path.join(output_base_path, filename)
-        with open(filepath, 'w') as file:
-            file.write(content)
-        return f"Text written to {filepath}"
+        configurable = config.get("configurable", {})
+        with span("text_writer.write", "io", chars=len(content)):
+            location = get_output_sink().write(
+                configurable.get("output_base_path"), filename, content,
+                skill=configurable.get("skill_name"))
+        record_artifact(filename, content)
+        return f"Text written to {location}"
     except ToolException as e:
         raise ToolException(f"text_writer error: {e}")
 
 @tool
 def git_cloner(repo_url: str, clone_path: str) -> str:
     """Clones a Git repository to a specified path."""
+    import git  # GitPython is slow to import and only needed here
     git.Repo.clone_from(repo_url, clone_path)
     return f"Repository cloned to {clone_path}"
 
@@ -93,15 +131,14 @@ def get_metadata_from_state(state: dict, key: str) -> dict:
                 return metadata
     
 
-def add_line_numbers(text: str) -> str:
-    """Adds line numbers to each line in the given text."""
-    lines = text.split('\n')
-    numbered_lines = [f"{i + 1}: {line}" for i, line in enumerate(lines)]
-    return '\n'.join(numbered_lines)
-
-
+@traced("io")
 def load_patient_data(patient_id: int, base_path: str = ".", line_numbers: bool = True) -> dict:
-    """Loads patient data from text files."""
+    """Loads patient data from the packed corpus in base_path if it has the
+    patient (see corpus.py), otherwise from the per-patient text files."""
+    with open_corpus(base_path) as corpus:
+        if corpus is not None and patient_id in corpus:
+            return corpus.load(patient_id, line_numbers=line_numbers)
+
     patient_id_str = f"pid{int(patient_id):04d}"
     note_fp = os.path.join(base_path, f"{patient_id_str}_note.txt")
     question_fp = os.path.join(base_path, f"{patient_id_str}_question.txt")
@@ -127,6 +164,7 @@ def load_patient_data(patient_id: int, base_path: str = ".", line_numbers: bool
     }
 
 
+@traced("xml")
 def create_xml_document(data: dict, root_tag: str="documents") -> str:
     """Creates a simple XML document from a dictionary."""
     xml_content = f"\n<{root_tag}>\n"
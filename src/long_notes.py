@@ -0,0 +1,197 @@
+"""Map-reduce over line-aligned chunks of long notes for the clinical_insights_skill:
+the chunk outputs are kept in memory and merged, with the citations renumbered (see
+the long_notes block in agent_config.yaml)."""
+
+import os
+import re
+import json
+import asyncio
+from typing import Optional
+
+from langchain_core.messages import HumanMessage
+
+import local_tools
+from output_sink import MemorySink
+from usage import UsageLedger
+from utils import DotDict
+
+
+INSUFFICIENT_SUPPORT = "INSUFFICIENT_CITABLE_SUPPORT"
+CITATION_MARKER = re.compile(r"\[(\d+)\]")
+
+
+def estimate_tokens(text: str) -> int:
+    """rough token estimate (~4 characters per token)."""
+    return len(text) // 4
+
+
+def is_long_note(numbered_note: str, settings: Optional[DotDict]) -> bool:
+    """whether the note should go through map-reduce processing."""
+    return bool(settings and settings.enabled
+                and estimate_tokens(numbered_note) > settings.token_threshold)
+
+
+def chunk_numbered_note(numbered_note: str, chunk_tokens: int) -> list[str]:
+    """Splits a line-numbered note into chunks of whole lines of at most
+    chunk_tokens each (a single longer line becomes its own chunk)."""
+    chunks, current, current_tokens = [], [], 0
+    for line in numbered_note.split("\n"):
+        line_tokens = estimate_tokens(line) + 1
+        if current and current_tokens + line_tokens > chunk_tokens:
+            chunks.append("\n".join(current))
+            current, current_tokens = [], 0
+        current.append(line)
+        current_tokens += line_tokens
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+def github_anchor(heading: str) -> str:
+    """GitHub-style anchor, as required by the Document Structure subskill."""
+    anchor = re.sub(r"[^\w\- ]", "", heading.strip().lower())
+    return anchor.replace(" ", "-")
+
+
+def merge_toc_markdown(chunk_markdowns: list[str]) -> str:
+    """Concatenates the H2 sections of the chunk documents (dropping their
+    titles and tables of contents) and rebuilds one table of contents. A
+    chunk's first section continues the previous chunk's last section when
+    both have the same heading."""
+    sections = []
+    for markdown in chunk_markdowns:
+        current = None
+        for line in markdown.split("\n"):
+            if line.startswith("## "):
+                heading = line[3:].strip()
+                if heading == "Table of Contents":
+                    current = None
+                elif current is None and sections and sections[-1][0][3:].strip() == heading:
+                    # a section cut by a chunk boundary continues
+                    current = sections[-1]
+                else:
+                    current = [line]
+                    sections.append(current)
+            elif current is not None:
+                current.append(line)
+
+    seen, toc = {}, []
+    for section in sections:
+        heading = section[0][3:].strip()
+        anchor = github_anchor(heading)
+        seen[anchor] = seen.get(anchor, 0) + 1
+        if seen[anchor] > 1:
+            anchor = f"{anchor}-{seen[anchor]}"
+        toc.append(f"- [{heading}](#{anchor})")
+
+    body = "\n".join("\n".join(section).rstrip() + "\n" for section in sections)
+    return "# Patient Notes\n\n## Table of Contents\n" + "\n".join(toc) + "\n\n" + body
+
+
+def merge_cited_outputs(parts: list[dict], text_key: str) -> dict:
+    """Combines partial outputs of one artifact, renumbering the inline
+    citation markers; identical citations (same section and lines) share a
+    number."""
+    parts = [part for part in parts
+             if part.get(text_key) and part[text_key] != INSUFFICIENT_SUPPORT]
+    if not parts:
+        return {text_key: INSUFFICIENT_SUPPORT, "citations": []}
+
+    citations, numbers, texts = [], {}, []
+    for part in parts:
+        renumber = {}
+        for citation in part.get("citations", []):
+            key = (citation.get("section"), str(citation.get("line_start")),
+                   str(citation.get("line_end")))
+            if key not in numbers:
+                numbers[key] = str(len(citations) + 1)
+                citations.append({**citation, "citation_number": numbers[key]})
+            renumber[str(citation.get("citation_number"))] = numbers[key]
+        texts.append(CITATION_MARKER.sub(
+            lambda match: f"[{renumber.get(match.group(1), match.group(1))}]",
+            part[text_key]))
+    return {**parts[0], text_key: " ".join(texts), "citations": citations}
+
+
+def valid_cited_output(output: dict, text_key: str) -> bool:
+    """every inline marker must refer to an entry of the citations list."""
+    if not isinstance(output, dict) or not isinstance(output.get(text_key), str):
+        return False
+    numbers = {str(c.get("citation_number")) for c in output.get("citations", [])}
+    markers = set(CITATION_MARKER.findall(output[text_key]))
+    return bool(markers) and markers <= numbers
+
+
+async def condense_output(agent, merged: dict, text_key: str, ledger: UsageLedger,
+                          metadata: Optional[dict] = None) -> dict:
+    """Asks the model to condense a combined output; keeps the combined
+    output if the answer is not a valid cited JSON object."""
+    prompt = (
+        f"The JSON below was assembled from partial results over consecutive "
+        f"parts of one patient's notes. Rewrite `{text_key}` into one concise, "
+        f"non-redundant text. Keep every sentence cited with the existing "
+        f"[n] markers, keep only citations that are still referenced, do not "
+        f"add new facts, and keep all other fields. Return only the JSON.\n\n"
+        f"{json.dumps(merged, indent=2)}")
+    response = await agent.ainvoke_model([HumanMessage(content=prompt)], ledger, metadata)
+    text = response.text if isinstance(response.text, str) else str(response.content)
+    try:
+        condensed, _ = json.JSONDecoder().raw_decode(text[text.index("{"):])
+    except ValueError:
+        return merged
+    return condensed if valid_cited_output(condensed, text_key) else merged
+
+
+async def arun_long_note(agent, patient_data: dict, metadata: dict,
+                         settings: DotDict, stream_mode: str = "updates",
+                         ledger: Optional[UsageLedger] = None) -> UsageLedger:
+    """Runs the insights skill over the note chunks in parallel and writes
+    the merged outputs to metadata["output_base_path"]."""
+    patient_id = patient_data["patient_id"]
+    output_base_path = metadata["output_base_path"]
+    ledger = ledger or agent.new_ledger(stream_mode, metadata)
+    chunks = chunk_numbered_note(patient_data["note"], settings.chunk_tokens)
+    semaphore = asyncio.Semaphore(settings.max_parallel_chunks)
+
+    async def run_chunk(index: int, chunk: str) -> dict:
+        chunk_path = os.path.join(
+            output_base_path, ".chunks", f"pid{patient_id:04d}", f"chunk_{index:03d}")
+        documents_xml = local_tools.create_xml_document({
+            "patient_id": patient_id,
+            "notes": chunk,
+            "questions": patient_data["question"],
+        }, root_tag="documents")
+        async with semaphore:
+            with local_tools.capture_artifacts() as artifacts:
+                await agent.astream_local(
+                    documents_xml,
+                    f"patient_{patient_id:04d}_chunk_{index:03d}_session",
+                    stream_mode=stream_mode,
+                    metadata={**metadata, "output_base_path": chunk_path},
+                    verbose=False, ledger=ledger, output_sink=MemorySink())
+        return artifacts
+
+    chunk_artifacts = await asyncio.gather(
+        *(run_chunk(index, chunk) for index, chunk in enumerate(chunks)))
+
+    prefix = f"pid{patient_id:04d}"
+    toc_name = f"{prefix}_notes_with_toc.md"
+    outputs = {toc_name: merge_toc_markdown(
+        [artifacts[toc_name] for artifacts in chunk_artifacts if toc_name in artifacts])}
+    for artifact, text_key in (("treatment_recommendation", "recommended_treatment"),
+                               ("clinical_summary", "summary")):
+        filename = f"{prefix}_{artifact}.json"
+        merged = merge_cited_outputs(
+            [artifacts[filename] for artifacts in chunk_artifacts if filename in artifacts],
+            text_key)
+        merged["patient_id"] = str(patient_id)
+        if settings.llm_reduce and len(chunks) > 1 and merged["citations"]:
+            merged = await condense_output(agent, merged, text_key, ledger, metadata)
+        outputs[filename] = merged
+
+    sink = agent.output_sink
+    for filename, value in outputs.items():
+        sink.write(output_base_path, filename, value, skill=metadata.get("skill_name"))
+        local_tools.record_artifact(filename, value)
+    print(f"[long note] patient {patient_id}: {len(chunks)} chunks merged")
+    return ledger
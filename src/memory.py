@@ -0,0 +1,156 @@
+"""Persistent chat sessions on a SQLite checkpointer, with the history compacted before
+each model call to stay within max_history_tokens (see the memory block in
+agent_config.yaml)."""
+
+import os
+import zlib
+import sqlite3
+from typing import Any, Optional
+
+from langchain.agents.middleware import AgentMiddleware
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import (
+    AIMessage, BaseMessage, HumanMessage, RemoveMessage, ToolMessage)
+from langchain_core.messages.utils import count_tokens_approximately
+from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+from langgraph.checkpoint.sqlite import SqliteSaver
+from langgraph.graph.message import REMOVE_ALL_MESSAGES
+
+from utils import DotDict
+
+
+class CompressedSerializer:
+    """Checkpoint serializer that zlib-compresses the msgpack payloads of
+    the default JsonPlusSerializer (patient documents compress well)."""
+    suffix = "+zlib"
+
+    def __init__(self, level: int = 6):
+        self.level = level
+        self.serde = JsonPlusSerializer()
+
+    def dumps_typed(self, obj: Any) -> tuple[str, bytes]:
+        type_, data = self.serde.dumps_typed(obj)
+        return f"{type_}{self.suffix}", zlib.compress(data, self.level)
+
+    def loads_typed(self, data: tuple[str, bytes]) -> Any:
+        type_, payload = data
+        if type_.endswith(self.suffix):
+            type_, payload = type_[:-len(self.suffix)], zlib.decompress(payload)
+        return self.serde.loads_typed((type_, payload))
+
+
+def build_checkpointer(memory_config: DotDict) -> SqliteSaver:
+    """Creates the SQLite checkpointer described by the memory config block."""
+    os.makedirs(os.path.dirname(os.path.abspath(memory_config.path)), exist_ok=True)
+    conn = sqlite3.connect(memory_config.path, check_same_thread=False)
+    return SqliteSaver(conn, serde=CompressedSerializer())
+
+
+SUMMARY_MESSAGE_ID = "history-summary"
+
+
+def is_summary(message: BaseMessage) -> bool:
+    return isinstance(message, AIMessage) and message.id == SUMMARY_MESSAGE_ID
+
+
+def split_turns(messages: list[BaseMessage]) -> list[list[BaseMessage]]:
+    """Splits the history into turns, each starting at a human message, so
+    that an AI tool call always stays with its tool results."""
+    turns = []
+    for message in messages:
+        if isinstance(message, HumanMessage) or not turns:
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+
+class HistoryCompactionMiddleware(AgentMiddleware):
+    """Keeps the stored conversation within a token budget."""
+    def __init__(self, max_history_tokens: int = 8000, keep_last_turns: int = 2,
+                 max_tool_output_chars: int = 500,
+                 summarizer: Optional[BaseChatModel] = None):
+        super().__init__()
+        self.max_history_tokens = max_history_tokens
+        self.keep_last_turns = keep_last_turns
+        self.max_tool_output_chars = max_tool_output_chars
+        self.summarizer = summarizer
+
+    def before_model(self, state: dict, runtime: Any) -> Optional[dict]:
+        messages = state["messages"]
+        compacted = self.compact(messages)
+        if compacted is messages:
+            return None
+        return {"messages": [RemoveMessage(id=REMOVE_ALL_MESSAGES), *compacted]}
+
+    def compact(self, messages: list[BaseMessage]) -> list[BaseMessage]:
+        """Returns the compacted history (the same list if nothing changed)."""
+        summary = next((message for message in messages if is_summary(message)), None)
+        turns = split_turns([message for message in messages if not is_summary(message)])
+        changed = False
+
+        # 1. elide stale tool outputs and tool-call arguments; the first turn
+        # keeps its documents but not the arguments of its first analysis
+        for turn in turns[:-self.keep_last_turns or None]:
+            for index, message in enumerate(turn):
+                if (isinstance(message, ToolMessage)
+                        and len(str(message.content)) > self.max_tool_output_chars):
+                    turn[index] = message.model_copy(update={"content": (
+                        f"[tool output elided: {message.name}, "
+                        f"{len(str(message.content))} chars]")})
+                    changed = True
+                elif isinstance(message, AIMessage) and message.tool_calls:
+                    elided = self._elide_tool_args(message)
+                    if elided is not message:
+                        turn[index] = elided
+                        changed = True
+
+        # 2. drop (or summarize) the oldest turns beyond the budget; the first
+        # turn (documents) and the current turn are always kept.
+        dropped = []
+        while (len(turns) > 2 and count_tokens_approximately(
+                [m for turn in turns for m in turn] + ([summary] if summary else []))
+                > self.max_history_tokens):
+            dropped.extend(turns.pop(1))
+            changed = True
+        if dropped and self.summarizer is not None:
+            summary = self._summarize(dropped, summary)
+
+        if not changed:
+            return messages
+        if summary is not None:
+            turns.insert(1, [summary])
+        return [message for turn in turns for message in turn]
+
+    def _elide_tool_args(self, message: AIMessage) -> AIMessage:
+        """replaces long tool-call arguments with a placeholder (the same
+        message if none is long)."""
+        tool_calls, elided = [], False
+        for tool_call in message.tool_calls:
+            args = {}
+            for name, value in tool_call["args"].items():
+                if len(str(value)) > self.max_tool_output_chars:
+                    value = f"[argument elided: {len(str(value))} chars]"
+                    elided = True
+                args[name] = value
+            tool_calls.append({**tool_call, "args": args})
+        if not elided:
+            return message
+        # the provider's raw copy of the arguments would keep the full text
+        additional_kwargs = {key: value for key, value in message.additional_kwargs.items()
+                             if key != "tool_calls"}
+        return message.model_copy(update={
+            "tool_calls": tool_calls, "additional_kwargs": additional_kwargs})
+
+    def _summarize(self, messages: list[BaseMessage],
+                   previous: Optional[AIMessage] = None) -> AIMessage:
+        """condenses dropped turns (and the previous summary) into one message."""
+        if previous is not None:
+            messages = [previous, *messages]
+        transcript = "\n".join(
+            f"{message.type}: {message.content}" for message in messages
+            if isinstance(message, (HumanMessage, AIMessage)) and message.content)
+        summary = self.summarizer.invoke([HumanMessage(content=(
+            "Summarize this earlier part of the conversation in a few sentences, "
+            "keeping facts, decisions and file names:\n\n" + transcript))])
+        return AIMessage(content=f"[Summary of earlier conversation]\n{summary.content}",
+                         id=SUMMARY_MESSAGE_ID)
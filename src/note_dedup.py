@@ -0,0 +1,293 @@
+"""Finds near-duplicate notes in a cohort (MinHash / LSH over word 5-grams); with reuse,
+a duplicate gets its representative's outputs with the citations moved to its own
+note lines instead of a run (see the note_dedup block in agent_config.yaml)."""
+
+import copy
+import difflib
+import hashlib
+import time
+from collections import Counter
+from typing import Callable, Optional
+
+import numpy as np
+
+from output_sink import OutputSink
+from run_manifest import SKILL_OUTPUTS
+from utils import DotDict
+
+
+HASH_SHIFT = np.uint64(32)
+
+
+def normalize_line(line: str) -> str:
+    return " ".join(line.lower().split())
+
+
+def note_hash(note: str) -> str:
+    """hash of the note's words, ignoring case, whitespace and line breaks."""
+    return hashlib.sha1(" ".join(note.lower().split()).encode("utf-8")).hexdigest()
+
+
+class MinHashIndex:
+    """MinHash signatures and LSH buckets of texts, grouped by a key (the
+    question) that candidates must share.
+
+    Shingles are hashed with the built-in str hash, so signatures are only
+    comparable within one process (the index is rebuilt per run)."""
+    def __init__(self, num_perm: int = 128, bands: int = 16, shingle_words: int = 5,
+                 seed: int = 1):
+        assert num_perm % bands == 0, "num_perm must be a multiple of bands"
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_words = shingle_words
+        rng = np.random.default_rng(seed)
+        # multiply-shift hashing: (a * x + b) >> 32 with odd a, mod 2^64
+        self._a = rng.integers(1, 2**63, size=num_perm, dtype=np.uint64) | np.uint64(1)
+        self._b = rng.integers(0, 2**63, size=num_perm, dtype=np.uint64)
+        self._word_factors = rng.integers(1, 2**63, size=shingle_words, dtype=np.uint64) | np.uint64(1)
+        self.signatures: dict = {}
+        self._exact: dict[tuple, object] = {}
+        self._buckets: dict[tuple, list] = {}
+
+    def __len__(self) -> int:
+        return len(self.signatures)
+
+    def shingles(self, text: str) -> np.ndarray:
+        """unique 64-bit hashes of the word n-grams of the text."""
+        words = text.lower().split()
+        words = np.fromiter(map(hash, words), dtype=np.int64, count=len(words)).view(np.uint64)
+        n = len(words) - self.shingle_words + 1
+        if n < 1:
+            return np.unique(words) if len(words) else np.zeros(1, dtype=np.uint64)
+        hashes = words[:n] * self._word_factors[0]
+        for offset in range(1, self.shingle_words):
+            hashes += words[offset:offset + n] * self._word_factors[offset]
+        return np.unique(hashes)
+
+    def signature(self, text: str) -> np.ndarray:
+        shingles = self.shingles(text)
+        return ((np.outer(self._a, shingles) + self._b[:, None]) >> HASH_SHIFT).min(axis=1).astype(np.uint32)
+
+    def _band_keys(self, group: str, signature: np.ndarray) -> list[tuple]:
+        return [(group, band, signature[band * self.rows:(band + 1) * self.rows].tobytes())
+                for band in range(self.bands)]
+
+    def add(self, key, signature: np.ndarray, text_hash: str, group: str = "") -> None:
+        self.signatures[key] = signature
+        self._exact.setdefault((group, text_hash), key)
+        for band_key in self._band_keys(group, signature):
+            self._buckets.setdefault(band_key, []).append(key)
+
+    def exact_match(self, text_hash: str, group: str = ""):
+        """the first indexed key with the same text hash, or None."""
+        return self._exact.get((group, text_hash))
+
+    def query(self, signature: np.ndarray, group: str = "") -> list[tuple[float, object]]:
+        """(estimated Jaccard similarity, key) of the indexed texts sharing
+        an LSH band with the signature, most similar first."""
+        found = set()
+        for band_key in self._band_keys(group, signature):
+            found.update(self._buckets.get(band_key, ()))
+        if not found:
+            return []
+        keys = list(found)
+        matches = (np.stack([self.signatures[key] for key in keys]) == signature).sum(axis=1)
+        return sorted(zip((matches / self.num_perm).tolist(), keys), key=lambda item: -item[0])
+
+
+class DedupPlan:
+    """The duplicates of a cohort and the patients that still run."""
+    def __init__(self, skill_name: str, settings: DotDict):
+        self.skill_name = skill_name
+        self.settings = settings
+        self.to_run: list[int] = []
+        # duplicate -> (representative, similarity, exact)
+        self.duplicates: dict[int, tuple[int, float, bool]] = {}
+        self.num_indexed = 0
+        self.index_s = 0.0
+        self.reused: list[int] = []
+        self.fallbacks = Counter()
+
+    def report(self) -> dict:
+        representatives = {representative for representative, _, _ in self.duplicates.values()}
+        return {
+            "skill": self.skill_name,
+            "indexed": self.num_indexed,
+            "index_s": round(self.index_s, 3),
+            "groups": len(representatives),
+            "duplicates": len(self.duplicates),
+            "exact": sum(1 for _, _, exact in self.duplicates.values() if exact),
+            "reuse": bool(getattr(self.settings, "reuse", False)),
+            "runs_avoided": len(self.reused),
+            "fallbacks": dict(self.fallbacks),
+        }
+
+
+def plan_duplicates(settings: DotDict, skill_name: str, patient_id_list: list[int],
+                    to_run: list[int], load_patient: Callable[[int], dict]) -> DedupPlan:
+    """Indexes the notes of the cohort and assigns every patient of to_run
+    whose note duplicates an earlier one to its most similar representative.
+    load_patient(patient_id) returns the patient's note and question (as
+    local_tools.load_patient_data without line numbers)."""
+    plan = DedupPlan(skill_name, settings)
+    index = MinHashIndex(getattr(settings, "num_perm", 128), getattr(settings, "bands", 16))
+    threshold = settings.similarity
+    running = set(to_run)
+    # patients with outputs come first, so they are preferred as representatives
+    ordered = [patient_id for patient_id in patient_id_list if patient_id not in running]
+    ordered += to_run
+    start = time.perf_counter()
+    for patient_id in ordered:
+        patient_data = load_patient(patient_id)
+        note, group = patient_data["note"], normalize_line(patient_data["question"])
+        signature, text_hash = index.signature(note), note_hash(note)
+        plan.num_indexed += 1
+        if patient_id in running:
+            # only representatives are indexed, so buckets stay small
+            representative = index.exact_match(text_hash, group)
+            if representative is not None:
+                plan.duplicates[patient_id] = (representative, 1.0, True)
+                continue
+            matches = index.query(signature, group)
+            if matches and matches[0][0] >= threshold:
+                plan.duplicates[patient_id] = (matches[0][1], matches[0][0], False)
+                continue
+            plan.to_run.append(patient_id)
+        index.add(patient_id, signature, text_hash, group)
+    plan.index_s = time.perf_counter() - start
+    if not getattr(settings, "reuse", False):
+        plan.to_run = list(to_run)
+    return plan
+
+
+def line_map(source_note: str, target_note: str) -> tuple[dict[int, int], list[tuple]]:
+    """{source line number: target line number} of the identical lines of
+    two notes (1-based, compared normalized) and the difflib opcodes."""
+    source = [normalize_line(line) for line in source_note.split("\n")]
+    target = [normalize_line(line) for line in target_note.split("\n")]
+    matcher = difflib.SequenceMatcher(None, source, target, autojunk=False)
+    mapping = {}
+    for source_start, target_start, size in matcher.get_matching_blocks():
+        for offset in range(size):
+            mapping[source_start + offset + 1] = target_start + offset + 1
+    return mapping, matcher.get_opcodes()
+
+
+def _remap_citations(value, mapping: dict[int, int]):
+    """moves line_start / line_end of every citation; raises KeyError when
+    a cited line has no identical line in the target."""
+    if isinstance(value, list):
+        return [_remap_citations(item, mapping) for item in value]
+    if not isinstance(value, dict):
+        return value
+    span = [str(value.get(key, "")).strip() for key in ("line_start", "line_end")]
+    if all(line.isdigit() for line in span):
+        # every line of a cited range must be unchanged
+        missing = [line for line in range(int(span[0]), int(span[1]) + 1) if line not in mapping]
+        if missing:
+            raise KeyError(missing[0])
+    remapped = {}
+    for key, item in value.items():
+        if key in ("line_start", "line_end") and str(item).strip().isdigit():
+            line = mapping[int(str(item).strip())]
+            remapped[key] = line if isinstance(item, int) else str(line)
+        else:
+            remapped[key] = _remap_citations(item, mapping)
+    return remapped
+
+
+def _adapt_markdown(text: str, source_lines: list[str], target_lines: list[str],
+                    opcodes: list[tuple]) -> Optional[str]:
+    """applies the line changes of the note to its markdown rendering; None
+    when a changed line (or its anchor) is not found in the markdown."""
+    for tag, source_start, source_end, target_start, target_end in reversed(opcodes):
+        if tag == "equal":
+            continue
+        old = [line.strip() for line in source_lines[source_start:source_end] if line.strip()]
+        new = "\n".join(line.strip() for line in target_lines[target_start:target_end] if line.strip())
+        if old:
+            if any(text.count(line) != 1 for line in old):
+                return None
+            text = text.replace(old[0], new, 1)
+            for line in old[1:]:
+                text = text.replace(line + "\n", "", 1) if line + "\n" in text else text.replace(line, "", 1)
+        elif new:
+            anchors = [line.strip() for line in source_lines[:source_start] if line.strip()]
+            if not anchors or text.count(anchors[-1]) != 1:
+                return None
+            position = text.index(anchors[-1]) + len(anchors[-1])
+            text = f"{text[:position]}\n{new}{text[position:]}"
+    return text
+
+
+def _rewrite_patient_id(value, source_id: int, target_id: int):
+    if isinstance(value, str):
+        return value.replace(f"pid{source_id:04d}", f"pid{target_id:04d}")
+    if isinstance(value, list):
+        return [_rewrite_patient_id(item, source_id, target_id) for item in value]
+    if isinstance(value, dict):
+        adapted = {}
+        for key, item in value.items():
+            if key == "patient_id" and str(item).strip() == str(source_id):
+                adapted[key] = target_id if isinstance(item, int) else str(target_id)
+            else:
+                adapted[key] = _rewrite_patient_id(item, source_id, target_id)
+        return adapted
+    return value
+
+
+def adapt_outputs(source_id: int, target_id: int, outputs: dict, source_note: str,
+                  target_note: str) -> tuple[Optional[dict], Optional[str]]:
+    """the outputs of source_id ({artifact: value}) adapted to target_id's
+    note, or (None, reason) when they cannot be reused."""
+    mapping, opcodes = line_map(source_note, target_note)
+    adapted = {}
+    for artifact, value in outputs.items():
+        value = _rewrite_patient_id(copy.deepcopy(value), source_id, target_id)
+        if artifact.endswith(".md"):
+            value = _adapt_markdown(value, source_note.split("\n"), target_note.split("\n"), opcodes)
+            if value is None:
+                return None, "markdown_not_adaptable"
+        else:
+            try:
+                value = _remap_citations(value, mapping)
+            except KeyError:
+                return None, "cited_line_changed"
+        adapted[artifact] = value
+    return adapted, None
+
+
+def reuse_duplicates(plan: DedupPlan, sink: OutputSink, output_base_path: str,
+                     load_patient: Callable[[int], dict]) -> list[int]:
+    """Writes the adapted outputs of their representative for the
+    duplicates of plan (once the representatives have run); returns the
+    duplicates that have to run after all."""
+    if not getattr(plan.settings, "reuse", False):
+        return []
+    artifacts = SKILL_OUTPUTS[plan.skill_name]
+    fallback = []
+    for patient_id, (representative, similarity, exact) in plan.duplicates.items():
+        outputs = sink.read_many(output_base_path, [
+            f"pid{representative:04d}_{artifact}" for artifact in artifacts])
+        if len(outputs) < len(artifacts):
+            plan.fallbacks["representative_failed"] += 1
+            fallback.append(patient_id)
+            continue
+        adapted, reason = adapt_outputs(
+            representative, patient_id,
+            {filename.split("_", 1)[1]: value for filename, value in outputs.items()},
+            load_patient(representative)["note"], load_patient(patient_id)["note"])
+        if adapted is None:
+            plan.fallbacks[reason] += 1
+            fallback.append(patient_id)
+            continue
+        sink.write_many([
+            (output_base_path, f"pid{patient_id:04d}_{artifact}", value, plan.skill_name)
+            for artifact, value in adapted.items()])
+        sink.write(output_base_path, f"pid{patient_id:04d}_note_dedup.json", {
+            "patient_id": patient_id, "skill": plan.skill_name,
+            "source_patient_id": representative, "similarity": round(similarity, 4),
+            "exact": exact}, plan.skill_name)
+        plan.reused.append(patient_id)
+    return fallback
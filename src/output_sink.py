@@ -0,0 +1,381 @@
+"""Pluggable sink (files or sqlite, optionally write-behind) for the artifacts of
+json_writer / text_writer; the writer tools use the sink of the run that called them
+(see the output_sink block in agent_config.yaml)."""
+
+import os
+import re
+import json
+import time
+import queue
+import atexit
+import sqlite3
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Iterator, Optional
+
+from utils import DotDict
+
+
+ARTIFACT_NAME_PATTERN = re.compile(r"^pid(\d+)_(.+)$")
+
+
+def parse_artifact_name(filename: str) -> tuple[Optional[int], str]:
+    """splits pid0011_clinical_summary.json into (11, "clinical_summary.json")."""
+    match = ARTIFACT_NAME_PATTERN.match(os.path.basename(filename))
+    if match is None:
+        return None, os.path.basename(filename)
+    return int(match.group(1)), match.group(2)
+
+
+def encode_value(filename: str, value: Any) -> str:
+    """decoded JSON artifacts are stored indented (as json_writer always
+    wrote them); texts are stored as they are, whatever the filename."""
+    if isinstance(value, str):
+        return value
+    return json.dumps(value, indent=4)
+
+
+def decode_value(filename: str, data: str) -> Any:
+    """JSON artifacts are decoded; a .json text that is no JSON (e.g. from
+    text_writer) is returned as it is."""
+    if not filename.endswith(".json"):
+        return data
+    try:
+        return json.loads(data)
+    except ValueError:
+        return data
+
+
+class OutputSink:
+    """Interface shared by the backends."""
+    def write(self, base_path: str, filename: str, value: Any,
+              skill: Optional[str] = None) -> str:
+        """stores a decoded JSON object or a text; returns its location."""
+        self.write_many([(base_path, filename, value, skill)])
+        return self.location(base_path, filename)
+
+    def write_many(self, records: list[tuple]) -> None:
+        raise NotImplementedError
+
+    def read(self, base_path: str, filename: str) -> Any:
+        """returns the stored value; raises FileNotFoundError if missing."""
+        values = self.read_many(base_path, [filename])
+        if filename not in values:
+            raise FileNotFoundError(self.location(base_path, filename))
+        return values[filename]
+
+    def read_many(self, base_path: str, filenames: list[str]) -> dict:
+        """returns {filename: value} for the filenames that exist."""
+        raise NotImplementedError
+
+    def exists(self, base_path: str, filename: str) -> bool:
+        return filename in self.read_many(base_path, [filename])
+
+    def versions(self, base_path: str, filenames: list[str]) -> dict:
+        """returns {filename: version string} for the filenames that exist;
+        the version changes whenever an artifact is rewritten."""
+        raise NotImplementedError
+
+    def location(self, base_path: str, filename: str) -> str:
+        return os.path.join(base_path, filename)
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class FileSink(OutputSink):
+    """One file per artifact, replaced atomically."""
+    def write_many(self, records: list[tuple]) -> None:
+        for base_path, filename, value, _ in records:
+            filepath = os.path.join(base_path, filename)
+            tmp_fp = f"{filepath}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_fp, 'w') as f:
+                f.write(encode_value(filename, value))
+            os.replace(tmp_fp, filepath)
+
+    def read_many(self, base_path: str, filenames: list[str]) -> dict:
+        values = {}
+        for filename in filenames:
+            try:
+                with open(os.path.join(base_path, filename), 'r') as f:
+                    values[filename] = decode_value(filename, f.read())
+            except FileNotFoundError:
+                continue
+        return values
+
+    def versions(self, base_path: str, filenames: list[str]) -> dict:
+        versions = {}
+        for filename in filenames:
+            try:
+                stat = os.stat(os.path.join(base_path, filename))
+            except FileNotFoundError:
+                continue
+            versions[filename] = f"{stat.st_mtime_ns}:{stat.st_size}"
+        return versions
+
+
+class SQLiteSink(OutputSink):
+    """All artifacts in one SQLite file (table artifacts)."""
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS artifacts ("
+            " base_path TEXT NOT NULL,"
+            " filename TEXT NOT NULL,"
+            " patient_id INTEGER,"
+            " skill TEXT,"
+            " artifact TEXT NOT NULL,"
+            " value TEXT NOT NULL,"
+            " updated_at REAL NOT NULL,"
+            " PRIMARY KEY (base_path, filename))")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS artifacts_patient"
+            " ON artifacts (artifact, patient_id, skill)")
+        self._conn.commit()
+
+    def write_many(self, records: list[tuple]) -> None:
+        now = time.time()
+        rows = []
+        for base_path, filename, value, skill in records:
+            patient_id, artifact = parse_artifact_name(filename)
+            rows.append((os.path.abspath(base_path), filename, patient_id, skill,
+                         artifact, encode_value(filename, value), now))
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO artifacts"
+                " (base_path, filename, patient_id, skill, artifact, value, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self._conn.commit()
+
+    def read_many(self, base_path: str, filenames: list[str]) -> dict:
+        values = self._select(base_path, filenames, "value")
+        return {filename: decode_value(filename, data) for filename, data in values.items()}
+
+    def versions(self, base_path: str, filenames: list[str]) -> dict:
+        return {filename: repr(updated_at) for filename, updated_at
+                in self._select(base_path, filenames, "updated_at").items()}
+
+    def _select(self, base_path: str, filenames: list[str], column: str) -> dict:
+        """{filename: column value} for the stored filenames of base_path."""
+        values = {}
+        base_path = os.path.abspath(base_path)
+        with self._lock:
+            # stay below SQLite's limit on host parameters
+            for start in range(0, len(filenames), 500):
+                batch = filenames[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT filename, {column} FROM artifacts WHERE base_path = ?"
+                    f" AND filename IN ({', '.join('?' * len(batch))})",
+                    (base_path, *batch)).fetchall()
+                values.update(rows)
+        return values
+
+    def location(self, base_path: str, filename: str) -> str:
+        return f"{self.path}:{os.path.join(base_path, filename)}"
+
+    def iter_artifacts(self, artifact: Optional[str] = None,
+                       skill: Optional[str] = None) -> Iterator[dict]:
+        """yields every stored artifact (optionally one kind, e.g.
+        "clinical_summary.json") for analytics over the whole store."""
+        query = "SELECT base_path, filename, patient_id, skill, artifact, value FROM artifacts"
+        clauses, params = [], []
+        if artifact is not None:
+            clauses.append("artifact = ?")
+            params.append(artifact)
+        if skill is not None:
+            clauses.append("skill = ?")
+            params.append(skill)
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        with self._lock:
+            rows = self._conn.execute(query + " ORDER BY patient_id", params).fetchall()
+        for base_path, filename, patient_id, skill_name, artifact_name, data in rows:
+            yield {"base_path": base_path, "filename": filename, "patient_id": patient_id,
+                   "skill": skill_name, "artifact": artifact_name,
+                   "value": decode_value(filename, data)}
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class MemorySink(OutputSink):
+    """Keeps the artifacts of one run in memory, for scratch outputs that
+    are merged or routed before anything is stored (long_notes.py,
+    judge_packing.py)."""
+    def __init__(self):
+        self._values = {}
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def write_many(self, records: list[tuple]) -> None:
+        with self._lock:
+            for base_path, filename, value, _ in records:
+                self._values[(base_path, filename)] = value
+                self._versions[(base_path, filename)] = self._versions.get((base_path, filename), 0) + 1
+
+    def read_many(self, base_path: str, filenames: list[str]) -> dict:
+        with self._lock:
+            return {filename: self._values[(base_path, filename)]
+                    for filename in filenames if (base_path, filename) in self._values}
+
+    def versions(self, base_path: str, filenames: list[str]) -> dict:
+        with self._lock:
+            return {filename: str(self._versions[(base_path, filename)])
+                    for filename in filenames if (base_path, filename) in self._versions}
+
+
+class WriteBehindSink(OutputSink):
+    """Queues writes for a background thread that applies them to the
+    wrapped sink in batches. The queue is bounded (max_pending) so a slow
+    disk slows the writers down instead of growing memory."""
+    def __init__(self, sink: OutputSink, max_pending: int = 1000, max_batch: int = 64):
+        self.sink = sink
+        self.max_batch = max_batch
+        self.writes = 0
+        self.batches = 0
+        self.errors = []
+        self._queue = queue.Queue(maxsize=max_pending)
+        # (base_path, filename) -> error of its last write, until a write succeeds
+        self._failed = {}
+        # latest queued value per (base_path, filename) for read-your-writes
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._thread = threading.Thread(
+            target=self._run, name="output-sink-writer", daemon=True)
+        self._thread.start()
+
+    def write_many(self, records: list[tuple]) -> None:
+        for record in records:
+            with self._pending_lock:
+                self._pending[(record[0], record[1])] = record
+            self._queue.put(record)
+
+    def read_many(self, base_path: str, filenames: list[str]) -> dict:
+        with self._pending_lock:
+            pending = {filename: self._pending[(base_path, filename)][2]
+                       for filename in filenames if (base_path, filename) in self._pending}
+        missing = [filename for filename in filenames if filename not in pending]
+        return {**self.sink.read_many(base_path, missing), **pending}
+
+    def versions(self, base_path: str, filenames: list[str]) -> dict:
+        """the versions once the queued writes are applied; an artifact whose
+        last write failed counts as missing (its error is left to flush())."""
+        self._queue.join()
+        with self._pending_lock:
+            failed = {filename for filename in filenames if (base_path, filename) in self._failed}
+        return self.sink.versions(base_path, [f for f in filenames if f not in failed])
+
+    def location(self, base_path: str, filename: str) -> str:
+        return self.sink.location(base_path, filename)
+
+    def flush(self) -> None:
+        """waits until every queued write is applied; raises the first
+        error a background write ran into."""
+        self._queue.join()
+        if self.errors:
+            errors, self.errors = self.errors, []
+            raise RuntimeError(f"{len(errors)} output write(s) failed: {errors[0]!r}")
+
+    def close(self) -> None:
+        self.flush()
+        self.sink.close()
+
+    def __getattr__(self, name: str) -> Any:
+        # backend specific readers (e.g. SQLiteSink.iter_artifacts) see
+        # every queued write
+        attr = getattr(self.sink, name)
+        if callable(attr):
+            def flushed(*args, **kwargs):
+                self.flush()
+                return attr(*args, **kwargs)
+            return flushed
+        return attr
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            error = None
+            try:
+                self.sink.write_many(batch)
+                self.writes += len(batch)
+                self.batches += 1
+            except Exception as e:
+                error = e
+                self.errors.append(e)
+                print(f"output sink: write failed ({e})")
+            with self._pending_lock:
+                for record in batch:
+                    if error is None:
+                        self._failed.pop((record[0], record[1]), None)
+                    else:
+                        self._failed[(record[0], record[1])] = error
+                    if self._pending.get((record[0], record[1])) is record:
+                        del self._pending[(record[0], record[1])]
+            for _ in batch:
+                self._queue.task_done()
+
+
+_sinks: dict[tuple, OutputSink] = {}
+_sinks_lock = threading.Lock()
+# the sink of the agent run in this context (see sink_scope)
+current_sink: ContextVar[Optional[OutputSink]] = ContextVar("current_sink", default=None)
+
+
+def build_output_sink(sink_config: Optional[DotDict]) -> OutputSink:
+    """Returns the sink described by the output_sink config block (plain
+    synchronous files when the block is missing). Sinks are shared per
+    process, so agents built from the same config write through one queue."""
+    backend = getattr(sink_config, "backend", "files") if sink_config else "files"
+    write_behind = bool(sink_config and getattr(sink_config, "write_behind", False))
+    path = getattr(sink_config, "path", None) if backend == "sqlite" else None
+    key = (backend, path, write_behind)
+    with _sinks_lock:
+        if key not in _sinks:
+            if backend == "files":
+                sink = FileSink()
+            elif backend == "sqlite":
+                sink = SQLiteSink(path)
+            else:
+                raise ValueError(f"Unsupported output sink backend: {backend}")
+            if write_behind:
+                sink = WriteBehindSink(sink, max_pending=getattr(sink_config, "max_pending", 1000))
+            _sinks[key] = sink
+        return _sinks[key]
+
+
+@contextmanager
+def sink_scope(sink: OutputSink) -> Iterator[OutputSink]:
+    """makes the writer tools called in this context write to sink."""
+    token = current_sink.set(sink)
+    try:
+        yield sink
+    finally:
+        current_sink.reset(token)
+
+
+def get_output_sink() -> OutputSink:
+    """the sink of the current run (plain files outside of a run)."""
+    return current_sink.get() or build_output_sink(None)
+
+
+def flush_output_sinks() -> None:
+    """waits for the queued writes of every sink."""
+    for sink in list(_sinks.values()):
+        sink.flush()
+
+
+atexit.register(flush_output_sinks)
@@ -0,0 +1,270 @@
+"""Client-side token buckets, adaptive concurrency and retries with backoff for model
+calls under provider rate limits (see the rate_limit block in agent_config.yaml)."""
+
+import time
+import random
+import asyncio
+import threading
+from typing import Any, Callable, Optional
+
+from langchain.agents.middleware import AgentMiddleware
+from langchain_core.messages import AIMessage
+from langchain_core.messages.utils import count_tokens_approximately
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+from utils import DotDict
+
+
+RETRYABLE_STATUS_CODES = (408, 409, 429, 500, 502, 503, 504)
+RETRYABLE_ERROR_NAMES = ("APIConnectionError", "APITimeoutError", "ConnectError",
+                         "ReadTimeout", "RemoteProtocolError")
+
+
+class TokenBucket:
+    """Refills rate_per_minute units per minute up to capacity."""
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None):
+        self.rate_per_s = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self.level = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate_per_s)
+        self._updated = now
+
+    def reserve(self, amount: float) -> float:
+        """Takes amount from the bucket (going into debt if needed) and
+        returns how long the caller has to wait before using it."""
+        with self._lock:
+            self._refill()
+            # a request larger than the bucket still passes once it is full
+            amount = min(amount, self.capacity)
+            self.level -= amount
+            return max(0.0, -self.level / self.rate_per_s)
+
+    def refund(self, amount: float) -> None:
+        """gives back (or, if negative, takes) tokens after the fact."""
+        with self._lock:
+            self._refill()
+            self.level = min(self.capacity, self.level + amount)
+
+
+class AdaptiveLimiter:
+    """Concurrency limit with additive increase / multiplicative decrease."""
+    def __init__(self, initial: int, min_limit: int = 1, max_limit: int = 64):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            return False
+
+    def release(self, throttled: bool = False, slow: bool = False) -> None:
+        with self._lock:
+            self.in_flight -= 1
+            if throttled or slow:
+                self.limit = max(self.min_limit, self.limit / 2)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+
+def is_retryable(error: Exception) -> bool:
+    status_code = getattr(error, "status_code", None)
+    if status_code is None:
+        status_code = getattr(getattr(error, "response", None), "status_code", None)
+    return status_code in RETRYABLE_STATUS_CODES or type(error).__name__ in RETRYABLE_ERROR_NAMES
+
+
+def is_throttled(error: Exception) -> bool:
+    return (getattr(error, "status_code", None) == 429
+            or getattr(getattr(error, "response", None), "status_code", None) == 429)
+
+
+def retry_after_s(error: Exception) -> Optional[float]:
+    """the server's Retry-After (or retry-after-ms) hint, if any."""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+class RateLimitScheduler:
+    """Token buckets, adaptive concurrency and retries for model calls."""
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float,
+                 max_concurrency: int = 16, min_concurrency: int = 1,
+                 latency_target_s: float = 30.0, max_retries: int = 6,
+                 backoff_base_s: float = 1.0, backoff_max_s: float = 60.0,
+                 burst_s: float = 60.0, output_tokens: int = 0,
+                 poll_interval_s: float = 0.01):
+        # the buckets hold burst_s worth of budget (a full minute by default)
+        self.requests = TokenBucket(requests_per_minute, requests_per_minute * burst_s / 60)
+        self.tokens = TokenBucket(tokens_per_minute, tokens_per_minute * burst_s / 60)
+        self.limiter = AdaptiveLimiter(max_concurrency, min_concurrency, max_concurrency)
+        self.latency_target_s = latency_target_s
+        self.max_retries = max_retries
+        self.backoff_base_s = backoff_base_s
+        self.backoff_max_s = backoff_max_s
+        self.output_tokens = output_tokens
+        self.poll_interval_s = poll_interval_s
+        self.counters = {"calls": 0, "attempts": 0, "retries": 0, "throttled": 0,
+                         "server_errors": 0, "failed": 0, "wait_s": 0.0}
+        self._tool_tokens = {}
+        self._lock = threading.Lock()
+
+    def _count(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self.counters[name] += value
+
+    def estimate_tokens(self, messages: list, tools: list = ()) -> int:
+        """prompt tokens (approximate) plus the reserved output tokens."""
+        key = tuple(id(tool) for tool in tools)
+        if key not in self._tool_tokens:
+            self._tool_tokens[key] = len(str([convert_to_openai_tool(tool) for tool in tools])) // 4
+        return count_tokens_approximately(messages) + self._tool_tokens[key] + self.output_tokens
+
+    def _reserve(self, estimate: int) -> float:
+        return max(self.requests.reserve(1), self.tokens.reserve(estimate))
+
+    def _backoff_s(self, attempt: int, error: Exception) -> float:
+        hint = retry_after_s(error)
+        if hint is not None:
+            return hint + random.uniform(0, self.backoff_base_s)
+        return random.uniform(0, min(self.backoff_max_s, self.backoff_base_s * 2 ** attempt))
+
+    def _settle(self, estimate: int, response: Any) -> None:
+        """corrects the tokens bucket with the usage the response reports."""
+        message = response if isinstance(response, AIMessage) else next(
+            (m for m in getattr(response, "result", []) if isinstance(m, AIMessage)), None)
+        usage = getattr(message, "usage_metadata", None)
+        if usage is None:
+            return
+        # langchain zeroes the cost of responses replayed from a cache
+        used = 0 if usage.get("total_cost") == 0 else usage.get("total_tokens", estimate)
+        self.tokens.refund(estimate - used)
+        if used == 0:
+            self.requests.refund(1)
+
+    def call(self, estimate: int, fn: Callable[[], Any]) -> Any:
+        """runs a synchronous model call under the limits."""
+        self._count("calls")
+        for attempt in range(self.max_retries + 1):
+            wait_s = self._reserve(estimate)
+            if wait_s:
+                time.sleep(wait_s)
+            while not self.limiter.try_acquire():
+                time.sleep(self.poll_interval_s)
+                wait_s += self.poll_interval_s
+            self._count("wait_s", wait_s)
+            error, start = None, time.monotonic()
+            try:
+                self._count("attempts")
+                response = fn()
+            except Exception as e:
+                error = e
+            retry = self._after_attempt(error, attempt, time.monotonic() - start)
+            if error is None:
+                self._settle(estimate, response)
+                return response
+            if not retry:
+                raise error
+            time.sleep(self._backoff_s(attempt, error))
+
+    async def acall(self, estimate: int, fn: Callable[[], Any]) -> Any:
+        """runs an asynchronous model call under the limits."""
+        self._count("calls")
+        for attempt in range(self.max_retries + 1):
+            wait_s = self._reserve(estimate)
+            if wait_s:
+                await asyncio.sleep(wait_s)
+            while not self.limiter.try_acquire():
+                await asyncio.sleep(self.poll_interval_s)
+                wait_s += self.poll_interval_s
+            self._count("wait_s", wait_s)
+            error, start = None, time.monotonic()
+            try:
+                self._count("attempts")
+                response = await fn()
+            except Exception as e:
+                error = e
+            retry = self._after_attempt(error, attempt, time.monotonic() - start)
+            if error is None:
+                self._settle(estimate, response)
+                return response
+            if not retry:
+                raise error
+            await asyncio.sleep(self._backoff_s(attempt, error))
+
+    def _after_attempt(self, error: Optional[Exception], attempt: int,
+                       latency_s: float) -> bool:
+        """updates the limiter and counters; whether to retry the error."""
+        throttled = error is not None and is_throttled(error)
+        self.limiter.release(throttled=throttled,
+                             slow=error is None and latency_s > self.latency_target_s)
+        if error is None:
+            return False
+        if throttled:
+            self._count("throttled")
+        elif is_retryable(error):
+            self._count("server_errors")
+        retry = is_retryable(error) and attempt < self.max_retries
+        self._count("retries" if retry else "failed")
+        return retry
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.counters)
+        stats["wait_s"] = round(stats["wait_s"], 3)
+        stats["concurrency_limit"] = round(self.limiter.limit, 2)
+        return stats
+
+
+class RateLimitMiddleware(AgentMiddleware):
+    """Sends the model calls of an agent graph through a scheduler."""
+    def __init__(self, scheduler: RateLimitScheduler):
+        super().__init__()
+        self.scheduler = scheduler
+
+    def _estimate(self, request: Any) -> int:
+        messages = list(request.messages)
+        if request.system_message is not None:
+            messages.insert(0, request.system_message)
+        return self.scheduler.estimate_tokens(messages, request.tools or [])
+
+    def wrap_model_call(self, request: Any, handler: Callable) -> Any:
+        return self.scheduler.call(self._estimate(request), lambda: handler(request))
+
+    async def awrap_model_call(self, request: Any, handler: Callable) -> Any:
+        return await self.scheduler.acall(self._estimate(request), lambda: handler(request))
+
+
+_schedulers: dict[tuple, RateLimitScheduler] = {}
+_schedulers_lock = threading.Lock()
+
+
+def build_scheduler(rate_limit_config: Optional[DotDict],
+                    output_tokens: int = 0) -> Optional[RateLimitScheduler]:
+    """Creates the scheduler from the rate_limit config block (None when
+    the block is missing or disabled). Provider limits apply per account,
+    so agents with the same limits share one scheduler."""
+    if rate_limit_config is None or not rate_limit_config.enabled:
+        return None
+    settings = rate_limit_config.to_dict()
+    settings.pop("enabled")
+    key = tuple(sorted(settings.items())) + (output_tokens,)
+    with _schedulers_lock:
+        if key not in _schedulers:
+            _schedulers[key] = RateLimitScheduler(output_tokens=output_tokens, **settings)
+        return _schedulers[key]
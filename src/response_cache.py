@@ -0,0 +1,173 @@
+"""Disk-backed LLM response cache keyed by the model parameters, tool schemas and
+messages, with LRU eviction (see the response_cache block in agent_config.yaml)."""
+
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from typing import Any, Optional, Sequence
+
+from langchain_core.caches import BaseCache
+from langchain_core.messages import message_to_dict, messages_from_dict
+from langchain_core.outputs import ChatGeneration, Generation
+
+from utils import DotDict
+
+
+# message fields that vary between otherwise identical conversations (ids,
+# usage and provider metadata). They are dropped from the key so that a
+# replayed AI message leads to the same key for the next turn.
+VOLATILE_MESSAGE_FIELDS = ("id", "usage_metadata", "response_metadata")
+
+
+def _canonical(value: Any) -> Any:
+    """removes volatile message fields from a serialized prompt."""
+    if isinstance(value, list):
+        return [_canonical(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _canonical(item) for key, item in value.items()
+                if key not in VOLATILE_MESSAGE_FIELDS}
+    return value
+
+
+def cache_key(prompt: str, llm_string: str) -> str:
+    """hashes the model parameters, tool schemas and messages into a key."""
+    try:
+        prompt = json.dumps(_canonical(json.loads(prompt)), sort_keys=True)
+    except json.JSONDecodeError:
+        pass
+    return hashlib.sha256(
+        f"{llm_string}\n---\n{prompt}".encode("utf-8")).hexdigest()
+
+
+class SQLiteResponseCache(BaseCache):
+    """A single-file response cache with LRU eviction and hit/miss counters."""
+    def __init__(self, path: str, max_entries: int = 10000,
+                 max_bytes: int = 512 * 1024 * 1024):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " last_access REAL NOT NULL)")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_access"
+            " ON responses (last_access)")
+        self._conn.commit()
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[Sequence[Generation]]:
+        """returns the cached generations or None."""
+        key = cache_key(prompt, llm_string)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute(
+                "UPDATE responses SET last_access = ? WHERE key = ?",
+                (time.time(), key))
+            self._conn.commit()
+        return [self._load_generation(item) for item in json.loads(row[0])]
+
+    def update(self, prompt: str, llm_string: str,
+               return_val: Sequence[Generation]) -> None:
+        """stores the generations and evicts old entries if needed."""
+        value = json.dumps([self._dump_generation(g) for g in return_val])
+        key = cache_key(prompt, llm_string)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses"
+                " (key, value, size, created_at, last_access)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value), now, now))
+            self._evict()
+            self._conn.commit()
+
+    def clear(self, **kwargs: Any) -> None:
+        """removes all entries."""
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        """hit/miss/eviction counters and the current size of the store."""
+        with self._lock:
+            entries, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": entries,
+            "bytes": size,
+        }
+
+    def _evict(self) -> None:
+        """deletes least recently used entries beyond the size limits."""
+        entries, size = self._conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        if entries <= self.max_entries and size <= self.max_bytes:
+            return
+        rows = self._conn.execute(
+            "SELECT key, size FROM responses ORDER BY last_access ASC").fetchall()
+        evicted = []
+        for key, entry_size in rows:
+            if entries <= self.max_entries and size <= self.max_bytes:
+                break
+            evicted.append((key,))
+            entries -= 1
+            size -= entry_size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        self.evictions += len(evicted)
+
+    @staticmethod
+    def _dump_generation(generation: Generation) -> dict:
+        if isinstance(generation, ChatGeneration):
+            return {"message": message_to_dict(generation.message),
+                    "generation_info": generation.generation_info}
+        return {"text": generation.text,
+                "generation_info": generation.generation_info}
+
+    @staticmethod
+    def _load_generation(item: dict) -> Generation:
+        if "message" in item:
+            message = messages_from_dict([item["message"]])[0]
+            return ChatGeneration(message=message,
+                                  generation_info=item.get("generation_info"))
+        return Generation(text=item["text"],
+                          generation_info=item.get("generation_info"))
+
+
+_response_caches: dict[str, SQLiteResponseCache] = {}
+_response_caches_lock = threading.Lock()
+
+
+def build_response_cache(cache_config: Optional[DotDict]) -> Optional[SQLiteResponseCache]:
+    """Creates the response cache from the response_cache config block
+    (None when the block is missing or disabled). Agents configured with
+    the same path share one cache (and its hit/miss counters)."""
+    if cache_config is None or not cache_config.enabled:
+        return None
+    with _response_caches_lock:
+        if cache_config.path not in _response_caches:
+            _response_caches[cache_config.path] = SQLiteResponseCache(
+                cache_config.path,
+                max_entries=cache_config.max_entries,
+                max_bytes=cache_config.max_bytes)
+        return _response_caches[cache_config.path]
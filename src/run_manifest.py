@@ -0,0 +1,249 @@
+"""Run manifest of input hashes and output versions per (skill, patient), so that
+run_skill skips patients whose inputs and outputs are unchanged and resumes crashed
+runs (see the run_manifest block in agent_config.yaml)."""
+
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from typing import Callable, Iterable, Optional
+
+from long_notes import estimate_tokens
+from output_sink import OutputSink
+from utils import DotDict
+
+
+SKILL_OUTPUTS = {
+    "clinical_insights_skill": ("notes_with_toc.md", "treatment_recommendation.json",
+                                "clinical_summary.json"),
+    "clinical_judge_skill": ("eval_treatment_plan.json", "eval_summarization.json"),
+}
+# outputs of other skills a skill reads (their versions are part of its input)
+SKILL_UPSTREAM = {
+    "clinical_judge_skill": ("treatment_recommendation.json", "clinical_summary.json"),
+}
+
+
+def _sha256(value) -> str:
+    return hashlib.sha256(
+        json.dumps(value, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def output_filenames(skill_name: str, patient_id: int,
+                     artifacts: Optional[Iterable[str]] = None) -> list[str]:
+    return [f"pid{patient_id:04d}_{artifact}"
+            for artifact in (SKILL_OUTPUTS[skill_name] if artifacts is None else artifacts)]
+
+
+def config_hash(agent) -> str:
+    """hashes the inputs every patient of the agent's skill shares."""
+    with open(agent.config.system_prompt_file_path, "r") as f:
+        system_prompt = f.read()
+    # the prompt prefix adds the schemas of the enabled tools
+    return _sha256({"system_prompt": system_prompt, "skill": agent.config.skill,
+                    "model": agent.config.model.to_dict(),
+                    "prompt_prefix": agent.prompt_prefix()})
+
+
+def data_hash(patient_data: dict, upstream_versions: Optional[dict] = None) -> str:
+    """hashes the patient's own inputs."""
+    return _sha256({"note": patient_data["note"], "question": patient_data["question"],
+                    "answer": patient_data.get("answer"), "upstream": upstream_versions or {}})
+
+
+class RunManifest:
+    """Input hashes and output status per (skill, patient)."""
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS runs ("
+            " skill TEXT NOT NULL,"
+            " patient_id INTEGER NOT NULL,"
+            " config_hash TEXT NOT NULL,"
+            " data_hash TEXT NOT NULL,"
+            " status TEXT NOT NULL,"
+            " outputs TEXT NOT NULL,"
+            " input_tokens INTEGER NOT NULL DEFAULT 0,"
+            " output_tokens INTEGER NOT NULL DEFAULT 0,"
+            " llm_calls INTEGER NOT NULL DEFAULT 0,"
+            " duration_s REAL NOT NULL DEFAULT 0,"
+            " error TEXT,"
+            " updated_at REAL NOT NULL,"
+            " PRIMARY KEY (skill, patient_id))")
+        self._conn.commit()
+
+    def rows(self, skill_name: str, patient_ids: list[int]) -> dict[int, dict]:
+        """{patient_id: row} of the patients with a manifest row."""
+        columns = ("patient_id", "config_hash", "data_hash", "status", "outputs",
+                   "input_tokens", "output_tokens", "llm_calls")
+        rows = {}
+        with self._lock:
+            for start in range(0, len(patient_ids), 500):
+                batch = patient_ids[start:start + 500]
+                for values in self._conn.execute(
+                        f"SELECT {', '.join(columns)} FROM runs WHERE skill = ?"
+                        f" AND patient_id IN ({', '.join('?' * len(batch))})",
+                        (skill_name, *batch)):
+                    row = dict(zip(columns, values))
+                    row["outputs"] = json.loads(row["outputs"])
+                    rows[row["patient_id"]] = row
+        return rows
+
+    def usage_per_patient(self, skill_name: str) -> Optional[dict]:
+        """mean tokens and calls of the skill's done runs (None without any)."""
+        with self._lock:
+            count, input_tokens, output_tokens, llm_calls = self._conn.execute(
+                "SELECT COUNT(*), AVG(input_tokens), AVG(output_tokens), AVG(llm_calls)"
+                " FROM runs WHERE skill = ? AND status = 'done' AND llm_calls > 0",
+                (skill_name,)).fetchone()
+        if not count:
+            return None
+        return {"input_tokens": input_tokens, "output_tokens": output_tokens,
+                "llm_calls": llm_calls}
+
+    def record(self, skill_name: str, patient_id: int, hashes: tuple[str, str],
+               status: str, outputs: dict, usage=None, duration_s: float = 0.0,
+               error: Optional[str] = None) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO runs (skill, patient_id, config_hash, data_hash, status,"
+                " outputs, input_tokens, output_tokens, llm_calls, duration_s, error, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (skill_name, patient_id, *hashes, status, json.dumps(outputs),
+                 getattr(usage, "input_tokens", 0), getattr(usage, "output_tokens", 0),
+                 getattr(usage, "llm_calls", 0), round(duration_s, 3), error, time.time()))
+            self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class RunPlan:
+    """What a run of a skill over a cohort has to do."""
+    def __init__(self, skill_name: str, manifest: RunManifest, config_hash: str):
+        self.skill_name = skill_name
+        self.manifest = manifest
+        self.config_hash = config_hash
+        self.data_hashes: dict[int, str] = {}
+        self.reasons: dict[int, str] = {}
+        self.document_tokens: dict[int, int] = {}
+        # output versions of the patients to run, taken before they run
+        self.versions_before: dict[int, dict] = {}
+
+    @property
+    def to_run(self) -> list[int]:
+        return [patient_id for patient_id, reason in self.reasons.items()
+                if reason != "unchanged"]
+
+    def hashes(self, patient_id: int) -> tuple[str, str]:
+        return self.config_hash, self.data_hashes[patient_id]
+
+    def report(self, prefix_tokens: int = 0) -> dict:
+        """the reasons and the estimated tokens of the patients to run:
+        the mean usage of earlier done runs of the skill, scaled by the
+        patient's documents, or one call with prefix and documents."""
+        counts = {}
+        for reason in self.reasons.values():
+            counts[reason] = counts.get(reason, 0) + 1
+        history = self.manifest.usage_per_patient(self.skill_name)
+        to_run = self.to_run
+        document_tokens = sum(self.document_tokens[patient_id] for patient_id in to_run)
+        if history is not None:
+            mean_documents = (sum(self.document_tokens.values()) / len(self.document_tokens)
+                              if self.document_tokens else 0)
+            scale = document_tokens / (mean_documents * len(to_run)) if to_run and mean_documents else 1.0
+            estimate = {"method": "history",
+                        "input_tokens": round(history["input_tokens"] * len(to_run) * scale),
+                        "output_tokens": round(history["output_tokens"] * len(to_run)),
+                        "llm_calls": round(history["llm_calls"] * len(to_run))}
+        else:
+            estimate = {"method": "prompt",
+                        "input_tokens": prefix_tokens * len(to_run) + document_tokens,
+                        "output_tokens": None, "llm_calls": len(to_run)}
+        return {"skill": self.skill_name, "patients": len(self.reasons),
+                "to_run": len(to_run), "skipped": counts.get("unchanged", 0),
+                "reasons": counts, "estimated": estimate}
+
+
+def plan_run(manifest: RunManifest, agent, skill_name: str, patient_id_list: list[int],
+             load_patient: Callable[[int], dict], sink: OutputSink, output_base_path: str) -> RunPlan:
+    """Hashes the inputs of every patient and compares them with the
+    manifest. load_patient(patient_id) returns the patient's note, question
+    and answer (as local_tools.load_patient_data)."""
+    plan = RunPlan(skill_name, manifest, config_hash(agent))
+    rows = manifest.rows(skill_name, list(patient_id_list))
+    for patient_id in patient_id_list:
+        patient_data = load_patient(patient_id)
+        upstream = None
+        if skill_name in SKILL_UPSTREAM:
+            upstream = sink.versions(output_base_path, output_filenames(
+                skill_name, patient_id, SKILL_UPSTREAM[skill_name]))
+        plan.data_hashes[patient_id] = data_hash(patient_data, upstream)
+        plan.document_tokens[patient_id] = estimate_tokens(
+            patient_data["note"] + patient_data["question"])
+
+        row = rows.get(patient_id)
+        if row is None:
+            reason = "new"
+        elif row["status"] != "done":
+            reason = "failed"
+        elif row["config_hash"] != plan.config_hash:
+            reason = "config_changed"
+        elif row["data_hash"] != plan.data_hashes[patient_id]:
+            reason = "data_changed"
+        elif sink.versions(output_base_path, list(row["outputs"])) != row["outputs"]:
+            reason = "outputs_changed"
+        else:
+            reason = "unchanged"
+        plan.reasons[patient_id] = reason
+        if reason != "unchanged":
+            plan.versions_before[patient_id] = sink.versions(
+                output_base_path, output_filenames(skill_name, patient_id))
+    return plan
+
+
+def record_patient(plan: RunPlan, patient_id: int, sink: OutputSink, output_base_path: str,
+                   usage=None, duration_s: float = 0.0,
+                   error: Optional[BaseException] = None) -> str:
+    """records the outcome of a patient's run: done when this run wrote all
+    outputs of the skill, failed otherwise; returns the status."""
+    outputs = sink.versions(output_base_path, output_filenames(plan.skill_name, patient_id))
+    before = plan.versions_before.get(patient_id, {})
+    # an output with the version it had before the run is left from an earlier run
+    written = [filename for filename, version in outputs.items() if before.get(filename) != version]
+    missing = len(written) < len(SKILL_OUTPUTS[plan.skill_name])
+    status = "failed" if error is not None or missing else "done"
+    message = repr(error) if error is not None else ("missing outputs" if missing else None)
+    plan.manifest.record(plan.skill_name, patient_id, plan.hashes(patient_id), status,
+                         outputs, usage, duration_s, message)
+    return status
+
+
+def record_cleared(plan: RunPlan, patient_id: int, sink: OutputSink, output_base_path: str,
+                   filenames: list[str]) -> None:
+    """records a patient the skill did not have to run (e.g. cleared by the
+    grounding check) as done, with the outputs that stand in for the skill's."""
+    plan.manifest.record(plan.skill_name, patient_id, plan.hashes(patient_id), "done",
+                         sink.versions(output_base_path, filenames))
+
+
+_manifests: dict[str, RunManifest] = {}
+_manifests_lock = threading.Lock()
+
+
+def build_run_manifest(settings: Optional[DotDict]) -> Optional[RunManifest]:
+    """the manifest of the run_manifest config block (shared per process),
+    or None when disabled."""
+    if not (settings and settings.enabled):
+        return None
+    with _manifests_lock:
+        if settings.path not in _manifests:
+            _manifests[settings.path] = RunManifest(settings.path)
+        return _manifests[settings.path]
@@ -0,0 +1,298 @@
+"""Renders streamed agent runs into a pluggable sink (terminal, file, queue or
+nothing) and records the time to first token and inter-token latencies per model turn."""
+
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+from langchain_core.messages import (
+    AIMessage, AIMessageChunk, BaseMessage, HumanMessage, ToolMessage)
+
+from tracing import traced
+from usage import UsageLedger
+
+
+TOKEN_STREAM_MODES = ["messages", "updates"]
+
+
+def graph_stream_mode(stream_mode: str):
+    """the langgraph stream mode(s) behind an agent stream mode."""
+    return TOKEN_STREAM_MODES if stream_mode == "tokens" else stream_mode
+
+
+def split_event(event, stream_mode: str) -> tuple[tuple, str, Any]:
+    """(namespace, graph stream mode, payload) of an event streamed with
+    subgraphs=True; the namespace is () for the top-level graph."""
+    if stream_mode == "tokens":
+        return event
+    namespace, payload = event
+    return namespace, stream_mode, payload
+
+
+def update_messages(response: dict) -> list[BaseMessage]:
+    """the messages of an updates-mode event ({node_name: state update})."""
+    messages = []
+    for update in response.values():
+        if isinstance(update, dict):
+            messages.extend(update.get("messages") or [])
+    return messages
+
+
+def latest_message(response, stream_mode: str) -> Optional[BaseMessage]:
+    """Returns the newest message carried by a streamed event."""
+    if stream_mode == "messages":
+        # (message chunk, metadata) tuples
+        return response[0]
+    if stream_mode == "updates":
+        messages = update_messages(response)
+        return messages[-1] if messages else None
+    messages = response.get("messages", [])
+    return messages[-1] if messages else None
+
+
+def message_text(message: BaseMessage) -> str:
+    """the printable text of a message (or message chunk)."""
+    content = message.content
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "".join(item["text"] if isinstance(item, dict) and "text" in item
+                       else "" if isinstance(item, dict) else str(item)
+                       for item in content)
+    if isinstance(content, dict) and content.get("type") == "function_call":
+        return f"Function Call: {content.get('name')}"
+    return ""
+
+
+class StreamSink:
+    """Receives the rendered text; kind is "label", "token" or "message"."""
+    def write(self, text: str, kind: str = "message") -> None:
+        raise NotImplementedError
+
+    def turn(self, timing: dict) -> None:
+        """called with the timing of every finished model turn."""
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.flush()
+
+
+class NullSink(StreamSink):
+    def write(self, text: str, kind: str = "message") -> None:
+        pass
+
+
+class TerminalSink(StreamSink):
+    """Writes to stdout with one flush per line instead of one per write."""
+    def __init__(self, stream: Any = None, flush_interval_s: float = 0.05):
+        self.stream = stream
+        self.flush_interval_s = flush_interval_s
+        self._buffer = []
+        self._last_flush = time.perf_counter()
+
+    def write(self, text: str, kind: str = "message") -> None:
+        self._buffer.append(text)
+        if "\n" in text or time.perf_counter() - self._last_flush >= self.flush_interval_s:
+            self.flush()
+
+    @traced("console", "TerminalSink.flush")
+    def flush(self) -> None:
+        if self._buffer:
+            # resolved late so that contextlib.redirect_stdout is honoured
+            stream = self.stream or sys.stdout
+            stream.write("".join(self._buffer))
+            stream.flush()
+            self._buffer.clear()
+        self._last_flush = time.perf_counter()
+
+
+class BufferedFileSink(StreamSink):
+    """Appends the transcript to a file."""
+    def __init__(self, filepath: str, buffer_size: int = 64 * 1024):
+        self._file = open(filepath, 'a', buffering=buffer_size)
+
+    def write(self, text: str, kind: str = "message") -> None:
+        self._file.write(text)
+
+    def flush(self) -> None:
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class QueueSink(StreamSink):
+    """Puts events on a queue.Queue or asyncio.Queue (non-blocking, so an
+    asyncio.Queue must belong to the loop that runs the stream)."""
+    def __init__(self, queue: Any):
+        self.queue = queue
+
+    def write(self, text: str, kind: str = "message") -> None:
+        self.queue.put_nowait({"type": kind, "text": text})
+
+    def turn(self, timing: dict) -> None:
+        self.queue.put_nowait({"type": "turn", **timing})
+
+
+@dataclass
+class TurnTiming:
+    """timing of one model turn as seen by the stream consumer."""
+    ttft_s: float
+    duration_s: float = 0.0
+    tokens: int = 1
+    inter_token_s: list[float] = field(default_factory=list)
+
+    def to_dict(self) -> dict:
+        gaps = sorted(self.inter_token_s)
+        return {
+            "ttft_s": round(self.ttft_s, 4),
+            "duration_s": round(self.duration_s, 4),
+            "tokens": self.tokens,
+            "inter_token_mean_s": round(sum(gaps) / len(gaps), 5) if gaps else None,
+            "inter_token_max_s": round(gaps[-1], 5) if gaps else None,
+        }
+
+
+@dataclass
+class _OpenTurn:
+    """a model turn whose tokens are still arriving."""
+    timing: TurnTiming
+    start: float
+    last_token: float = 0.0
+    text: list[str] = field(default_factory=list)
+
+
+def _from_model(message: AIMessage) -> bool:
+    """whether an AI message was returned by a model call (graph nodes such
+    as the fan-out join make messages without usage or response metadata)."""
+    return bool(message.usage_metadata or message.response_metadata)
+
+
+class StreamRenderer:
+    """Renders the events of one streamed run into a sink and records the
+    per-turn timings in the ledger. collect keeps the rendered messages
+    (see Agent.stream_local(first_response_file_path=...))."""
+    def __init__(self, sink: StreamSink, stream_mode: str, ledger: UsageLedger,
+                 collect: bool = False):
+        self.sink = sink
+        self.stream_mode = stream_mode
+        self.ledger = ledger
+        self.response_values = [] if collect else None
+        self._run_start = time.perf_counter()
+        # when the next turn of every (sub)graph namespace starts
+        self._turn_starts: dict[tuple, float] = {}
+        # open turns by (namespace, message id); _live is the one streaming
+        self._turns: dict[tuple, _OpenTurn] = {}
+        self._live: Optional[tuple] = None
+        self._rendered: set[str] = set()
+
+    @traced("stream", "StreamRenderer.handle")
+    def handle(self, response) -> None:
+        """renders one streamed graph event."""
+        if response is None:
+            return
+        self.ledger.count_event()
+        namespace, mode, response = split_event(response, self.stream_mode)
+        if mode == "updates" and self.stream_mode == "tokens":
+            # a node of this (sub)graph finished: its model turn (if any) is
+            # over and the next one starts now
+            self._end_turns(namespace)
+            self._turn_starts[namespace] = time.perf_counter()
+            return
+        if mode == "messages":
+            messages = [response[0]]
+        elif mode == "updates":
+            messages = update_messages(response)
+        else:
+            message = latest_message(response, mode)
+            messages = [message] if message is not None else []
+        for message in messages:
+            if isinstance(message, AIMessageChunk):
+                self._token(namespace, message)
+            else:
+                self._message(namespace, message)
+
+    def _message(self, namespace: tuple, message: BaseMessage) -> None:
+        if message.id is not None:
+            if message.id in self._rendered:
+                return
+            self._rendered.add(message.id)
+        elapsed_s = time.perf_counter() - self._turn_starts.get(namespace, self._run_start)
+        self._end_turns(namespace)
+        if isinstance(message, HumanMessage):
+            label, value = "\nHuman: ", message_text(message)
+        elif isinstance(message, AIMessage):
+            # a complete message: its arrival is the first (and only) token
+            label, value = "\nAI: ", message_text(message)
+            if _from_model(message):
+                self._record(TurnTiming(ttft_s=elapsed_s, duration_s=elapsed_s))
+        elif isinstance(message, ToolMessage):
+            tool_name = getattr(message, 'name', 'Unknown')
+            label, value = f"\n[Tool: {tool_name}] ", f"[Tool: {tool_name}]"
+        else:
+            label, value = "", None
+        if self.response_values is not None and value is not None:
+            self.response_values.append(value)
+        self.sink.write(label, "label")
+        self.sink.write(message_text(message))
+        self._turn_starts[namespace] = time.perf_counter()
+
+    def _token(self, namespace: tuple, chunk: AIMessageChunk) -> None:
+        now = time.perf_counter()
+        key = (namespace, chunk.id)
+        turn = self._turns.get(key)
+        if turn is None:
+            # a new message ends the previous turn of its (sub)graph
+            self._end_turns(namespace)
+            start = self._turn_starts.get(namespace, self._run_start)
+            # the first chunk of a turn may carry only tool call deltas
+            turn = self._turns[key] = _OpenTurn(TurnTiming(ttft_s=now - start, tokens=0), start)
+            if chunk.id is not None:
+                self._rendered.add(chunk.id)
+        text = message_text(chunk)
+        if not text:
+            return
+        if turn.timing.tokens:
+            turn.timing.inter_token_s.append(now - turn.last_token)
+        elif self._live is None:
+            self._live = key
+            self.sink.write("\nAI: ", "label")
+        turn.timing.tokens += 1
+        turn.last_token = now
+        turn.text.append(text)
+        if self._live == key:
+            self.sink.write(text, "token")
+
+    def _end_turns(self, namespace: Optional[tuple] = None) -> None:
+        """ends the open turns of a namespace (all of them without one)."""
+        for key in [key for key in self._turns if namespace is None or key[0] == namespace]:
+            turn = self._turns.pop(key)
+            now = time.perf_counter()
+            turn.timing.duration_s = now - turn.start
+            self._record(turn.timing)
+            text = "".join(turn.text)
+            if self._live == key:
+                self._live = None
+            elif text:
+                # a concurrent turn that did not stream: written as a block
+                self.sink.write("\nAI: ", "label")
+                self.sink.write(text)
+            if self.response_values is not None:
+                self.response_values.append(text)
+            self._turn_starts[key[0]] = now
+
+    def _record(self, turn: TurnTiming) -> None:
+        timing = turn.to_dict()
+        self.ledger.record_turn(timing)
+        self.sink.turn(timing)
+
+    def close(self) -> list:
+        """ends the last turns and flushes the sink; returns the collected
+        messages (empty unless collect was set)."""
+        self._end_turns()
+        self.sink.write("\n", "label")
+        self.sink.flush()
+        return self.response_values or []
@@ -0,0 +1,319 @@
+"""Local stand-ins for the OpenAI chat model that replay scripted turns, so agents run
+offline (ThrottlingStubChatModel also injects rate-limit and server errors)."""
+
+import re
+import json
+import time
+import asyncio
+import uuid
+import threading
+from collections import deque
+from typing import Any, AsyncIterator, Iterator, Optional, Sequence
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage, SystemMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from pydantic import PrivateAttr
+
+
+PATIENT_ID_PATTERN = re.compile(r"<patient_id>\s*(\d+)\s*</patient_id>")
+NOTES_PATTERN = re.compile(r"<notes>\n?(.*?)</notes>", re.S)
+NUMBERED_LINE_PATTERN = re.compile(r"^(\d+): (.*)$")
+
+
+def cited_line(notes: str) -> tuple[int, str]:
+    """the first sentence of six or more words of the numbered note lines
+    (line number, sentence without its final period)."""
+    for line in notes.split("\n"):
+        match = NUMBERED_LINE_PATTERN.match(line.strip())
+        if not match:
+            continue
+        sentence = re.split(r"(?<=[.!?])\s+", match.group(2).strip())[0].rstrip(".!?")
+        if len(sentence.split()) >= 6:
+            return int(match.group(1)), sentence
+    return 1, ""
+
+
+def judge_tool_turns() -> list[dict]:
+    """scripted turns for the clinical_judge_skill (two json_writer calls)."""
+    return [
+        {"tool_calls": [
+            {"name": "json_writer", "args": {
+                "json_string": '{"patient_id": "{patient_id}", "evaluation_task": "treatment_plan", '
+                               '"hallucination": {"score": "0", "instances": []}, '
+                               '"accuracy": {"score": "HIGH", "reason": ""}}',
+                "filename": "pid{patient_id:04d}_eval_treatment_plan.json"}},
+            {"name": "json_writer", "args": {
+                "json_string": '{"patient_id": "{patient_id}", "evaluation_task": "summarization", '
+                               '"hallucination": {"score": "0", "instances": []}, '
+                               '"accuracy": {"score": "HIGH", "reason": ""}}',
+                "filename": "pid{patient_id:04d}_eval_summarization.json"}},
+        ]},
+        {"content": "Evaluation files written."},
+    ]
+
+
+def insights_tool_turns(grounded: bool = False) -> list[dict]:
+    """scripted turns for the clinical_insights_skill (one turn per subskill).
+    grounded outputs quote and cite a line of the patient's note, so they
+    pass the citation check of grounding.py."""
+    if grounded:
+        cited = ('"citations": [{"citation_number": "1", "section": "Notes", '
+                 '"line_start": "{note_line_number}", "line_end": "{note_line_number}"}]')
+        treatment, summary = "{note_line} [1].", "{note_line} [1]."
+    else:
+        cited = ('"citations": [{"citation_number": "1", "section": "Notes", '
+                 '"line_start": "1", "line_end": "1"}]')
+        treatment, summary = "Continue care [1].", "Patient was admitted [1]."
+    return [
+        {"tool_calls": [
+            {"name": "text_writer", "args": {
+                "content": "# Patient Notes\n\n## Table of Contents\n- [Notes](#notes)\n\n## Notes\n",
+                "filename": "pid{patient_id:04d}_notes_with_toc.md"}},
+        ]},
+        {"tool_calls": [
+            {"name": "json_writer", "args": {
+                "json_string": '{"patient_id": "{patient_id}", "recommended_treatment": "%s", %s}'
+                               % (treatment, cited),
+                "filename": "pid{patient_id:04d}_treatment_recommendation.json"}},
+        ]},
+        {"tool_calls": [
+            {"name": "json_writer", "args": {
+                "json_string": '{"patient_id": "{patient_id}", "summary": "%s", "question": "", %s}'
+                               % (summary, cited),
+                "filename": "pid{patient_id:04d}_clinical_summary.json"}},
+        ]},
+        {"content": "All three files were written."},
+    ]
+
+
+def insights_branch_turns(grounded: bool = False) -> dict[str, list[dict]]:
+    """scripted turns of the fan-out branches of the clinical_insights_skill
+    (see fanout.py), keyed by the branch scope of their system prompt."""
+    turns = insights_tool_turns(grounded)
+    return {f"Perform ONLY Subskill {number} ": [turns[number - 1]] for number in (1, 2, 3)}
+
+
+def _fill(value: Any, patient_id: int, line: tuple[int, str] = (1, "")) -> Any:
+    """fills {patient_id} / {patient_id:04d} and {note_line_number} /
+    {note_line} (JSON-escaped) placeholders in scripted values."""
+    if isinstance(value, str):
+        return (value.replace("{patient_id:04d}", f"{patient_id:04d}")
+                     .replace("{patient_id}", str(patient_id))
+                     .replace("{note_line_number}", str(line[0]))
+                     .replace("{note_line}", json.dumps(line[1])[1:-1]))
+    if isinstance(value, dict):
+        return {k: _fill(v, patient_id, line) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_fill(v, patient_id, line) for v in value]
+    return value
+
+
+class StubChatModel(BaseChatModel):
+    """A deterministic, offline chat model that replays scripted turns.
+
+    The turn that is replayed is the number of AI messages seen after the
+    latest human message, so each patient conversation walks the script from
+    the top. Placeholders in the script are filled with the patient id found
+    in the <patient_id> tag of the human message and a line of its <notes>
+    (the tool calls of a turn are repeated for every patient of a
+    multi-patient message). With
+    turns_by_prompt, the script is the one whose key occurs in the system
+    message (e.g. one script per fan-out branch); with turns_by_patient, the
+    one of the (first) patient id; else turns.
+
+    When streamed (e.g. stream_mode="messages"), the content is emitted in
+    chunks of chunk_chars characters, chunk_latency_s apart, followed by one
+    chunk with the tool calls and the usage.
+    """
+    turns: list[dict] = []
+    turns_by_prompt: dict[str, list[dict]] = {}
+    turns_by_patient: dict[int, list[dict]] = {}
+    latency_s: float = 0.0
+    chunk_chars: int = 16
+    chunk_latency_s: float = 0.0
+    input_tokens: int = 0
+    cached_input_tokens: int = 0
+    output_tokens: int = 32
+    model_name: str = "stub-chat-model"
+    calls: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "stub-chat"
+
+    def bind_tools(self, tools: Sequence[Any], **kwargs: Any) -> Any:
+        """tool schemas are ignored; the script decides which tools are called.
+        An output cap (max_tokens) is kept, see _next_message."""
+        if kwargs.get("max_tokens"):
+            return self.bind(max_tokens=kwargs["max_tokens"])
+        return self
+
+    def _next_message(self, messages: list[BaseMessage],
+                      max_tokens: Optional[int] = None) -> AIMessage:
+        """builds the scripted AI message for the current conversation state.
+        A turn of more than max_tokens output tokens is cut off: its content
+        is shortened and its tool calls become invalid (finish_reason length)."""
+        turn_index, patient_ids, lines = 0, [0], []
+        for message in reversed(messages):
+            if isinstance(message, HumanMessage):
+                patient_ids = [int(match) for match in
+                               PATIENT_ID_PATTERN.findall(str(message.content))] or [0]
+                lines = [cited_line(notes) for notes in NOTES_PATTERN.findall(str(message.content))]
+                break
+            if isinstance(message, AIMessage):
+                turn_index += 1
+
+        turns = self.turns
+        if self.turns_by_prompt and messages and isinstance(messages[0], SystemMessage):
+            system = str(messages[0].content)
+            turns = next((script for key, script in self.turns_by_prompt.items()
+                          if key in system), turns)
+        turns = self.turns_by_patient.get(patient_ids[0], turns)
+        turn = turns[turn_index] if turn_index < len(turns) else {"content": "done."}
+        lines += [(1, "")] * (len(patient_ids) - len(lines))
+        tool_calls = [
+            {"name": call["name"], "args": _fill(call["args"], patient_id, line),
+             "id": f"call_{uuid.uuid4().hex[:12]}", "type": "tool_call"}
+            for patient_id, line in zip(patient_ids, lines) for call in turn.get("tool_calls", [])]
+        patient_id = patient_ids[0]
+        input_tokens = self.input_tokens or sum(
+            len(str(m.content)) for m in messages) // 4
+        self.calls += 1
+        content = _fill(turn.get("content", ""), patient_id)
+        output_tokens, invalid_tool_calls = self.output_tokens, []
+        truncated = bool(max_tokens) and output_tokens > max_tokens
+        if truncated:
+            output_tokens, content = max_tokens, content[:max_tokens * 4]
+            invalid_tool_calls = [
+                {"name": call["name"], "args": json.dumps(call["args"])[:max_tokens * 4],
+                 "id": call["id"], "error": "truncated", "type": "invalid_tool_call"}
+                for call in tool_calls]
+            tool_calls = []
+        return AIMessage(
+            content=content,
+            tool_calls=tool_calls,
+            invalid_tool_calls=invalid_tool_calls,
+            usage_metadata={
+                "input_tokens": input_tokens,
+                "output_tokens": output_tokens,
+                "total_tokens": input_tokens + output_tokens,
+                "input_token_details": {
+                    "cache_read": min(self.cached_input_tokens, input_tokens)},
+            },
+            response_metadata={"model_name": self.model_name,
+                               "finish_reason": "length" if truncated else "stop"},
+        )
+
+    def _generate(self, messages: list[BaseMessage], stop: Optional[list[str]] = None,
+                  run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        if self.latency_s:
+            time.sleep(self.latency_s)
+        message = self._next_message(messages, kwargs.get("max_tokens"))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(self, messages: list[BaseMessage], stop: Optional[list[str]] = None,
+                         run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        if self.latency_s:
+            await asyncio.sleep(self.latency_s)
+        message = self._next_message(messages, kwargs.get("max_tokens"))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _chunks(self, message: AIMessage) -> list[ChatGenerationChunk]:
+        """splits a scripted message into streamed chunks."""
+        content = message.content
+        size = self.chunk_chars or len(content) or 1
+        chunks = [AIMessageChunk(content=content[start:start + size], id=message.id)
+                  for start in range(0, len(content), size)]
+        chunks.append(AIMessageChunk(
+            content="", id=message.id,
+            tool_call_chunks=[
+                {"name": call["name"], "args": json.dumps(call["args"]), "id": call["id"],
+                 "index": index, "type": "tool_call_chunk"}
+                for index, call in enumerate(message.tool_calls)],
+            usage_metadata=message.usage_metadata,
+            response_metadata=message.response_metadata,
+            chunk_position="last"))
+        return [ChatGenerationChunk(message=chunk) for chunk in chunks]
+
+    def _stream(self, messages: list[BaseMessage], stop: Optional[list[str]] = None,
+                run_manager: Any = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        if self.latency_s:
+            time.sleep(self.latency_s)
+        message = self._next_message(messages, kwargs.get("max_tokens"))
+        for index, chunk in enumerate(self._chunks(message)):
+            if index and self.chunk_latency_s:
+                time.sleep(self.chunk_latency_s)
+            if run_manager is not None:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+    async def _astream(self, messages: list[BaseMessage], stop: Optional[list[str]] = None,
+                       run_manager: Any = None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        if self.latency_s:
+            await asyncio.sleep(self.latency_s)
+        message = self._next_message(messages, kwargs.get("max_tokens"))
+        for index, chunk in enumerate(self._chunks(message)):
+            if index and self.chunk_latency_s:
+                await asyncio.sleep(self.chunk_latency_s)
+            if run_manager is not None:
+                await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+
+class StubAPIError(Exception):
+    """mimics openai.APIStatusError (status_code, response.headers)."""
+    def __init__(self, status_code: int, retry_after_s: Optional[float] = None):
+        super().__init__(f"stub error {status_code}")
+        self.status_code = status_code
+        headers = {"retry-after-ms": str(int(retry_after_s * 1000))} if retry_after_s else {}
+        self.response = type("StubResponse", (), {"status_code": status_code, "headers": headers})()
+
+
+class ThrottlingStubChatModel(StubChatModel):
+    """A StubChatModel behind a provider-like limit: more than
+    requests_per_window calls in a sliding window of window_s seconds are
+    rejected with a 429 (and a Retry-After hint), and every
+    server_error_every-th admitted call fails with a 503."""
+    requests_per_window: int = 60
+    window_s: float = 60.0
+    server_error_every: int = 0
+    rejected: int = 0
+    _window: deque = PrivateAttr(default_factory=deque)
+    _admitted: int = PrivateAttr(default=0)
+    _lock: Any = PrivateAttr(default_factory=threading.Lock)
+
+    def _admit(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            while self._window and now - self._window[0] >= self.window_s:
+                self._window.popleft()
+            if len(self._window) >= self.requests_per_window:
+                self.rejected += 1
+                raise StubAPIError(429, retry_after_s=self.window_s - (now - self._window[0]))
+            self._window.append(now)
+            self._admitted += 1
+            if self.server_error_every and self._admitted % self.server_error_every == 0:
+                self.rejected += 1
+                raise StubAPIError(503)
+
+    def _generate(self, messages: list[BaseMessage], stop: Optional[list[str]] = None,
+                  run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        self._admit()
+        return super()._generate(messages, stop, run_manager, **kwargs)
+
+    async def _agenerate(self, messages: list[BaseMessage], stop: Optional[list[str]] = None,
+                         run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        self._admit()
+        return await super()._agenerate(messages, stop, run_manager, **kwargs)
+
+    def _stream(self, messages: list[BaseMessage], stop: Optional[list[str]] = None,
+                run_manager: Any = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        self._admit()
+        yield from super()._stream(messages, stop, run_manager, **kwargs)
+
+    async def _astream(self, messages: list[BaseMessage], stop: Optional[list[str]] = None,
+                       run_manager: Any = None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        self._admit()
+        async for chunk in super()._astream(messages, stop, run_manager, **kwargs):
+            yield chunk
@@ -0,0 +1,355 @@
+"""Opt-in latency spans and sampling profile of a run (see the tracing block in
+agent_config.yaml), written as Chrome trace events and a p50 / p95 / p99 summary.
+While tracing is disabled, @traced and span() cost one global lookup per call."""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import threading
+import functools
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterator, Optional
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from usage import percentile
+from utils import DotDict
+
+
+@dataclass(slots=True)
+class Span:
+    """one timed interval; times are perf_counter_ns."""
+    name: str
+    category: str
+    start_ns: int
+    end_ns: int
+    patient_id: Any = None
+    session_id: Optional[str] = None
+    thread_id: int = 0
+    args: dict = field(default_factory=dict)
+
+
+# (patient_id, session_id) of the run the current code belongs to
+current_trace: ContextVar[tuple] = ContextVar("current_trace", default=(None, None))
+
+
+class Tracer:
+    """Collects spans from all threads and tasks of a process."""
+    def __init__(self):
+        self.spans: list[Span] = []
+        self.origin_ns = time.perf_counter_ns()
+        self._lock = threading.Lock()
+
+    def record(self, name: str, category: str, start_ns: int, end_ns: int,
+               scope: Optional[tuple] = None, args: Optional[dict] = None) -> None:
+        patient_id, session_id = scope or current_trace.get()
+        span = Span(name, category, start_ns, end_ns, patient_id, session_id,
+                    threading.get_ident(), args or {})
+        with self._lock:
+            self.spans.append(span)
+
+    def chrome_trace(self) -> dict:
+        """Chrome trace events: one process per session, one thread per OS
+        thread; complete ("X") events in microseconds."""
+        sessions, threads, events = {}, {}, []
+        for span in sorted(self.spans, key=lambda span: span.start_ns):
+            session = span.session_id or "(no session)"
+            if session not in sessions:
+                sessions[session] = len(sessions) + 1
+                label = session if span.patient_id is None else f"{session} (patient {span.patient_id})"
+                events.append({"ph": "M", "name": "process_name", "pid": sessions[session],
+                               "tid": 0, "args": {"name": label}})
+            thread = threads.setdefault(span.thread_id, len(threads) + 1)
+            events.append({
+                "ph": "X", "name": span.name, "cat": span.category,
+                "pid": sessions[session], "tid": thread,
+                "ts": (span.start_ns - self.origin_ns) / 1000,
+                "dur": (span.end_ns - span.start_ns) / 1000,
+                "args": {"patient_id": span.patient_id, **span.args}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def summary(self) -> dict:
+        """{category: {name: count, total and p50 / p95 / p99 / max in ms}}."""
+        durations = {}
+        for span in self.spans:
+            durations.setdefault((span.category, span.name), []).append(
+                (span.end_ns - span.start_ns) / 1e6)
+        summary = {}
+        for (category, name), values in sorted(durations.items()):
+            summary.setdefault(category, {})[name] = {
+                "count": len(values),
+                "total_ms": round(sum(values), 3),
+                "p50_ms": round(percentile(values, 0.5), 3),
+                "p95_ms": round(percentile(values, 0.95), 3),
+                "p99_ms": round(percentile(values, 0.99), 3),
+                "max_ms": round(max(values), 3),
+            }
+        return summary
+
+    def save(self, output_path: str, name: str) -> dict[str, str]:
+        """writes {name}_trace.json and {name}_latency_summary.json."""
+        os.makedirs(output_path, exist_ok=True)
+        paths = {"trace": os.path.join(output_path, f"{name}_trace.json"),
+                 "summary": os.path.join(output_path, f"{name}_latency_summary.json")}
+        with open(paths["trace"], 'w') as f:
+            json.dump(self.chrome_trace(), f)
+        with open(paths["summary"], 'w') as f:
+            json.dump(self.summary(), f, indent=4)
+        return paths
+
+
+# the active tracer; None disables tracing
+_tracer: Optional[Tracer] = None
+_null_span = nullcontext()
+
+
+def enable_tracing(tracer: Optional[Tracer] = None) -> Tracer:
+    global _tracer
+    _tracer = tracer or Tracer()
+    return _tracer
+
+
+def disable_tracing() -> Optional[Tracer]:
+    """stops recording; returns the tracer that was active."""
+    global _tracer
+    tracer, _tracer = _tracer, None
+    return tracer
+
+
+def active_tracer() -> Optional[Tracer]:
+    return _tracer
+
+
+class _Span:
+    __slots__ = ("tracer", "name", "category", "args", "start_ns")
+
+    def __init__(self, tracer: Tracer, name: str, category: str, args: dict):
+        self.tracer, self.name, self.category, self.args = tracer, name, category, args
+
+    def __enter__(self) -> "_Span":
+        self.start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.tracer.record(self.name, self.category, self.start_ns,
+                           time.perf_counter_ns(), args=self.args)
+
+
+def span(name: str, category: str = "code", **args: Any):
+    """times the with block as a span (a shared no-op when disabled)."""
+    tracer = _tracer
+    if tracer is None:
+        return _null_span
+    return _Span(tracer, name, category, args)
+
+
+def traced(category: str, name: Optional[str] = None) -> Callable:
+    """Decorator: every call of the function (sync or async) is a span,
+    named after the function's qualified name unless name is given."""
+    def decorator(func: Callable) -> Callable:
+        span_name = name or func.__qualname__
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                tracer = _tracer
+                if tracer is None:
+                    return await func(*args, **kwargs)
+                start_ns = time.perf_counter_ns()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    tracer.record(span_name, category, start_ns, time.perf_counter_ns())
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            tracer = _tracer
+            if tracer is None:
+                return func(*args, **kwargs)
+            start_ns = time.perf_counter_ns()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                tracer.record(span_name, category, start_ns, time.perf_counter_ns())
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def _scope(patient_id: Any, session_id: Optional[str]) -> Iterator[None]:
+    token = current_trace.set((patient_id, session_id))
+    try:
+        yield
+    finally:
+        current_trace.reset(token)
+
+
+def trace_scope(patient_id: Any = None, session_id: Optional[str] = None):
+    """attributes the spans recorded in this context to a patient / session."""
+    if _tracer is None:
+        return _null_span
+    return _scope(patient_id, session_id)
+
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    """Records model calls, tool calls, graph nodes and graph runs as spans.
+
+    The patient / session is captured when a run starts, like the ledger of
+    usage.UsageCallbackHandler."""
+    run_inline = True
+
+    def __init__(self, tracer: Tracer):
+        self.tracer = tracer
+        self._pending: dict[UUID, tuple] = {}
+        self._nodes: dict[UUID, str] = {}
+
+    def _start(self, run_id: UUID, name: str, category: str) -> None:
+        self._pending[run_id] = (name, category, time.perf_counter_ns(), current_trace.get())
+
+    def _end(self, run_id: UUID, error: bool = False) -> None:
+        pending = self._pending.pop(run_id, None)
+        if pending is not None:
+            name, category, start_ns, scope = pending
+            self.tracer.record(name, category, start_ns, time.perf_counter_ns(), scope,
+                               {"error": True} if error else None)
+
+    def on_chat_model_start(self, serialized: dict[str, Any], messages: list,
+                            *, run_id: UUID, **kwargs: Any) -> None:
+        name = (kwargs.get("metadata") or {}).get("ls_model_name") or kwargs.get("name") or "llm"
+        self._start(run_id, name, "llm")
+
+    def on_llm_start(self, serialized: dict[str, Any], prompts: list[str],
+                     *, run_id: UUID, **kwargs: Any) -> None:
+        self.on_chat_model_start(serialized, [], run_id=run_id, **kwargs)
+
+    def on_llm_end(self, response: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id, error=True)
+
+    def on_tool_start(self, serialized: dict[str, Any], input_str: str,
+                      *, run_id: UUID, **kwargs: Any) -> None:
+        self._start(run_id, (serialized or {}).get("name") or kwargs.get("name") or "tool", "tool")
+
+    def on_tool_end(self, output: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id)
+
+    def on_tool_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id, error=True)
+
+    def on_chain_start(self, serialized: dict[str, Any], inputs: Any,
+                       *, run_id: UUID, parent_run_id: Optional[UUID] = None,
+                       **kwargs: Any) -> None:
+        name = kwargs.get("name") or ""
+        if parent_run_id is None:
+            self._start(run_id, name or "graph", "graph")
+        elif name and name == (kwargs.get("metadata") or {}).get("langgraph_node"):
+            # only the node itself, not the runnables (or the subgraph of a
+            # fan-out branch) it wraps under the same name
+            if self._nodes.get(parent_run_id) != name:
+                self._start(run_id, name, "node")
+            self._nodes[run_id] = name
+
+    def on_chain_end(self, outputs: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        self._nodes.pop(run_id, None)
+        self._end(run_id)
+
+    def on_chain_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._nodes.pop(run_id, None)
+        self._end(run_id, error=True)
+
+
+def callbacks() -> list:
+    """the tracing callback handler for a run ([] when disabled)."""
+    tracer = _tracer
+    return [TracingCallbackHandler(tracer)] if tracer is not None else []
+
+
+class SamplingProfiler:
+    """Samples the Python stacks of all other threads every interval_s
+    into folded stacks ("frame;frame;frame count" lines)."""
+    def __init__(self, interval_s: float = 0.005):
+        self.interval_s = interval_s
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> "SamplingProfiler":
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self) -> None:
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval_s):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:"
+                                 f"{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def save(self, filepath: str) -> None:
+        with open(filepath, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+@contextmanager
+def trace_run(settings: Optional[DotDict], name: str,
+              output_path: Optional[str] = None) -> Iterator[Optional[Tracer]]:
+    """Traces the with block when settings (the tracing config block) is
+    enabled: writes the trace, the latency summary and, with
+    sampling_profiler, the folded stacks to settings.path (or output_path)
+    as {name}_*, and prints the slowest span types."""
+    if not (settings and settings.enabled):
+        yield None
+        return
+    tracer = enable_tracing()
+    profiler = None
+    if getattr(settings, "sampling_profiler", False):
+        profiler = SamplingProfiler(getattr(settings, "sample_interval_ms", 5) / 1000).start()
+    try:
+        with span(name, "run"):
+            yield tracer
+    finally:
+        if profiler is not None:
+            profiler.stop()
+        disable_tracing()
+        output_path = getattr(settings, "path", None) or output_path or "."
+        paths = tracer.save(output_path, name)
+        if profiler is not None:
+            paths["profile"] = os.path.join(output_path, f"{name}_profile.folded")
+            profiler.save(paths["profile"])
+        print_latency_summary(tracer.summary())
+        print(f"Trace written to {', '.join(paths.values())}")
+
+
+def print_latency_summary(summary: dict, top: int = 12) -> None:
+    """prints the span types with the most total time."""
+    rows = sorted(((category, name, stats) for category, names in summary.items()
+                   for name, stats in names.items()),
+                  key=lambda row: row[2]["total_ms"], reverse=True)
+    print("\n=== Latency by span (ms) ===")
+    for category, name, stats in rows[:top]:
+        print(f"{category:>8} {name[:48]:<48} n={stats['count']:<5} "
+              f"total {stats['total_ms']:>10.1f}  p50 {stats['p50_ms']:>8.2f}  "
+              f"p95 {stats['p95_ms']:>8.2f}  p99 {stats['p99_ms']:>8.2f}")
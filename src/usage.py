@@ -0,0 +1,466 @@
+"""Token and cost ledger of LLM calls, recorded once per call by a callback handler into
+the ledger of the current run (usage_scope), so concurrent runs keep separate ledgers."""
+
+import json
+import time
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field, asdict, fields, replace
+from typing import Any, Iterator, Optional
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+
+
+@dataclass
+class LLMCall:
+    """usage of a single chat model call."""
+    model: str
+    input_tokens: int = 0
+    cached_input_tokens: int = 0
+    output_tokens: int = 0
+    reasoning_tokens: int = 0
+    total_tokens: int = 0
+    latency_s: float = 0.0
+    cache_hit: bool = False
+    # the configured model whose pricing applies (set by UsageLedger.record;
+    # model is the name the provider reports)
+    billing_model: Optional[str] = None
+
+
+@dataclass
+class TokenUsage:
+    """aggregated usage over a set of LLM calls."""
+    model: str
+    stream_mode: str = "values"
+    input_tokens: int = 0
+    cached_input_tokens: int = 0
+    output_tokens: int = 0
+    reasoning_tokens: int = 0
+    total_tokens: int = 0
+    llm_calls: int = 0
+    llm_latency_s: float = 0.0
+    cache_hits: int = 0
+    events_seen: int = 0
+
+    def add_call(self, call: LLMCall) -> None:
+        """adds one LLM call to the totals (cache hits are not billed)."""
+        self.llm_calls += 1
+        self.llm_latency_s += call.latency_s
+        if call.cache_hit:
+            self.cache_hits += 1
+            return
+        self.input_tokens += call.input_tokens
+        self.cached_input_tokens += call.cached_input_tokens
+        self.output_tokens += call.output_tokens
+        self.reasoning_tokens += call.reasoning_tokens
+        self.total_tokens += call.total_tokens
+
+    def merge(self, other: "TokenUsage") -> None:
+        """adds the totals of another usage object."""
+        self.input_tokens += other.input_tokens
+        self.cached_input_tokens += other.cached_input_tokens
+        self.output_tokens += other.output_tokens
+        self.reasoning_tokens += other.reasoning_tokens
+        self.total_tokens += other.total_tokens
+        self.llm_calls += other.llm_calls
+        self.llm_latency_s += other.llm_latency_s
+        self.cache_hits += other.cache_hits
+        self.events_seen += other.events_seen
+
+    def save(self, filepath: str) -> None:
+        """saves the token usage to a JSON file."""
+        with open(filepath, 'w') as f:
+            json.dump(self.__dict__, f, indent=4)
+
+    def reset(self) -> None:
+        """resets the token usage."""
+        self.input_tokens = 0
+        self.cached_input_tokens = 0
+        self.output_tokens = 0
+        self.reasoning_tokens = 0
+        self.total_tokens = 0
+        self.llm_calls = 0
+        self.llm_latency_s = 0.0
+        self.cache_hits = 0
+        self.events_seen = 0
+
+
+@dataclass
+class CompletionSavings:
+    """model calls the completion contract skipped (estimated usage) and
+    turns cut off by the output-token budgets (see completion.py)."""
+    early_stops: int = 0
+    saved_input_tokens: int = 0
+    saved_output_tokens: int = 0
+    saved_seconds: float = 0.0
+    truncated_turns: int = 0
+    budget_stops: int = 0
+
+    def merge(self, other: "CompletionSavings") -> None:
+        for name, value in asdict(other).items():
+            setattr(self, name, getattr(self, name) + value)
+
+
+def prompt_cache_report(usage: TokenUsage, pricing: Any = None) -> dict:
+    """Reports how much of the input was served from the provider's prompt
+    cache and what the input effectively cost.
+
+    pricing holds USD per 1M tokens for input, cached_input and output
+    (the pricing block of agent_config.yaml); costs are omitted without it."""
+    report = {
+        "input_tokens": usage.input_tokens,
+        "cached_input_tokens": usage.cached_input_tokens,
+        "cache_hit_ratio": round(
+            usage.cached_input_tokens / usage.input_tokens, 4)
+            if usage.input_tokens else 0.0,
+    }
+    if pricing is not None:
+        uncached_tokens = usage.input_tokens - usage.cached_input_tokens
+        uncached_input_cost = usage.input_tokens * pricing.input / 1e6
+        effective_input_cost = (uncached_tokens * pricing.input
+                                + usage.cached_input_tokens * pricing.cached_input) / 1e6
+        report.update({
+            "effective_input_cost_usd": round(effective_input_cost, 6),
+            "uncached_input_cost_usd": round(uncached_input_cost, 6),
+            "input_cost_saved_usd": round(uncached_input_cost - effective_input_cost, 6),
+            "output_cost_usd": round(usage.output_tokens * pricing.output / 1e6, 6),
+        })
+    return report
+
+
+def tiered_cache_report(parts: list[tuple[TokenUsage, Any]]) -> dict:
+    """prompt_cache_report over usage billed at different rates (e.g. the
+    tiers of a cascade): the hit ratio is over all of it and the costs are
+    summed over the parts, each priced at its own rates (omitted when a part
+    has no pricing)."""
+    total = TokenUsage(parts[0][0].model if parts else "")
+    for usage, _ in parts:
+        total.merge(usage)
+    report = prompt_cache_report(total)
+    if parts and all(pricing is not None for _, pricing in parts):
+        for usage, pricing in parts:
+            for key, value in prompt_cache_report(usage, pricing).items():
+                if key.endswith("_usd"):
+                    report[key] = round(report.get(key, 0.0) + value, 6)
+    return report
+
+
+def percentile(values: list[float], q: float) -> float:
+    """nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(q * len(ordered)) - 1))]
+
+
+def stream_latency_report(turns: list[dict]) -> dict:
+    """Time to first token and inter-token latency over model turns."""
+    if not turns:
+        return {"turns": 0}
+    ttfts = [turn["ttft_s"] for turn in turns]
+    gaps = [turn["inter_token_mean_s"] for turn in turns
+            if turn.get("inter_token_mean_s") is not None]
+    report = {
+        "turns": len(turns),
+        "ttft_mean_s": round(sum(ttfts) / len(ttfts), 4),
+        "ttft_p50_s": round(percentile(ttfts, 0.5), 4),
+        "ttft_p95_s": round(percentile(ttfts, 0.95), 4),
+        "tokens": sum(turn.get("tokens", 0) for turn in turns),
+    }
+    if gaps:
+        report["inter_token_mean_s"] = round(sum(gaps) / len(gaps), 5)
+        report["inter_token_max_s"] = max(turn["inter_token_max_s"] for turn in turns
+                                          if turn.get("inter_token_max_s") is not None)
+    return report
+
+
+def apportion(total: float, weights: list[float]) -> list:
+    """splits total by weights; integer totals are split into integers that
+    sum to total (largest remainder first)."""
+    weight_sum = sum(weights) or 1
+    shares = [total * weight / weight_sum for weight in weights]
+    if not isinstance(total, int) or isinstance(total, bool):
+        return shares
+    parts = [int(share) for share in shares]
+    by_remainder = sorted(range(len(shares)), key=lambda i: parts[i] - shares[i])
+    for i in by_remainder[:total - sum(parts)]:
+        parts[i] += 1
+    return parts
+
+
+def _apportion_fields(value: Any, weights: list[float]) -> list:
+    """one copy of a dataclass per weight with its numeric fields apportioned."""
+    split = {item.name: apportion(getattr(value, item.name), weights) for item in fields(value)
+             if isinstance(getattr(value, item.name), (int, float))
+             and not isinstance(getattr(value, item.name), bool)}
+    return [replace(value, **{name: parts[i] for name, parts in split.items()})
+            for i in range(len(weights))]
+
+
+class UsageLedger:
+    """Records the LLM calls of one run (e.g. one patient for one skill)."""
+    def __init__(self, model: str, stream_mode: str = "values",
+                 patient_id: Optional[int] = None, skill: Optional[str] = None,
+                 pricing: Any = None, prefix_fingerprint: Optional[str] = None):
+        self.patient_id = patient_id
+        self.skill = skill
+        self.pricing = pricing
+        self.prefix_fingerprint = prefix_fingerprint
+        self.usage = TokenUsage(model, stream_mode)
+        self.calls: list[LLMCall] = []
+        # per model turn stream timings (see streaming.StreamRenderer)
+        self.turns: list[dict] = []
+        self.completion = CompletionSavings()
+        # set on the per-patient parts of a run shared by several patients
+        self.shared: Optional[dict] = None
+        # the rates of every model with calls in the ledger (merged cascade
+        # tiers are billed at their own pricing)
+        self.pricing_by_model = {model: pricing}
+        self._lock = threading.Lock()
+
+    def record(self, call: LLMCall) -> None:
+        """records one LLM call."""
+        if call.billing_model is None:
+            call.billing_model = self.usage.model
+        with self._lock:
+            self.calls.append(call)
+            self.usage.add_call(call)
+
+    def count_event(self) -> None:
+        """counts one streamed graph event (informational only)."""
+        with self._lock:
+            self.usage.events_seen += 1
+
+    def record_turn(self, timing: dict) -> None:
+        """records the stream timing of one model turn."""
+        with self._lock:
+            self.turns.append(timing)
+
+    def record_completion(self, **amounts) -> None:
+        """adds to the completion contract counters (see completion.py)."""
+        with self._lock:
+            self.completion.merge(CompletionSavings(**amounts))
+
+    def merge(self, other: "UsageLedger") -> None:
+        """adds the calls and turns of another run (e.g. a cascade tier)."""
+        with self._lock:
+            self.calls.extend(other.calls)
+            self.turns.extend(other.turns)
+            self.usage.merge(other.usage)
+            self.completion.merge(other.completion)
+            for model, pricing in other.pricing_by_model.items():
+                self.pricing_by_model.setdefault(model, pricing)
+
+    def priced_usage(self) -> list[tuple[TokenUsage, Any]]:
+        """the usage per model with the pricing it is billed at."""
+        if len(self.pricing_by_model) == 1:
+            return [(self.usage, self.pricing)]
+        usages = {}
+        for call in self.calls:
+            usages.setdefault(call.billing_model, TokenUsage(call.billing_model)).add_call(call)
+        return [(usage, self.pricing_by_model.get(model, self.pricing))
+                for model, usage in usages.items()]
+
+    def split(self, shares: dict[int, float]) -> dict[int, "UsageLedger"]:
+        """Splits a run shared by several patients (e.g. a judge pack) into
+        one ledger per patient, pro rata to shares: every call's tokens,
+        latency and the completion counters are apportioned, so the parts
+        sum to the run. Each part counts the calls the patient took part
+        in and keeps the run's stream timings."""
+        patient_ids = list(shares)
+        weights = [shares[patient_id] for patient_id in patient_ids]
+        parts = {patient_id: UsageLedger(self.usage.model, self.usage.stream_mode, patient_id,
+                                         self.skill, self.pricing, self.prefix_fingerprint)
+                 for patient_id in patient_ids}
+        for part in parts.values():
+            part.pricing_by_model = dict(self.pricing_by_model)
+        for call in self.calls:
+            for patient_id, part in zip(patient_ids, _apportion_fields(call, weights)):
+                parts[patient_id].record(part)
+        events = apportion(self.usage.events_seen, weights)
+        completions = _apportion_fields(self.completion, weights)
+        weight_sum = sum(weights) or 1
+        for i, patient_id in enumerate(patient_ids):
+            part = parts[patient_id]
+            part.usage.events_seen = events[i]
+            part.completion = completions[i]
+            part.turns = list(self.turns)
+            part.shared = {"patients": patient_ids, "share": round(weights[i] / weight_sum, 4)}
+        return parts
+
+    def to_dict(self) -> dict:
+        return {
+            "patient_id": self.patient_id,
+            "skill": self.skill,
+            **({"shared": self.shared} if self.shared else {}),
+            **asdict(self.usage),
+            "prompt_cache": {
+                "prefix_fingerprint": self.prefix_fingerprint,
+                **tiered_cache_report(self.priced_usage()),
+            },
+            "streaming": stream_latency_report(self.turns),
+            "completion": asdict(self.completion),
+            "calls": [asdict(call) for call in self.calls],
+        }
+
+    def save(self, filepath: str) -> None:
+        """saves the totals and the per-call records to a JSON file."""
+        with open(filepath, 'w') as f:
+            json.dump(self.to_dict(), f, indent=4)
+
+
+@dataclass
+class BatchUsage:
+    """Aggregates ledgers per patient, per skill and for the whole batch."""
+    model: str
+    ledgers: list[UsageLedger] = field(default_factory=list)
+
+    def add(self, ledger: UsageLedger) -> None:
+        self.ledgers.append(ledger)
+
+    def total(self) -> TokenUsage:
+        """usage summed over the whole batch."""
+        usage = TokenUsage(self.model)
+        for ledger in self.ledgers:
+            usage.merge(ledger.usage)
+        return usage
+
+    def cache_report(self) -> dict:
+        """prompt cache ratio and costs of the batch, with the usage of every
+        model priced at its own rates (see UsageLedger.priced_usage)."""
+        by_model = {}
+        for ledger in self.ledgers:
+            for usage, pricing in ledger.priced_usage():
+                total, _ = by_model.setdefault(usage.model, (TokenUsage(usage.model), pricing))
+                total.merge(usage)
+        return tiered_cache_report(list(by_model.values()))
+
+    def stream_report(self) -> dict:
+        """time to first token / inter-token latency over all runs."""
+        return stream_latency_report(
+            [turn for ledger in self.ledgers for turn in ledger.turns])
+
+    def completion_report(self, num_patients: Optional[int] = None) -> dict:
+        """completion contract savings over all runs and per patient (per
+        run without num_patients; packed runs cover several patients)."""
+        savings = CompletionSavings()
+        for ledger in self.ledgers:
+            savings.merge(ledger.completion)
+        patients = num_patients or len(self.ledgers) or 1
+        return {**asdict(savings), "saved_seconds": round(savings.saved_seconds, 3),
+                "per_patient": {"saved_input_tokens": round(savings.saved_input_tokens / patients, 1),
+                                "saved_output_tokens": round(savings.saved_output_tokens / patients, 1),
+                                "saved_seconds": round(savings.saved_seconds / patients, 3)}}
+
+    def by_skill(self) -> dict[str, TokenUsage]:
+        """usage summed per skill."""
+        return self._group(lambda ledger: ledger.skill)
+
+    def by_patient(self) -> dict[int, TokenUsage]:
+        """usage summed per patient (over all skills)."""
+        return self._group(lambda ledger: ledger.patient_id)
+
+    def _group(self, key) -> dict:
+        groups = {}
+        for ledger in self.ledgers:
+            usage = groups.setdefault(key(ledger), TokenUsage(self.model))
+            usage.merge(ledger.usage)
+        return groups
+
+
+current_ledger: ContextVar[Optional[UsageLedger]] = ContextVar(
+    "current_ledger", default=None)
+
+
+@contextmanager
+def usage_scope(ledger: UsageLedger) -> Iterator[UsageLedger]:
+    """makes the ledger receive all LLM calls made in this context."""
+    token = current_ledger.set(ledger)
+    try:
+        yield ledger
+    finally:
+        current_ledger.reset(token)
+
+
+def _sum_details(details: Optional[dict], suffix: str) -> int:
+    """sums token details whose key ends with suffix (e.g. priority_cache_read)."""
+    return sum(value or 0 for key, value in (details or {}).items()
+               if key.endswith(suffix))
+
+
+def call_from_result(response: LLMResult, model: str,
+                     latency_s: float = 0.0) -> LLMCall:
+    """Builds an LLMCall from a model result.
+
+    The message usage_metadata is preferred; the provider's raw token_usage
+    in llm_output is only used when no message carries usage_metadata, so a
+    call is never counted twice."""
+    call = LLMCall(model=model, latency_s=round(latency_s, 4))
+    found = False
+    for generations in response.generations:
+        for generation in generations:
+            message = getattr(generation, "message", None)
+            usage = getattr(message, "usage_metadata", None)
+            if not usage:
+                continue
+            found = True
+            call.input_tokens += usage.get("input_tokens", 0)
+            call.output_tokens += usage.get("output_tokens", 0)
+            call.total_tokens += usage.get("total_tokens", 0)
+            call.cached_input_tokens += _sum_details(
+                usage.get("input_token_details"), "cache_read")
+            call.reasoning_tokens += _sum_details(
+                usage.get("output_token_details"), "reasoning")
+            call.model = message.response_metadata.get("model_name", call.model)
+            # langchain zeroes the cost of responses replayed from a cache
+            call.cache_hit = call.cache_hit or usage.get("total_cost") == 0
+
+    if not found:
+        llm_output = response.llm_output or {}
+        usage = llm_output.get("token_usage") or llm_output.get("usage") or {}
+        call.input_tokens = usage.get("prompt_tokens", usage.get("input_tokens", 0))
+        call.output_tokens = usage.get("completion_tokens", usage.get("output_tokens", 0))
+        call.total_tokens = usage.get(
+            "total_tokens", call.input_tokens + call.output_tokens)
+        call.cached_input_tokens = (usage.get("prompt_tokens_details") or {}).get(
+            "cached_tokens", 0) or 0
+        call.reasoning_tokens = (usage.get("completion_tokens_details") or {}).get(
+            "reasoning_tokens", 0) or 0
+        call.model = llm_output.get("model_name", call.model)
+    return call
+
+
+class UsageCallbackHandler(BaseCallbackHandler):
+    """Routes the usage of every chat model call to the current ledger.
+
+    The ledger is captured when the call starts, so the call is attributed
+    to the run that issued it even if the end event is handled elsewhere."""
+    run_inline = True
+
+    def __init__(self, model: str):
+        self.model = model
+        self._pending: dict[UUID, tuple[float, UsageLedger]] = {}
+
+    def on_chat_model_start(self, serialized: dict[str, Any], messages: list,
+                            *, run_id: UUID, **kwargs: Any) -> None:
+        ledger = current_ledger.get()
+        if ledger is not None:
+            self._pending[run_id] = (time.perf_counter(), ledger)
+
+    def on_llm_start(self, serialized: dict[str, Any], prompts: list[str],
+                     *, run_id: UUID, **kwargs: Any) -> None:
+        self.on_chat_model_start(serialized, [], run_id=run_id, **kwargs)
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID,
+                   **kwargs: Any) -> None:
+        pending = self._pending.pop(run_id, None)
+        if pending is None:
+            return
+        start, ledger = pending
+        ledger.record(call_from_result(
+            response, self.model, time.perf_counter() - start))
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID,
+                     **kwargs: Any) -> None:
+        self._pending.pop(run_id, None)
@@ -24,6 +24,8 @@ class DotDict:
             value = getattr(self, key)
             if isinstance(value, DotDict):
                 value = value.to_dict()
+            if isinstance(value, list):
+                value = [item.to_dict() if isinstance(item, DotDict) else item for item in value]
             result[key] = value
         return result
 
@@ -0,0 +1,65 @@
+"""Shared fixtures: the repo's agent config with local paths and agents
+around stub_models.StubChatModel, so the tests run offline."""
+
+import os
+import contextlib
+
+import pytest
+
+import agents
+import local_tools
+import stub_models
+from utils import ConfigLoader
+
+REPO_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+SRC_PATH = os.path.join(REPO_PATH, "src")
+SKILL_PATH = os.path.join(REPO_PATH, "skills")
+SAMPLE_DATA_PATH = os.path.join(REPO_PATH, "data", "text_files")
+SKILL_NAME = "clinical_insights_skill"
+
+
+@pytest.fixture
+def output_path(tmp_path):
+    path = tmp_path / "outputs"
+    path.mkdir()
+    return str(path)
+
+
+@pytest.fixture
+def agent_config(tmp_path):
+    """the repo's agent config with local paths, the caches and the rate
+    limiter disabled."""
+    config = ConfigLoader(os.path.join(SRC_PATH, "agent_config.yaml")).dotdict
+    config.system_prompt_file_path = os.path.join(SRC_PATH, "system_prompt.txt")
+    config.response_cache.enabled = False
+    config.rate_limit.enabled = False
+    config.memory.path = str(tmp_path / "chat_memory.sqlite")
+    config.output_sink.path = str(tmp_path / "results.sqlite")
+    return config
+
+
+def build_agent(config, grounded: bool = True) -> agents.Agent:
+    """an insights agent whose model replays the skill's tool calls."""
+    llm = stub_models.StubChatModel(
+        turns=stub_models.insights_tool_turns(grounded),
+        turns_by_prompt=stub_models.insights_branch_turns(grounded))
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        return agents.prepare_agent(SKILL_NAME, SKILL_PATH, config, llm=llm, reuse=False)
+
+
+def load_patient(patient_id: int) -> dict:
+    return local_tools.load_patient_data(
+        patient_id, base_path=SAMPLE_DATA_PATH, line_numbers=False)
+
+
+def run_patient(agent: agents.Agent, patient_id: int, output_path: str) -> None:
+    """runs the insights skill for one sample patient and flushes its outputs."""
+    data = local_tools.load_patient_data(patient_id, base_path=SAMPLE_DATA_PATH)
+    documents_xml = local_tools.create_xml_document({
+        "patient_id": patient_id, "notes": data["note"], "questions": data["question"],
+    }, root_tag="documents")
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        agents.run_agent(agent, f"test_{patient_id:04d}", user_query=documents_xml,
+                         metadata={"patient_id": patient_id, "skill_name": SKILL_NAME,
+                                   "output_base_path": output_path})
+    agent.output_sink.flush()
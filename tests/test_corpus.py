@@ -0,0 +1,89 @@
+import os
+import json
+
+import pytest
+
+import local_tools
+from conftest import SAMPLE_DATA_PATH
+from corpus import (CORPUS_DATA_FILENAME, CORPUS_INDEX_FILENAME, CorpusWriter, PackedCorpus,
+                    add_line_numbers, open_corpus)
+
+
+def write_corpus(base_path: str, patients: dict) -> None:
+    with CorpusWriter(base_path) as writer:
+        for patient_id, note in patients.items():
+            writer.add(patient_id, note, f"question {patient_id}", f"answer {patient_id}")
+
+
+def data_filename(base_path: str) -> str:
+    with open(os.path.join(base_path, CORPUS_INDEX_FILENAME)) as f:
+        return json.load(f)["data"]
+
+
+def test_load_matches_the_text_files(tmp_path):
+    base_path = str(tmp_path)
+    with CorpusWriter(base_path) as writer:
+        for patient_id in (2, 5):
+            data = local_tools.load_patient_data(
+                patient_id, base_path=SAMPLE_DATA_PATH, line_numbers=False)
+            writer.add(patient_id, data["note"], data["question"], data["answer"])
+
+    corpus = PackedCorpus(base_path)
+    try:
+        assert corpus.patient_ids() == [2, 5]
+        for patient_id in (2, 5):
+            for line_numbers in (True, False):
+                assert corpus.load(patient_id, line_numbers) == local_tools.load_patient_data(
+                    patient_id, base_path=SAMPLE_DATA_PATH, line_numbers=line_numbers)
+        assert corpus.read(2, "note_numbered") == add_line_numbers(corpus.read(2, "note"))
+    finally:
+        corpus.close()
+
+
+def test_appending_keeps_the_data_file(tmp_path):
+    base_path = str(tmp_path)
+    write_corpus(base_path, {1: "first note"})
+    write_corpus(base_path, {2: "second note"})
+    assert data_filename(base_path) == CORPUS_DATA_FILENAME
+    corpus = PackedCorpus(base_path)
+    try:
+        assert corpus.read(1, "note") == "first note"
+        assert corpus.read(2, "note_numbered") == "1: second note"
+    finally:
+        corpus.close()
+
+
+def test_replacing_a_patient_compacts_into_a_new_generation(tmp_path):
+    base_path = str(tmp_path)
+    write_corpus(base_path, {1: "old note", 2: "kept note"})
+    write_corpus(base_path, {1: "new note"})
+    data = data_filename(base_path)
+    assert data != CORPUS_DATA_FILENAME
+    assert sorted(os.listdir(base_path)) == sorted([data, CORPUS_INDEX_FILENAME])
+    corpus = PackedCorpus(base_path)
+    try:
+        assert corpus.read(1, "note") == "new note"
+        assert corpus.read(2, "note") == "kept note"
+    finally:
+        corpus.close()
+
+
+def test_stale_view_is_closed_by_its_last_user(tmp_path):
+    base_path = str(tmp_path)
+    write_corpus(base_path, {1: "old note"})
+    with open_corpus(base_path) as old:
+        assert old.read(1, "note") == "old note"
+        write_corpus(base_path, {1: "new note"})
+        os.utime(os.path.join(base_path, CORPUS_INDEX_FILENAME), ns=(1, 1))
+        with open_corpus(base_path) as new:
+            assert new is not old
+            assert new.read(1, "note") == "new note"
+        # the replaced view stays readable while it is in use
+        assert old.read(1, "note") == "old note"
+    with pytest.raises(ValueError):
+        old.read(1, "note")
+
+
+def test_missing_corpus(tmp_path):
+    with open_corpus(str(tmp_path)) as corpus:
+        assert corpus is None
@@ -0,0 +1,77 @@
+import grounding
+from conftest import SAMPLE_DATA_PATH, build_agent, run_patient
+
+NOTE = "\n".join([
+    "Patient admitted with community acquired pneumonia.",
+    "Started on intravenous ceftriaxone and azithromycin.",
+    "Discharged home on oral amoxicillin for five days.",
+])
+CITATION = {"citation_number": "1", "section": "Notes", "line_start": "2", "line_end": "2"}
+
+
+def treatment(text: str, citations=(CITATION,)) -> dict:
+    return {"recommended_treatment": text, "citations": list(citations)}
+
+
+def check(output: dict) -> dict:
+    return grounding.check_output(output, "recommended_treatment", grounding.NoteIndex(NOTE))
+
+
+def test_supported_sentence():
+    report = check(treatment("Started on intravenous ceftriaxone and azithromycin [1]."))
+    assert report["risk"] == 0.0
+    assert report["issues"] == []
+
+
+def test_uncited_sentence():
+    report = check(treatment("Started on intravenous ceftriaxone and azithromycin."))
+    assert report["risk"] == 0.5
+    assert report["issues"][0]["type"] == "uncited"
+
+
+def test_dangling_citation():
+    report = check(treatment("Started on intravenous ceftriaxone [2]."))
+    assert report["risk"] == 1.0
+    assert report["issues"][0]["type"] == "invalid_citation"
+
+
+def test_number_not_in_note():
+    report = check(treatment("Started on 500 mg ceftriaxone and azithromycin [1]."))
+    assert report["risk"] == 1.0
+    assert report["issues"][0] == {"sentence": 0, "type": "number_not_in_note", "numbers": ["500"]}
+
+
+def test_citation_outside_the_note():
+    report = check(treatment("Discharged home [1].", [{**CITATION, "line_end": "9"}]))
+    assert report["risk"] == 1.0
+
+
+def test_insufficient_support_claims_nothing():
+    assert check(treatment(grounding.INSUFFICIENT_SUPPORT, []))["risk"] == 0.0
+
+
+def test_missing_output_is_high_risk():
+    report = grounding.check_patient(NOTE, {"treatment_recommendation": treatment(
+        "Started on intravenous ceftriaxone and azithromycin [1].")})
+    assert report["treatment_recommendation"]["risk"] == 0.0
+    assert report["clinical_summary"]["issues"] == [{"type": "missing_output"}]
+    assert report["risk"] == 1.0
+
+
+def test_select_for_judge():
+    reports = {2: {"risk": 0.0}, 5: {"risk": 0.5}, 11: {"risk": 1.0}}
+    assert grounding.select_for_judge(reports, 0.5) == [5, 11]
+
+
+def test_cohort_check(agent_config, output_path):
+    grounded = build_agent(agent_config, grounded=True)
+    ungrounded = build_agent(agent_config, grounded=False)
+    run_patient(grounded, 2, output_path)
+    run_patient(ungrounded, 5, output_path)
+
+    reports = grounding.check_patients([2, 5], grounded.output_sink, output_path,
+                                       SAMPLE_DATA_PATH)
+    assert reports[2]["risk"] < 0.5 <= reports[5]["risk"]
+    grounding.write_reports(reports, grounded.output_sink, output_path)
+    assert grounded.output_sink.read(output_path, grounding.report_filename(5))["risk"] == reports[5]["risk"]
+    assert grounding.grounding_summary(reports)["patients"] == 2
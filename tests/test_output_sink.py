@@ -0,0 +1,80 @@
+import os
+
+import pytest
+
+from conftest import build_agent, run_patient
+from output_sink import (FileSink, MemorySink, SQLiteSink, WriteBehindSink, decode_value,
+                         encode_value, get_output_sink, parse_artifact_name, sink_scope)
+
+
+@pytest.fixture(params=["files", "sqlite", "memory", "write_behind"])
+def sink(request, tmp_path):
+    if request.param == "files":
+        sink = FileSink()
+    elif request.param == "sqlite":
+        sink = SQLiteSink(str(tmp_path / "results.sqlite"))
+    elif request.param == "memory":
+        sink = MemorySink()
+    else:
+        sink = WriteBehindSink(SQLiteSink(str(tmp_path / "results.sqlite")))
+    yield sink
+    sink.close()
+
+
+def test_parse_artifact_name():
+    assert parse_artifact_name("out/pid0011_clinical_summary.json") == (11, "clinical_summary.json")
+    assert parse_artifact_name("notes.md") == (None, "notes.md")
+
+
+def test_texts_are_stored_verbatim():
+    # text_writer may write a .json filename with any text
+    assert encode_value("pid0001_eval.json", '{"a": 1}') == '{"a": 1}'
+    assert decode_value("pid0001_eval.json", "not json") == "not json"
+    assert decode_value("pid0001_eval.json", encode_value("x.json", {"a": [1]})) == {"a": [1]}
+    assert decode_value("pid0001_notes.md", "[1, 2]") == "[1, 2]"
+
+
+def test_round_trip(sink, output_path):
+    sink.write(output_path, "pid0001_summary.json", {"summary": "ok"})
+    sink.write(output_path, "pid0001_notes.md", "# Notes\n")
+    sink.flush()
+    assert sink.read_many(output_path, ["pid0001_summary.json", "pid0001_notes.md", "missing.md"]) == {
+        "pid0001_summary.json": {"summary": "ok"}, "pid0001_notes.md": "# Notes\n"}
+    assert sink.exists(output_path, "pid0001_notes.md")
+    assert not sink.exists(output_path, "missing.md")
+
+
+def test_versions_change_on_rewrite(sink, output_path):
+    sink.write(output_path, "pid0001_notes.md", "first")
+    sink.flush()
+    before = sink.versions(output_path, ["pid0001_notes.md", "missing.md"])
+    assert list(before) == ["pid0001_notes.md"]
+    sink.write(output_path, "pid0001_notes.md", "second, longer")
+    sink.flush()
+    assert sink.versions(output_path, ["pid0001_notes.md"]) != before
+
+
+def test_sink_scope():
+    outer, inner = MemorySink(), MemorySink()
+    with sink_scope(outer):
+        with sink_scope(inner):
+            assert get_output_sink() is inner
+        assert get_output_sink() is outer
+    assert isinstance(get_output_sink(), FileSink)
+
+
+def test_agents_write_to_their_own_sink(agent_config, tmp_path, output_path):
+    files_agent = build_agent(agent_config)
+    agent_config.output_sink.backend = "sqlite"
+    sqlite_agent = build_agent(agent_config)
+    assert isinstance(sqlite_agent.output_sink, SQLiteSink)
+
+    run_patient(files_agent, 2, output_path)
+    run_patient(sqlite_agent, 5, output_path)
+    assert sorted(os.listdir(output_path)) == [
+        "pid0002_clinical_summary.json", "pid0002_notes_with_toc.md",
+        "pid0002_treatment_recommendation.json"]
+    stored = [artifact["filename"] for artifact in sqlite_agent.output_sink.iter_artifacts()]
+    assert sorted(stored) == [
+        "pid0005_clinical_summary.json", "pid0005_notes_with_toc.md",
+        "pid0005_treatment_recommendation.json"]
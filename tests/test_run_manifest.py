@@ -0,0 +1,81 @@
+import os
+
+import pytest
+
+import run_manifest
+from conftest import SKILL_NAME, build_agent, load_patient, run_patient
+
+
+@pytest.fixture
+def manifest(tmp_path):
+    manifest = run_manifest.RunManifest(str(tmp_path / "run_manifest.sqlite"))
+    yield manifest
+    manifest.close()
+
+
+@pytest.fixture
+def agent(agent_config):
+    return build_agent(agent_config)
+
+
+def plan(manifest, agent, output_path, patient_ids=(2,)):
+    return run_manifest.plan_run(manifest, agent, SKILL_NAME, list(patient_ids), load_patient,
+                                 agent.output_sink, output_path)
+
+
+def test_done_run_is_skipped(manifest, agent, output_path):
+    first = plan(manifest, agent, output_path, (2, 5))
+    assert first.reasons == {2: "new", 5: "new"}
+    run_patient(agent, 2, output_path)
+    assert run_manifest.record_patient(first, 2, agent.output_sink, output_path) == "done"
+
+    second = plan(manifest, agent, output_path, (2, 5))
+    assert second.reasons == {2: "unchanged", 5: "new"}
+    assert second.to_run == [5]
+
+
+def test_changed_outputs_rerun(manifest, agent, output_path):
+    first = plan(manifest, agent, output_path)
+    run_patient(agent, 2, output_path)
+    run_manifest.record_patient(first, 2, agent.output_sink, output_path)
+    os.remove(os.path.join(output_path, "pid0002_clinical_summary.json"))
+    assert plan(manifest, agent, output_path).reasons == {2: "outputs_changed"}
+
+
+def test_outputs_of_an_earlier_run_do_not_count(manifest, agent, output_path):
+    run_patient(agent, 2, output_path)
+    # the outputs exist before the planned run, which then writes nothing
+    stale = plan(manifest, agent, output_path)
+    assert run_manifest.record_patient(stale, 2, agent.output_sink, output_path) == "failed"
+    row = manifest.rows(SKILL_NAME, [2])[2]
+    assert row["status"] == "failed"
+    assert plan(manifest, agent, output_path).reasons == {2: "failed"}
+
+
+def test_error_is_recorded(manifest, agent, output_path):
+    failed = plan(manifest, agent, output_path)
+    run_patient(agent, 2, output_path)
+    status = run_manifest.record_patient(failed, 2, agent.output_sink, output_path,
+                                         error=KeyboardInterrupt())
+    assert status == "failed"
+    with manifest._lock:
+        error, = manifest._conn.execute("SELECT error FROM runs").fetchone()
+    assert error == "KeyboardInterrupt()"
+
+
+def test_cleared_patient_is_done(manifest, agent, output_path):
+    cleared = plan(manifest, agent, output_path)
+    agent.output_sink.write(output_path, "pid0002_grounding_check.json", {"risk": 0.0})
+    run_manifest.record_cleared(cleared, 2, agent.output_sink, output_path,
+                                ["pid0002_grounding_check.json"])
+    assert plan(manifest, agent, output_path).reasons == {2: "unchanged"}
+
+
+def test_config_change_reruns(manifest, agent_config, output_path):
+    agent = build_agent(agent_config)
+    first = plan(manifest, agent, output_path)
+    run_patient(agent, 2, output_path)
+    run_manifest.record_patient(first, 2, agent.output_sink, output_path)
+
+    agent_config.model.temperature = 0.5
+    assert plan(manifest, build_agent(agent_config), output_path).reasons == {2: "config_changed"}